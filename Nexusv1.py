@@ -1,14 +1,29 @@
 import discord
 from discord.ext import commands, tasks
-import psycopg2  # Reemplaza sqlite3
+import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import execute_values
+import sqlite3
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import random
+import math
+import heapq
+from collections import OrderedDict, deque
+import bisect
+import functools
+from abc import ABC, abstractmethod
+import sys
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from contextlib import contextmanager  # Para un mejor manejo de la conexión
 import asyncio
-from typing import Optional
+import aiohttp
+import multiprocessing
+import signal
+from typing import Awaitable, Callable, Literal, Optional, Union
 import os
-from flask import Flask  # Para mantener el bot vivo en Render
+from aiohttp import web  # Servidor de salud para Render (aiohttp ya viene con discord.py)
 
 # ----------------------------------------------------
 # 1. CLASE DE AYUDA PERSONALIZADA
@@ -32,24 +47,27 @@ class CustomHelpCommand(commands.HelpCommand):
 
 
         mod_cmds = (
-            "`/mod-ban <user> <razón>`: Banea a un usuario.",
+            "`/mod-ban <user> <razón> [duración]`: Banea a un usuario (temporal opcional).",
             "`/mod-kick <user> <razón>`: Expulsa a un usuario.",
-            "`/mod-mute <user> <duración>`: Silencia temporalmente.",
+            "`/mod-mute <user> <duración>`: Silencia temporalmente (aislamiento nativo o rol).",
             "`/mod-warn <user> <razón>`: Aplica una advertencia.",
-            "`/mod-purge <cantidad>`: Borra mensajes del canal."
+            "`/mod-warnings <user>`: Muestra las advertencias (paginadas).",
+            "`/mod-clearwarnings <user> [older_than] [from_id] [to_id]`: Borra advertencias.",
+            "`/mod-purge <cantidad> [filtros]`: Borra mensajes del canal (por autor, bots, texto, adjuntos o rango)."
         )
         embed.add_field(name="🛡️ Moderación (Slash)", value='\n'.join(mod_cmds), inline=False)
 
 
         eco_cmds = (
             f"`{prefix}balance` o `{prefix}bal`: Muestra tu saldo.",
+            f"`{prefix}transactions [usuario]` o `{prefix}tx`: Muestra el historial de movimientos de dinero.",
             f"`{prefix}daily`: Reclama tu recompensa diaria.",
             f"`{prefix}work`: Gana dinero por trabajar.",
             f"`{prefix}flip <cara|cruz> <monto>`: Apuesta a cara o cruz.",
             f"`{prefix}shop`: Ve los roles a la venta.",
             f"`{prefix}buyrole <rol>`: Compra un rol de la tienda.",
             f"`{prefix}rank`: Muestra tu nivel y XP.",
-            f"`{prefix}leaderboard` o `{prefix}top`: Muestra la tabla de niveles."
+            f"`{prefix}leaderboard [levels|balance]` o `{prefix}top`: Muestra la tabla de niveles o de dinero."
         )
         embed.add_field(name="💰 Economía y Niveles (Prefix)", value='\n'.join(eco_cmds), inline=False)
 
@@ -65,7 +83,10 @@ class CustomHelpCommand(commands.HelpCommand):
         util_cmds = (
             "`/report <user> <razón>`: Reporta a un usuario.",
             "`/admin-setlogs <canal>`: Configura el canal de logs.",
+            "`/admin-setmutemode <timeout|role>`: Elige cómo silencia `/mod-mute`.",
             "`/admin-setmoney <user> <monto>`: Establece el saldo de un usuario (Admin).",
+            "`/admin-addxp|setxp|setlevel <user|rol> <valor>`: Modifica XP o nivel en lote (Admin).",
+            "`/admin-addshoprole|removeshoprole <rol>`: Gestiona los roles de la tienda (Admin).",
             f"`{prefix}sync`: Sincroniza comandos Slash (Owner)."
         )
         embed.add_field(name="🛠️ Utilidad / Admin", value='\n'.join(util_cmds), inline=False)
@@ -81,301 +102,2870 @@ class CustomHelpCommand(commands.HelpCommand):
 
 OWNER_ID = 1224791534436749354
 PREFIX = '!'
-INTENTS = discord.Intents.all()
+
+
+def parse_flags(spec: str, flags_cls, presets: tuple[str, ...]):
+    """
+    Construye `discord.Intents` o `discord.MemberCacheFlags` a partir de una lista separada por comas.
+
+    Acepta presets (`all`, `default`, `none`...), nombres de flags para activarlos y `-nombre` para
+    desactivarlos, p. ej. `default,members,message_content,-typing`.
+    """
+    flags = flags_cls.none()
+    for name in (part.strip() for part in spec.split(',')):
+        if not name:
+            continue
+        if name in presets:
+            flags.value |= getattr(flags_cls, name)().value
+        elif name.lstrip('-') in flags_cls.VALID_FLAGS:
+            setattr(flags, name.lstrip('-'), not name.startswith('-'))
+        else:
+            raise ValueError(f"Flag desconocido en {flags_cls.__name__}: {name}")
+    return flags
+
+# Por defecto se mantiene todo activo; en servidores grandes conviene algo como
+# INTENTS="default,members,message_content", MEMBER_CACHE_FLAGS="joined" y CHUNK_GUILDS_AT_STARTUP=false.
+INTENTS = parse_flags(os.getenv('INTENTS', 'all'), discord.Intents, ('all', 'default', 'none'))
+# Sin MEMBER_CACHE_FLAGS se cachea todo lo que permiten los intents (comportamiento de discord.py).
+MEMBER_CACHE_FLAGS = (
+    parse_flags(os.environ['MEMBER_CACHE_FLAGS'], discord.MemberCacheFlags, ('all', 'none'))
+    if os.getenv('MEMBER_CACHE_FLAGS') else discord.MemberCacheFlags.from_intents(INTENTS)
+)
+CHUNK_GUILDS_AT_STARTUP = os.getenv('CHUNK_GUILDS_AT_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+MEMBER_FALLBACK_CACHE_SIZE = int(os.getenv('MEMBER_FALLBACK_CACHE_SIZE', 5000))
+MEMBER_FALLBACK_CACHE_TTL_SECONDS = 600
+# Cola de envío: los logs y anuncios de nivel se agrupan durante esta ventana antes de enviarse.
+OUTBOUND_COALESCE_SECONDS = 1.0
+OUTBOUND_MAX_PENDING_PER_CHANNEL = 500
+OUTBOUND_USE_WEBHOOKS = os.getenv('OUTBOUND_USE_WEBHOOKS', 'false').lower() in ('1', 'true', 'yes')
+OUTBOUND_WEBHOOK_NAME = "Nexus Logs"
+OUTBOUND_WEBHOOK_RETRY_SECONDS = 300
+OUTBOUND_DRAIN_TIMEOUT_SECONDS = 10
 MUTE_ROLE_NAME = "Silenciado"
+# 'timeout' usa el aislamiento nativo de Discord (una sola llamada, expira en el servidor);
+# 'role' usa el rol de silencio y un desmuteo programado. Se elige por servidor con /admin-setmutemode.
+DEFAULT_MUTE_MODE = 'timeout'
+MAX_TIMEOUT_DURATION = timedelta(days=28)  # Límite de Discord para los aislamientos.
+MUTE_OVERWRITE_CONCURRENCY = 5
+# Caché de auditoría para los logs de mensajes borrados (solo servidores con canal de logs).
+AUDIT_CACHE_MAX_BYTES = int(os.getenv('AUDIT_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+AUDIT_CONTENT_MAX_CHARS = 1000
+AUDIT_RECORD_OVERHEAD_BYTES = 200
+AUDIT_BULK_LOG_MAX_CHARS = 3500
+# Tamaño de la caché interna de mensajes de discord.py; la auditoría ya no depende de ella.
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', 1000))
+WARNINGS_PAGE_SIZE = 10
+PURGE_MAX_AMOUNT = 5000
+PURGE_SCAN_LIMIT = 20000  # Mensajes revisados como máximo al aplicar filtros.
+PURGE_PROGRESS_INTERVAL_SECONDS = 2.0
 DAILY_REWARD = 500
 ECONOMY_COOLDOWN_DAILY_HOURS = 24
 ECONOMY_COOLDOWN_WORK_HOURS = 1
+ECONOMY_COOLDOWN_ROB_HOURS = 2
+# Cooldown en segundos de cada acción de economía.
+ECONOMY_COOLDOWNS = {
+    'daily': ECONOMY_COOLDOWN_DAILY_HOURS * 3600,
+    'work': ECONOMY_COOLDOWN_WORK_HOURS * 3600,
+    'rob': ECONOMY_COOLDOWN_ROB_HOURS * 3600,
+}
+COOLDOWN_CACHE_MAX_SIZE = 50000
+LEDGER_COMPACTION_INTERVAL_HOURS = 24
+LEDGER_RETENTION_DAYS = 30
+TRANSACTIONS_PAGE_SIZE = 10
+SHOP_PAGE_SIZE = 15
+MARRY_PROPOSAL_TIMEOUT_SECONDS = 60
+DIVORCE_CONFIRM_TIMEOUT_SECONDS = 20
 XP_PER_MESSAGE = 15
 XP_COOLDOWN_SECONDS = 60
+XP_FLUSH_INTERVAL_SECONDS = 5
+XP_FLUSH_MAX_PENDING = 200
+XP_CACHE_IDLE_SECONDS = 600
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+# Motor de almacenamiento: 'postgres' (producción) o 'sqlite' (un archivo local, sin servicios externos).
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'postgres').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'nexus.db')
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_STATEMENT_CACHE_SIZE = 256
+
+# Modo clúster (opcional). Con CLUSTER_COUNT > 1 el proceso principal reparte los shards entre
+# CLUSTER_COUNT procesos; cada uno recibe CLUSTER_ID, SHARD_IDS y SHARD_COUNT por variables de entorno.
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', 1))
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', 0))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id] or None
+IS_CLUSTER_WORKER = 'CLUSTER_ID' in os.environ
+CLUSTER_MODE = CLUSTER_COUNT > 1 or SHARD_COUNT is not None
+# Solo el clúster 0 ejecuta las tareas globales (compactación, aviso al dueño).
+IS_PRIMARY_CLUSTER = CLUSTER_ID == 0
+CLUSTER_IDENTIFY_WINDOW_SECONDS = 5.5
+CLUSTER_STATUS_TIMEOUT_SECONDS = 2.0
+HTTP_PORT = int(os.getenv('PORT', 5000))
+HTTP_HOST = os.getenv('HTTP_HOST', '0.0.0.0')
+HEALTH_MAX_LOOP_LAG_SECONDS = float(os.getenv('HEALTH_MAX_LOOP_LAG_SECONDS', 0.5))
+HEALTH_LAG_CHECK_INTERVAL_SECONDS = 1.0
+HEALTH_DB_TIMEOUT_SECONDS = 3.0
+# Límites superiores (en segundos) de los histogramas de latencia de /metrics.
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Histograma con buckets fijos: registrar un valor es una búsqueda binaria y un incremento."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # El último es el bucket +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Contadores e histogramas en memoria, expuestos en formato de texto de Prometheus.
+
+    Todas las escrituras ocurren en el hilo del event loop (salvo las aperturas de conexión, que el pool
+    ya serializa con su propio lock), así que no se necesitan locks. /metrics solo lee.
+    """
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.gauges: dict[str, Callable[[], list[tuple[tuple, float]]]] = {}
+        self.help: dict[str, str] = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def gauge(self, name: str, description: str):
+        """Registra una función que calcula los valores `[(labels, valor)]` de un gauge al leer /metrics."""
+        def decorator(func):
+            self.gauges[name] = func
+            self.help[name] = description
+            return func
+        return decorator
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, series in list(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in list(series.items()):
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for name, series in list(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in list(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        for name, func in list(self.gauges.items()):
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            try:
+                values = func()
+            except Exception as e:
+                print(f"Error al calcular la métrica {name}: {e}")
+                continue
+            for labels, value in values:
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(METRICS_LATENCY_BUCKETS)
+
+
+def timed_event(func):
+    """Registra la duración de un handler de evento en `nexus_event_duration_seconds`."""
+    labels = (('event', func.__name__),)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc('nexus_event_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('nexus_event_duration_seconds', labels, time.perf_counter() - start)
+    return wrapper
+
+
+class NexusCommandTree(discord.app_commands.CommandTree):
+    """Árbol de comandos slash que mide la duración de cada comando (los híbridos se miden en `after_invoke`)."""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras['started'] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: discord.app_commands.AppCommandError):
+        observe_app_command(interaction, interaction.command, failed=True)
+        await super().on_error(interaction, error)
+
+
+def observe_app_command(interaction: discord.Interaction, command, failed: bool = False):
+    started = interaction.extras.get('started')
+    if started is None or command is None or isinstance(command, commands.hybrid.HybridAppCommand):
+        return
+    labels = (('command', command.qualified_name), ('kind', 'slash'))
+    metrics.observe('nexus_command_duration_seconds', labels, time.perf_counter() - started)
+    if failed:
+        metrics.inc('nexus_command_errors_total', labels)
+
+
+class NexusBot(commands.AutoShardedBot if CLUSTER_MODE else commands.Bot):
+    """Bot con ciclo de vida propio: abre el almacenamiento y el servidor de salud al iniciar y los cierra al apagarse."""
+
+    http_runner: Optional[web.AppRunner] = None
+
+    async def setup_hook(self):
+        await storage.open()
+        await guild_configs.load_all()
+        await interactions.load()
+        await scheduler.start()
+        loop_lag.start()
+        self.http_runner = await start_http_server()
+        flush_xp.start()
+        if IS_PRIMARY_CLUSTER:
+            compact_ledger.start()
+
+    async def close(self):
+        await outbound.drain(OUTBOUND_DRAIN_TIMEOUT_SECONDS)
+        await super().close()
+        scheduler.stop()
+        flush_xp.cancel()
+        compact_ledger.cancel()
+        await xp_aggregator.flush()
+        loop_lag.stop()
+        if self.http_runner:
+            await self.http_runner.cleanup()
+        await storage.close()
+
+
+bot = NexusBot(
+    command_prefix=PREFIX,
+    intents=INTENTS,
+    member_cache_flags=MEMBER_CACHE_FLAGS,
+    max_messages=MESSAGE_CACHE_SIZE or None,
+    chunk_guilds_at_startup=CHUNK_GUILDS_AT_STARTUP,
+    tree_cls=NexusCommandTree,
+    **({'shard_count': SHARD_COUNT, 'shard_ids': SHARD_IDS} if CLUSTER_MODE else {})
+)
+bot.help_command = CustomHelpCommand()
+
+# ----------------------------------------------------
+# 3. FUNCIONES DE UTILIDAD PARA EMBEDS
+# ----------------------------------------------------
+
+def create_error_embed(title: str, description: str) -> discord.Embed:
+    """Crea un embed estándar para mensajes de error."""
+    return discord.Embed(
+        title=f"❌ {title}",
+        description=description,
+        color=discord.Color.red()
+    )
+
+def create_success_embed(title: str, description: str) -> discord.Embed:
+    """Crea un embed estándar para mensajes exitosos."""
+    return discord.Embed(
+        title=f"✅ {title}",
+        description=description,
+        color=discord.Color.green()
+    )
+
+class KeysetPaginator(discord.ui.View):
+    """
+    Botones ◀ ▶ para resultados paginados por keyset.
+
+    `fetch(cursor, limit)` obtiene filas a partir de un cursor (None para la primera página),
+    `render(rows, page)` crea el embed de una página y `cursor_of(row)` da el cursor que sigue a una fila.
+    Se guarda el cursor de cada página visitada, así que ninguna página necesita OFFSET.
+    """
+
+    def __init__(self, author_id: int, fetch: Callable, render: Callable, cursor_of: Callable, page_size: int):
+        super().__init__(timeout=120)
+        self.author_id = author_id
+        self.fetch = fetch
+        self.render = render
+        self.cursor_of = cursor_of
+        self.page_size = page_size
+        self.page = 0
+        self.cursors: list = [None]  # Cursor con el que se obtuvo cada página.
+        self.has_next = False
+        self.message: Optional[discord.Message] = None  # Se asigna al enviar, para poder editarlo al expirar.
+
+    async def load(self, page: int) -> Optional[discord.Embed]:
+        """Obtiene y renderiza una página. Retorna None si no hay resultados."""
+        rows = await self.fetch(self.cursors[page], self.page_size + 1)
+        if not rows:
+            return None
+        self.page = page
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.has_next and len(self.cursors) == page + 1:
+            self.cursors.append(self.cursor_of(rows[-1]))
+        self.previous_page.disabled = page == 0
+        self.next_page.disabled = not self.has_next
+        return self.render(rows, page)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message(embed=create_error_embed("Error", "Solo quien usó el comando puede cambiar de página."), ephemeral=True)
+            return False
+        return True
+
+    async def _show(self, interaction: discord.Interaction, page: int):
+        embed = await self.load(page)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    async def on_timeout(self):
+        # Sin esto los botones parecen usables pero fallan con "interacción fallida".
+        for child in self.children:
+            child.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass  # El mensaje ya no existe.
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+class MemberCache:
+    """
+    Respaldo de `guild.get_member` para cuando la caché de discord.py no tiene al miembro
+    (intents o MemberCacheFlags reducidos, o sin chunking al iniciar).
+
+    Los miembros se piden bajo demanda y se guardan en un LRU acotado con expiración. También se
+    recuerda quién ya no está en el servidor, para no volver a pedirlo en cada página.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[tuple[int, int], tuple[float, Optional[discord.Member]]] = OrderedDict()
+
+    def _cached(self, guild_id: int, user_id: int):
+        """Retorna el miembro (o None si se sabe que no está) o `...` si no hay entrada válida."""
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return ...
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return ...
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, guild_id: int, user_id: int, member: Optional[discord.Member]):
+        self.entries[(guild_id, user_id)] = (time.monotonic() + self.ttl, member)
+        self.entries.move_to_end((guild_id, user_id))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get(self, guild: discord.Guild, user_id: int, refresh: bool = False) -> Optional[discord.Member]:
+        """Obtiene un miembro desde la caché de discord.py, el LRU o la API. `refresh` ignora el LRU."""
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+        if not refresh:
+            cached = self._cached(guild.id, user_id)
+            if cached is not ...:
+                return cached
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            member = None
+        except discord.HTTPException:
+            return None  # Error transitorio: no se guarda.
+        self._store(guild.id, user_id, member)
+        return member
+
+    async def resolve(self, guild: discord.Guild, user_ids: list[int]) -> dict[int, Optional[discord.Member]]:
+        """Obtiene varios miembros; los que faltan se piden en una sola consulta al gateway si hay intent de miembros."""
+        result, missing = {}, []
+        for user_id in user_ids:
+            member = guild.get_member(user_id)
+            if member is None:
+                member = self._cached(guild.id, user_id)
+            if member is ...:
+                missing.append(user_id)
+            else:
+                result[user_id] = member
+        if not missing:
+            return result
+        if bot.intents.members:
+            try:
+                found = {member.id: member for member in await guild.query_members(user_ids=missing[:100], cache=False)}
+            except (asyncio.TimeoutError, discord.ClientException):
+                found = None
+            if found is not None:
+                for user_id in missing[:100]:
+                    result[user_id] = found.get(user_id)
+                    self._store(guild.id, user_id, result[user_id])
+                missing = missing[100:]
+        members = await asyncio.gather(*(self.get(guild, user_id) for user_id in missing))
+        result.update(zip(missing, members))
+        return result
+
+    async def display_name(self, guild: discord.Guild, user_id: int, fallback: str = "ID: {}") -> str:
+        member = await self.get(guild, user_id)
+        return member.display_name if member else fallback.format(user_id)
+
+    async def display_names(self, guild: discord.Guild, user_ids: list[int], fallback: str = "ID: {}") -> dict[int, str]:
+        members = await self.resolve(guild, user_ids)
+        return {user_id: member.display_name if member else fallback.format(user_id) for user_id, member in members.items()}
+
+    def forget(self, guild_id: int, user_id: int):
+        self.entries.pop((guild_id, user_id), None)
+
+    def invalidate_guild(self, guild_id: int):
+        for key in [key for key in self.entries if key[0] == guild_id]:
+            del self.entries[key]
+
+
+member_cache = MemberCache(MEMBER_FALLBACK_CACHE_SIZE, MEMBER_FALLBACK_CACHE_TTL_SECONDS)
+
+
+class ChannelOutbox:
+    """Mensajes pendientes de un canal: embeds en orden y líneas de texto agrupables por clave."""
+
+    def __init__(self):
+        self.embeds: deque[discord.Embed] = deque()
+        self.lines: dict = {}
+        self.task: Optional[asyncio.Task] = None
+
+
+class OutboundQueue:
+    """
+    Cola de salida por canal que se envía en segundo plano.
+
+    Los handlers solo encolan y siguen; cada canal tiene como mucho una tarea que espera una ventana corta,
+    junta hasta 10 embeds por mensaje (o el texto de varios anuncios) y los envía, opcionalmente a través de
+    un webhook del canal. Así una purga o un raid no se convierten en cientos de envíos individuales.
+    """
+
+    MAX_EMBEDS = 10
+    MAX_EMBED_CHARS = 6000
+    MAX_CONTENT_CHARS = 2000
+
+    def __init__(self, window: float, max_pending: int, use_webhooks: bool):
+        self.window = window
+        self.max_pending = max_pending
+        self.use_webhooks = use_webhooks
+        self.outboxes: dict[int, ChannelOutbox] = {}
+        self.webhooks: dict[int, discord.Webhook] = {}
+        self.webhook_retry_at: dict[int, float] = {}
+
+    def _outbox(self, channel: discord.abc.Messageable) -> ChannelOutbox:
+        outbox = self.outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self.outboxes[channel.id] = ChannelOutbox()
+        if outbox.task is None or outbox.task.done():
+            outbox.task = asyncio.create_task(self._drain(channel, outbox))
+        return outbox
+
+    def send_embed(self, channel: discord.abc.Messageable, embed: discord.Embed):
+        """Encola un embed (p. ej. un log de moderación)."""
+        outbox = self._outbox(channel)
+        if len(outbox.embeds) >= self.max_pending:
+            outbox.embeds.popleft()
+            metrics.inc('nexus_outbound_dropped_total')
+        outbox.embeds.append(embed)
+
+    def announce(self, channel: discord.abc.Messageable, key, text: str):
+        """Encola una línea de texto; si ya hay una pendiente con la misma clave, la reemplaza."""
+        outbox = self._outbox(channel)
+        outbox.lines.pop(key, None)
+        if len(outbox.lines) >= self.max_pending:
+            outbox.lines.pop(next(iter(outbox.lines)))
+            metrics.inc('nexus_outbound_dropped_total')
+        outbox.lines[key] = text
+
+    def pending(self) -> int:
+        return sum(len(outbox.embeds) + len(outbox.lines) for outbox in self.outboxes.values())
+
+    def _take_lines(self, outbox: ChannelOutbox) -> str:
+        taken, size = [], 0
+        for key, line in list(outbox.lines.items()):
+            if taken and size + len(line) + 1 > self.MAX_CONTENT_CHARS:
+                break
+            taken.append(line[:self.MAX_CONTENT_CHARS])
+            size += len(line) + 1
+            del outbox.lines[key]
+        return "\n".join(taken)
+
+    def _take_embeds(self, outbox: ChannelOutbox) -> list[discord.Embed]:
+        taken, size = [], 0
+        while outbox.embeds and len(taken) < self.MAX_EMBEDS:
+            length = len(outbox.embeds[0])
+            if taken and size + length > self.MAX_EMBED_CHARS:
+                break
+            taken.append(outbox.embeds.popleft())
+            size += length
+        return taken
+
+    async def _webhook(self, channel: discord.abc.Messageable) -> Optional[discord.Webhook]:
+        if channel.id in self.webhooks:
+            return self.webhooks[channel.id]
+        if self.webhook_retry_at.get(channel.id, 0) > time.monotonic():
+            return None
+        try:
+            webhook = next((wh for wh in await channel.webhooks() if wh.user and wh.user.id == bot.user.id), None)
+            if webhook is None:
+                webhook = await channel.create_webhook(name=OUTBOUND_WEBHOOK_NAME, reason="Envío agrupado de logs.")
+        except (AttributeError, discord.HTTPException):
+            # Sin permiso de webhooks (o no es un canal de texto): se usa el canal y se reintenta más tarde,
+            # por si le dan el permiso o el fallo era pasajero.
+            self.webhook_retry_at[channel.id] = time.monotonic() + OUTBOUND_WEBHOOK_RETRY_SECONDS
+            return None
+        self.webhook_retry_at.pop(channel.id, None)
+        self.webhooks[channel.id] = webhook
+        return webhook
+
+    async def _send_embeds(self, channel: discord.abc.Messageable, embeds: list[discord.Embed]):
+        webhook = await self._webhook(channel) if self.use_webhooks else None
+        if webhook is not None:
+            try:
+                await webhook.send(embeds=embeds, username=bot.user.display_name, avatar_url=bot.user.display_avatar.url)
+                return
+            except discord.NotFound:
+                self.webhooks.pop(channel.id, None)  # Alguien borró el webhook; se vuelve a buscar la próxima vez.
+        await channel.send(embeds=embeds)
+
+    async def _drain(self, channel: discord.abc.Messageable, outbox: ChannelOutbox):
+        await asyncio.sleep(self.window)
+        while outbox.embeds or outbox.lines:
+            try:
+                if outbox.lines:
+                    await channel.send(self._take_lines(outbox))
+                if outbox.embeds:
+                    await self._send_embeds(channel, self._take_embeds(outbox))
+                metrics.inc('nexus_outbound_messages_total')
+            except discord.HTTPException as e:
+                metrics.inc('nexus_errors_total', (('where', 'outbound_send'),))
+                print(f"Error al enviar mensajes agrupados al canal {channel.id}: {e}")
+        # No hay await desde la última comprobación, así que nadie pudo encolar entre medias.
+        if self.outboxes.get(channel.id) is outbox:
+            del self.outboxes[channel.id]
+
+    async def drain(self, timeout: float):
+        """Espera a que se envíe lo pendiente (al apagar el bot)."""
+        tasks = [outbox.task for outbox in self.outboxes.values() if outbox.task and not outbox.task.done()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+
+outbound = OutboundQueue(OUTBOUND_COALESCE_SECONDS, OUTBOUND_MAX_PENDING_PER_CHANNEL, OUTBOUND_USE_WEBHOOKS)
+
+
+def parse_duration(duration: str) -> Optional[timedelta]:
+    """Convierte una duración como '1d', '2h' o '30m' en un timedelta. Retorna None si el formato es inválido."""
+    try:
+        if 'd' in duration:
+            return timedelta(days=int(duration.replace('d', '')))
+        elif 'h' in duration:
+            return timedelta(hours=int(duration.replace('h', '')))
+        elif 'm' in duration:
+            return timedelta(minutes=int(duration.replace('m', '')))
+    except ValueError:
+        pass
+    return None
+
+MUTE_OVERWRITE_CHANNEL_TYPES = (discord.TextChannel, discord.VoiceChannel, discord.StageChannel, discord.ForumChannel, discord.CategoryChannel)
+
+async def apply_mute_overwrites(guild: discord.Guild, role: discord.Role) -> int:
+    """
+    Aplica los permisos del rol de silencio en todos los canales, con como mucho
+    MUTE_OVERWRITE_CONCURRENCY peticiones a la vez (discord.py espera solo ante un 429).
+    Se saltan los canales que ya los tienen. Retorna en cuántos canales falló.
+    """
+    semaphore = asyncio.Semaphore(MUTE_OVERWRITE_CONCURRENCY)
+    failed = 0
+
+    async def apply(channel):
+        nonlocal failed
+        overwrite = channel.overwrites_for(role)
+        if overwrite.send_messages is False and overwrite.speak is False:
+            return
+        async with semaphore:
+            try:
+                await channel.set_permissions(role, send_messages=False, speak=False, reason="Configuración del rol de silencio.")
+            except discord.HTTPException:
+                failed += 1
+
+    await asyncio.gather(*(apply(channel) for channel in guild.channels if isinstance(channel, MUTE_OVERWRITE_CHANNEL_TYPES)))
+    if failed:
+        print(f"Advertencia: No se pudieron establecer permisos del rol de silencio en {failed} canales de {guild.name}.")
+    return failed
+
+async def get_mute_role(guild: discord.Guild, create: bool = False) -> Optional[discord.Role]:
+    """
+    Obtiene el rol de silencio usando la ID guardada en la configuración del servidor.
+    Si no existe y `create` es True, lo crea y configura sus permisos (hay que haber diferido la interacción antes).
+    """
+    config = await get_config(guild)
+    role = guild.get_role(config.get('mute_role_id') or 0) or discord.utils.get(guild.roles, name=MUTE_ROLE_NAME)
+    if role is None and create:
+        role = await guild.create_role(name=MUTE_ROLE_NAME, permissions=discord.Permissions.none(), reason="Rol de silencio.")
+        await apply_mute_overwrites(guild, role)
+    if role is not None and role.id != config.get('mute_role_id'):
+        await update_config(guild.id, mute_role_id=role.id)
+    return role
+
+
+# ----------------------------------------------------
+# 4. FUNCIONES DE UTILIDAD DE BASE DE DATOS (DB)
+# ----------------------------------------------------
+
+db_pool: Optional[pg_pool.ThreadedConnectionPool] = None
+db_semaphore: Optional[asyncio.Semaphore] = None
+
+
+class InstrumentedConnectionPool(pg_pool.ThreadedConnectionPool):
+    """Pool que cuenta las conexiones nuevas que abre (llamado con el lock del pool tomado)."""
+
+    def _connect(self, key=None):
+        metrics.inc('nexus_db_connections_opened_total')
+        return super()._connect(key)
+
+
+def open_db_pool():
+    """Abre el pool persistente de conexiones a PostgreSQL (una sola vez al iniciar)."""
+    global db_pool, db_semaphore
+    if db_pool is None:
+        db_pool = InstrumentedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DATABASE_URL, sslmode=DB_SSLMODE)
+        # El semáforo limita las consultas concurrentes al tamaño del pool para no agotarlo.
+        db_semaphore = asyncio.Semaphore(DB_POOL_MAX_SIZE)
+
+def close_db_pool():
+    """Cierra todas las conexiones del pool."""
+    global db_pool
+    if db_pool is not None:
+        db_pool.closeall()
+        db_pool = None
+
+@contextmanager
+def get_db_connection():
+    """Toma prestada una conexión del pool y la devuelve al terminar."""
+    conn = db_pool.getconn()
+    try:
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn, close=bool(conn.closed))
+
+def _run_transaction(func, *args):
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            result = func(cursor, *args)
+            conn.commit()
+            return result
+
+async def db_transaction(func, *args, helper: Optional[str] = None):
+    """
+    Ejecuta `func(cursor, *args)` en una transacción dentro de un hilo, sin bloquear el event loop.
+
+    La duración se registra en /metrics bajo `helper` (por defecto, el nombre de `func`).
+    """
+    labels = (('helper', helper or func.__qualname__),)
+    async with db_semaphore:
+        start = time.perf_counter()
+        try:
+            return await asyncio.to_thread(_run_transaction, func, *args)
+        except Exception:
+            metrics.inc('nexus_db_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('nexus_db_query_duration_seconds', labels, time.perf_counter() - start)
+
+def _caller_name() -> str:
+    """
+    Nombre de la función que llamó a db_execute/db_fetchone/db_fetchall, para etiquetar las métricas.
+
+    Se usa `co_name` y no `co_qualname`, que solo existe desde Python 3.11.
+    """
+    return sys._getframe(2).f_code.co_name
+
+async def db_execute(query: str, params: Union[tuple, dict] = ()) -> int:
+    """Ejecuta una sentencia y retorna el número de filas afectadas."""
+    def run(cursor):
+        cursor.execute(query, params)
+        return cursor.rowcount
+    return await db_transaction(run, helper=_caller_name())
+
+async def db_fetchone(query: str, params: Union[tuple, dict] = ()) -> Optional[tuple]:
+    """Ejecuta una consulta y retorna la primera fila."""
+    def run(cursor):
+        cursor.execute(query, params)
+        return cursor.fetchone()
+    return await db_transaction(run, helper=_caller_name())
+
+async def db_fetchall(query: str, params: Union[tuple, dict] = ()) -> list[tuple]:
+    """Ejecuta una consulta y retorna todas las filas."""
+    def run(cursor):
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    return await db_transaction(run, helper=_caller_name())
+
+# ----------------------------------------------------
+# MIGRACIONES DE ESQUEMA
+# ----------------------------------------------------
+
+def _migration_001_baseline(cursor):
+    """Esquema base. Es idempotente para poder aplicarse sobre bases creadas antes de versionar el esquema."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS config (
+            guild_id BIGINT PRIMARY KEY,
+            log_channel_id BIGINT,
+            report_channel_id BIGINT,
+            report_role_id BIGINT,
+            autorole_id BIGINT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_actions (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            action TEXT NOT NULL,
+            run_at DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (guild_id, user_id, action)
+        )
+    """)
+    # Migración: los muteos temporales pendientes pasan a `scheduled_actions`.
+    cursor.execute("""
+        DO $$
+        BEGIN
+            IF to_regclass('temp_mutes') IS NOT NULL THEN
+                INSERT INTO scheduled_actions (guild_id, user_id, action, run_at)
+                SELECT guild_id, user_id, 'unmute', unmute_time FROM temp_mutes
+                ON CONFLICT (guild_id, user_id, action) DO NOTHING;
+                DROP TABLE temp_mutes;
+            END IF;
+        END
+        $$
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS warnings (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            guild_id BIGINT,
+            moderator_id BIGINT,
+            reason TEXT,
+            timestamp TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS economy (
+            user_id BIGINT,
+            guild_id BIGINT,
+            balance INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, guild_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS economy_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            delta BIGINT NOT NULL,
+            reason TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS economy_ledger_user_idx ON economy_ledger (guild_id, user_id, id DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS economy_ledger_created_idx ON economy_ledger (created_at)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS economy_snapshots (
+            guild_id BIGINT,
+            user_id BIGINT,
+            balance BIGINT NOT NULL,
+            compacted_delta BIGINT NOT NULL DEFAULT 0,
+            compacted_entries BIGINT NOT NULL DEFAULT 0,
+            last_ledger_id BIGINT NOT NULL,
+            taken_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cooldowns (
+            user_id BIGINT,
+            guild_id BIGINT,
+            action TEXT,
+            last_time DOUBLE PRECISION,
+            PRIMARY KEY (user_id, guild_id, action)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS leveling (
+            user_id BIGINT,
+            guild_id BIGINT,
+            total_xp BIGINT NOT NULL DEFAULT 0,
+            level INTEGER DEFAULT 0,
+            last_message_time DOUBLE PRECISION DEFAULT 0,
+            PRIMARY KEY (user_id, guild_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS role_shop (
+            guild_id BIGINT,
+            role_id BIGINT,
+            price INTEGER,
+            PRIMARY KEY (guild_id, role_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS marriages (
+            user1_id BIGINT,
+            user2_id BIGINT,
+            guild_id BIGINT,
+            marriage_date TEXT,
+            PRIMARY KEY (user1_id, user2_id, guild_id)
+        )
+    """)
+    # La clave primaria sirve las búsquedas por user1_id; este índice cubre user2_id y la carga por servidor.
+    cursor.execute("CREATE INDEX IF NOT EXISTS marriages_guild_user2_idx ON marriages (guild_id, user2_id)")
+    # Curva de niveles en el servidor: alcanzar el nivel L requiere 25*L^2 + 75*L de XP acumulado
+    # (la suma de get_xp_needed(0..L-1)), por lo que el nivel se obtiene en forma cerrada.
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION nexus_xp_for_level(lvl INTEGER) RETURNS BIGINT AS $$
+            SELECT 25 * lvl::BIGINT * lvl + 75 * lvl
+        $$ LANGUAGE SQL IMMUTABLE
+    """)
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION nexus_level_for_xp(total BIGINT) RETURNS INTEGER AS $$
+            SELECT floor((sqrt(5625 + 100 * total::NUMERIC) - 75) / 50)::INTEGER
+        $$ LANGUAGE SQL IMMUTABLE
+    """)
+    # Migración: `leveling` guardaba solo el XP restante del nivel actual; ahora guarda el XP total
+    # acumulado (monótono) y el nivel se deriva de él.
+    cursor.execute("""
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'leveling' AND column_name = 'xp') THEN
+                ALTER TABLE leveling ADD COLUMN IF NOT EXISTS total_xp BIGINT;
+                UPDATE leveling SET total_xp = nexus_xp_for_level(level) + xp;
+                ALTER TABLE leveling ALTER COLUMN total_xp SET DEFAULT 0, ALTER COLUMN total_xp SET NOT NULL;
+                ALTER TABLE leveling DROP COLUMN xp;
+            END IF;
+        END
+        $$
+    """)
+    # Índices de las tablas de clasificación: cubren el ORDER BY y la paginación por keyset.
+    cursor.execute("DROP INDEX IF EXISTS leveling_guild_total_xp_idx")
+    cursor.execute("CREATE INDEX IF NOT EXISTS leveling_rank_idx ON leveling (guild_id, total_xp DESC, user_id DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS economy_rank_idx ON economy (guild_id, balance DESC, user_id DESC)")
+
+def _alter_column_type(cursor, table: str, column: str, new_type: str, using: str):
+    """Cambia el tipo de una columna solo si todavía no lo tiene."""
+    cursor.execute(
+        """
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+        """,
+        (table, column)
+    )
+    current = cursor.fetchone()
+    if current and current[0] != new_type:
+        cursor.execute(f'ALTER TABLE {table} ALTER COLUMN "{column}" TYPE {new_type} USING {using}')
+
+def _migration_002_types_and_indexes(cursor):
+    """Fechas como TIMESTAMPTZ, saldos de 64 bits e índices secundarios de advertencias."""
+    # Las fechas se guardaban con datetime.now().isoformat() en la hora del servidor (UTC en Render).
+    _alter_column_type(cursor, 'warnings', 'timestamp', 'timestamp with time zone',
+                       "NULLIF(\"timestamp\", '')::timestamp AT TIME ZONE 'UTC'")
+    cursor.execute('ALTER TABLE warnings ALTER COLUMN "timestamp" SET DEFAULT now()')
+    _alter_column_type(cursor, 'marriages', 'marriage_date', 'timestamp with time zone',
+                       "NULLIF(marriage_date, '')::timestamp AT TIME ZONE 'UTC'")
+    _alter_column_type(cursor, 'economy', 'balance', 'bigint', 'balance::BIGINT')
+    _alter_column_type(cursor, 'role_shop', 'price', 'bigint', 'price::BIGINT')
+    # Advertencias de un usuario, de la más reciente a la más antigua.
+    cursor.execute("CREATE INDEX IF NOT EXISTS warnings_user_idx ON warnings (guild_id, user_id, id DESC)")
+
+def _migration_003_mute_mode(cursor):
+    """Modo de silencio ('timeout' o 'role') y la ID del rol de silencio, por servidor."""
+    cursor.execute("ALTER TABLE config ADD COLUMN IF NOT EXISTS mute_mode TEXT")
+    cursor.execute("ALTER TABLE config ADD COLUMN IF NOT EXISTS mute_role_id BIGINT")
+
+def _migration_004_pending_interactions(cursor):
+    """Propuestas y confirmaciones con botones que esperan respuesta (sobreviven a un reinicio)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pending_interactions (
+            message_id BIGINT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            guild_id BIGINT NOT NULL,
+            channel_id BIGINT NOT NULL,
+            author_id BIGINT NOT NULL,
+            target_id BIGINT NOT NULL,
+            responder_id BIGINT NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL
+        )
+    """)
+
+def _migration_005_drop_grant_xp(cursor):
+    """El XP se otorga en lote desde el agregador; `nexus_grant_xp` ya no tiene llamadores."""
+    cursor.execute("DROP FUNCTION IF EXISTS nexus_grant_xp(BIGINT, BIGINT, INTEGER, DOUBLE PRECISION)")
+
+
+# (versión, descripción, función). Cada migración se aplica una sola vez, en su propia transacción.
+MIGRATIONS: list[tuple[int, str, Callable]] = [
+    (1, "Esquema base", _migration_001_baseline),
+    (2, "Tipos de fecha y saldo, índices de advertencias", _migration_002_types_and_indexes),
+    (3, "Modo de silencio por servidor", _migration_003_mute_mode),
+    (4, "Interacciones pendientes con botones persistentes", _migration_004_pending_interactions),
+    (5, "Eliminar la función nexus_grant_xp sin uso", _migration_005_drop_grant_xp),
+]
+# Clave del advisory lock que serializa a varios procesos migrando a la vez (modo clúster, despliegues).
+MIGRATIONS_LOCK_ID = 7_466_245_118
+
+def run_migrations() -> int:
+    """
+    Aplica las migraciones pendientes antes de conectar el bot. Retorna cuántas se aplicaron.
+
+    Usa una conexión propia (el pool todavía no existe) y no se vuelve a ejecutar en reconexiones.
+    """
+    conn = psycopg2.connect(DATABASE_URL, sslmode=DB_SSLMODE)
+    applied = 0
+    try:
+        for version, description, migrate in MIGRATIONS:
+            with conn, conn.cursor() as cursor:  # `with conn` hace COMMIT o ROLLBACK de la transacción.
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                """)
+                cursor.execute("SELECT 1 FROM schema_version WHERE version = %s", (version,))
+                if cursor.fetchone():
+                    continue
+                migrate(cursor)
+                cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                applied += 1
+                print(f"Migración {version} aplicada: {description}")
+    finally:
+        conn.close()
+    return applied
+
+
+# ----------------------------------------------------
+# ALMACENAMIENTO (POSTGRESQL O SQLITE)
+# ----------------------------------------------------
+
+CONFIG_FIELDS = ('log_channel_id', 'report_channel_id', 'report_role_id', 'autorole_id', 'mute_mode', 'mute_role_id')
+
+class Storage(ABC):
+    """
+    Operaciones de datos del bot, independientes del motor.
+
+    Las cachés, los handlers y las tareas solo llaman a estos métodos y cada implementación escribe su propio SQL.
+    `PostgresStorage` es el motor de producción; `SQLiteStorage` usa un archivo local para instalaciones pequeñas,
+    pruebas y benchmarks sin servicios externos. Se elige con `STORAGE_BACKEND`.
+    """
+
+    @abstractmethod
+    async def open(self):
+        """Abre las conexiones (en `setup_hook`)."""
+
+    @abstractmethod
+    async def close(self):
+        """Cierra las conexiones (al apagar el bot, después de vaciar las escrituras diferidas)."""
+
+    @abstractmethod
+    def migrate(self) -> int:
+        """Crea o actualiza el esquema antes de conectar el bot (síncrono). Retorna cuántas migraciones aplicó."""
+
+    @abstractmethod
+    async def ping(self) -> bool:
+        """Comprueba que el motor responda a una consulta."""
+
+    # --- Configuración ---
+
+    @abstractmethod
+    async def load_configs(self) -> list[tuple]:
+        """Retorna (guild_id, *CONFIG_FIELDS) de todos los servidores."""
+
+    @abstractmethod
+    async def get_config(self, guild_id: int) -> Optional[tuple]:
+        """Retorna los CONFIG_FIELDS de un servidor, o None si no tiene configuración."""
+
+    @abstractmethod
+    async def update_config(self, guild_id: int, fields: dict) -> tuple:
+        """Guarda campos de configuración y retorna la fila completa de CONFIG_FIELDS."""
+
+    # --- Economía ---
+
+    @abstractmethod
+    async def get_balance(self, user_id: int, guild_id: int) -> int:
+        """Retorna el saldo de un usuario, creando su fila con 0 si no existe."""
+
+    @abstractmethod
+    async def add_balance(self, user_id: int, guild_id: int, amount: int, reason: str, required: int = 0) -> Optional[int]:
+        """Suma `amount` al saldo y lo anota en el libro de forma atómica; con `required` positivo, solo si el saldo lo alcanza. Retorna el nuevo saldo o None."""
+
+    @abstractmethod
+    async def transfer_balance(self, guild_id: int, from_user_id: int, to_user_id: int, amount: int, reason: str) -> Optional[tuple[int, int]]:
+        """Mueve dinero y anota ambos movimientos de forma atómica si el origen tiene suficiente. Retorna (saldo del origen, saldo del destino) o None."""
+
+    @abstractmethod
+    async def set_balance(self, user_id: int, guild_id: int, amount: int, reason: str) -> tuple[int, int]:
+        """Establece el saldo y anota la diferencia en el libro. Retorna (saldo nuevo, saldo anterior)."""
+
+    @abstractmethod
+    async def claim_cooldown(self, user_id: int, guild_id: int, action: str, now: float, cooldown: float, reward: int) -> tuple[Optional[float], Optional[int], Optional[float]]:
+        """
+        Reclama el cooldown de una acción, paga `reward` y lo anota en el libro (con la acción como motivo) de forma atómica.
+
+        Retorna (hora reclamada, nuevo saldo, hora del último reclamo); las dos primeras son None si seguía en cooldown.
+        """
+
+    @abstractmethod
+    async def compact_ledger(self, cutoff: datetime):
+        """
+        Mueve los movimientos anteriores a `cutoff` a `economy_snapshots` y los borra del libro.
+
+        El saldo del snapshot es `economy.balance` menos los movimientos que quedan en el libro; como cada
+        movimiento se escribe en la misma transacción que su cambio de saldo, ambos se leen consistentes.
+        """
+
+    @abstractmethod
+    async def get_ledger_page(self, guild_id: int, user_id: int, before_id: Optional[int], limit: int) -> list[tuple[int, int, str, datetime]]:
+        """Obtiene (id, delta, reason, created_at) del más reciente al más antiguo, paginado por keyset sobre id."""
+
+    @abstractmethod
+    async def get_ledger_snapshot(self, guild_id: int, user_id: int) -> Optional[tuple[int, int, int, datetime]]:
+        """Obtiene (balance, compacted_delta, compacted_entries, taken_at) del historial compactado."""
+
+    @abstractmethod
+    async def get_leaderboard_page(self, guild_id: int, mode: str, after: Optional[tuple[int, int]], limit: int) -> list[tuple[int, int]]:
+        """
+        Obtiene una página de (user_id, puntuación) ordenada de mayor a menor.
+
+        La paginación es por keyset: `after` es la (puntuación, user_id) de la última fila de la página anterior,
+        así que cualquier página cuesta lo mismo que la primera.
+        """
+
+    # --- Niveles ---
+
+    @abstractmethod
+    async def get_level(self, user_id: int, guild_id: int) -> Optional[tuple[int, float]]:
+        """Retorna (total_xp, last_message_time) de un usuario, o None si no tiene fila."""
+
+    @abstractmethod
+    async def grant_xp_batch(self, rows: list[dict]):
+        """Suma en lote el XP de filas {user_id, guild_id, xp, last_message_time} y recalcula el nivel."""
+
+    @abstractmethod
+    async def bulk_update_xp(self, guild_id: int, user_ids: list[int], amount: int, replace: bool = False) -> int:
+        """Suma (o establece, si `replace`) el XP total de varios usuarios. Retorna las filas afectadas."""
+
+    # --- Advertencias ---
+
+    @abstractmethod
+    async def add_warning(self, guild_id: int, user_id: int, moderator_id: int, reason: str, timestamp: datetime):
+        ...
+
+    @abstractmethod
+    async def count_warnings(self, guild_id: int, user_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def get_warnings_page(self, guild_id: int, user_id: int, before_id: Optional[int], limit: int) -> list[tuple[int, int, str, datetime]]:
+        """Obtiene (id, moderator_id, reason, timestamp) de la más reciente a la más antigua, por keyset sobre id."""
+
+    @abstractmethod
+    async def delete_warnings(self, guild_id: int, user_id: int, before: Optional[datetime] = None, from_id: Optional[int] = None, to_id: Optional[int] = None) -> int:
+        """Borra las advertencias de un usuario, opcionalmente solo las anteriores a `before` o con ID en [from_id, to_id]. Retorna cuántas borró."""
+
+    # --- Acciones programadas ---
+
+    @abstractmethod
+    async def load_scheduled_actions(self, shard_ids: Optional[list[int]] = None) -> list[tuple[int, int, str, float]]:
+        """Retorna (guild_id, user_id, action, run_at) pendientes; con `shard_ids`, solo de los servidores de esos shards."""
+
+    @abstractmethod
+    async def schedule_action(self, guild_id: int, user_id: int, action: str, run_at: float):
+        """Programa (o reprograma) una acción."""
+
+    @abstractmethod
+    async def cancel_action(self, guild_id: int, user_id: int, action: str):
+        ...
+
+    @abstractmethod
+    async def finish_action(self, guild_id: int, user_id: int, action: str, run_at: float):
+        """Borra una acción ejecutada, salvo que se haya reprogramado a otra hora mientras tanto."""
+
+    # --- Interacciones pendientes ---
+
+    @abstractmethod
+    async def load_pending_interactions(self, shard_ids: Optional[list[int]] = None) -> list[tuple]:
+        """Retorna las filas de `pending_interactions`; con `shard_ids`, solo de los servidores de esos shards."""
+
+    @abstractmethod
+    async def add_pending_interaction(self, message_id: int, kind: str, guild_id: int, channel_id: int, author_id: int, target_id: int, responder_id: int, expires_at: float):
+        ...
+
+    @abstractmethod
+    async def delete_pending_interaction(self, message_id: int):
+        ...
+
+    # --- Tienda de roles ---
+
+    @abstractmethod
+    async def get_shop_roles(self, guild_id: int) -> list[tuple[int, int]]:
+        """Obtiene (role_id, price) de todos los roles a la venta en el servidor."""
+
+    @abstractmethod
+    async def set_shop_role(self, guild_id: int, role_id: int, price: int):
+        """Pone un rol a la venta o actualiza su precio."""
+
+    @abstractmethod
+    async def remove_shop_roles(self, guild_id: int, role_ids: list[int]) -> int:
+        """Quita roles de la tienda. Retorna cuántos estaban a la venta."""
+
+    # --- Matrimonios ---
+
+    @abstractmethod
+    async def get_marriages(self, guild_id: int) -> list[tuple[int, int, datetime]]:
+        """Obtiene (user1_id, user2_id, marriage_date) de todos los matrimonios del servidor."""
+
+    @abstractmethod
+    async def add_marriage(self, guild_id: int, user1_id: int, user2_id: int, marriage_date: datetime):
+        """Registra un matrimonio; `user1_id` debe ser el menor de los dos."""
+
+    @abstractmethod
+    async def delete_marriage(self, guild_id: int, user1_id: int, user2_id: int):
+        ...
+
+
+class PostgresStorage(Storage):
+    """Almacenamiento en PostgreSQL mediante el pool de psycopg2 (el motor de producción)."""
+
+    async def open(self):
+        await asyncio.to_thread(open_db_pool)
+
+    async def close(self):
+        close_db_pool()
+
+    def migrate(self) -> int:
+        return run_migrations()
+
+    async def ping(self) -> bool:
+        if db_pool is None or db_pool.closed:
+            return False
+        await db_fetchone("SELECT 1")
+        return True
+
+    async def load_configs(self) -> list[tuple]:
+        return await db_fetchall(f"SELECT guild_id, {', '.join(CONFIG_FIELDS)} FROM config")
+
+    async def get_config(self, guild_id: int) -> Optional[tuple]:
+        return await db_fetchone(f"SELECT {', '.join(CONFIG_FIELDS)} FROM config WHERE guild_id = %s", (guild_id,))
+
+    async def update_config(self, guild_id: int, fields: dict) -> tuple:
+        columns = list(fields)
+        return await db_fetchone(
+            f"""
+            INSERT INTO config (guild_id, {', '.join(columns)}) VALUES (%s, {', '.join(['%s'] * len(columns))})
+            ON CONFLICT (guild_id) DO UPDATE SET {', '.join(f'{c} = EXCLUDED.{c}' for c in columns)}
+            RETURNING {', '.join(CONFIG_FIELDS)}
+            """,
+            (guild_id, *fields.values())
+        )
+
+    async def get_balance(self, user_id: int, guild_id: int) -> int:
+        def query(cursor):
+            cursor.execute(
+                "INSERT INTO economy (user_id, guild_id, balance) VALUES (%s, %s, 0) ON CONFLICT (user_id, guild_id) DO NOTHING",
+                (user_id, guild_id)
+            )
+            cursor.execute("SELECT balance FROM economy WHERE user_id = %s AND guild_id = %s", (user_id, guild_id))
+            result = cursor.fetchone()
+            return result[0] if result else 0
+        return await db_transaction(query)
+
+    async def add_balance(self, user_id: int, guild_id: int, amount: int, reason: str, required: int = 0) -> Optional[int]:
+        # El movimiento se anota en la misma sentencia (y transacción) que el cambio de saldo.
+        if required > 0:
+            update = """
+                UPDATE economy SET balance = balance + %(amount)s
+                WHERE user_id = %(user_id)s AND guild_id = %(guild_id)s AND balance >= %(required)s
+                RETURNING balance
+            """
+        else:
+            update = """
+                INSERT INTO economy (user_id, guild_id, balance) VALUES (%(user_id)s, %(guild_id)s, %(amount)s)
+                ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = economy.balance + EXCLUDED.balance
+                RETURNING balance
+            """
+        result = await db_fetchone(
+            f"""
+            WITH updated AS ({update}), logged AS (
+                INSERT INTO economy_ledger (guild_id, user_id, delta, reason)
+                SELECT %(guild_id)s, %(user_id)s, %(amount)s, %(reason)s FROM updated
+            )
+            SELECT balance FROM updated
+            """,
+            {'user_id': user_id, 'guild_id': guild_id, 'amount': amount, 'reason': reason, 'required': required}
+        )
+        return result[0] if result else None
+
+    async def transfer_balance(self, guild_id: int, from_user_id: int, to_user_id: int, amount: int, reason: str) -> Optional[tuple[int, int]]:
+        result = await db_fetchone(
+            """
+            WITH debit AS (
+                UPDATE economy SET balance = balance - %(amount)s
+                WHERE user_id = %(from_user_id)s AND guild_id = %(guild_id)s AND balance >= %(amount)s
+                RETURNING balance
+            ), credit AS (
+                INSERT INTO economy (user_id, guild_id, balance) SELECT %(to_user_id)s, %(guild_id)s, %(amount)s FROM debit
+                ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = economy.balance + EXCLUDED.balance
+                RETURNING balance
+            ), logged AS (
+                INSERT INTO economy_ledger (guild_id, user_id, delta, reason)
+                SELECT %(guild_id)s, %(from_user_id)s, %(debit)s, %(reason)s FROM debit
+                UNION ALL
+                SELECT %(guild_id)s, %(to_user_id)s, %(amount)s, %(reason)s FROM debit
+            )
+            SELECT (SELECT balance FROM debit), (SELECT balance FROM credit)
+            """,
+            {'guild_id': guild_id, 'from_user_id': from_user_id, 'to_user_id': to_user_id, 'amount': amount, 'debit': -amount, 'reason': reason}
+        )
+        return None if result[0] is None else result
+
+    async def set_balance(self, user_id: int, guild_id: int, amount: int, reason: str) -> tuple[int, int]:
+        return await db_fetchone(
+            """
+            WITH old AS (
+                SELECT balance FROM economy WHERE user_id = %(user_id)s AND guild_id = %(guild_id)s FOR UPDATE
+            ), updated AS (
+                INSERT INTO economy (user_id, guild_id, balance) VALUES (%(user_id)s, %(guild_id)s, %(amount)s)
+                ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = EXCLUDED.balance
+                RETURNING balance
+            ), logged AS (
+                INSERT INTO economy_ledger (guild_id, user_id, delta, reason)
+                SELECT %(guild_id)s, %(user_id)s, balance - COALESCE((SELECT balance FROM old), 0), %(reason)s FROM updated
+                WHERE balance <> COALESCE((SELECT balance FROM old), 0)
+            )
+            SELECT balance, COALESCE((SELECT balance FROM old), 0) FROM updated
+            """,
+            {'user_id': user_id, 'guild_id': guild_id, 'amount': amount, 'reason': reason}
+        )
+
+    async def claim_cooldown(self, user_id: int, guild_id: int, action: str, now: float, cooldown: float, reward: int) -> tuple[Optional[float], Optional[int], Optional[float]]:
+        return await db_fetchone(
+            """
+            WITH claimed AS (
+                INSERT INTO cooldowns (user_id, guild_id, action, last_time) VALUES (%(user_id)s, %(guild_id)s, %(action)s, %(now)s)
+                ON CONFLICT (user_id, guild_id, action) DO UPDATE SET last_time = EXCLUDED.last_time
+                WHERE cooldowns.last_time <= %(now)s - %(cooldown)s
+                RETURNING last_time
+            ), paid AS (
+                INSERT INTO economy (user_id, guild_id, balance) SELECT %(user_id)s, %(guild_id)s, %(reward)s FROM claimed
+                ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = economy.balance + EXCLUDED.balance
+                RETURNING balance
+            ), logged AS (
+                INSERT INTO economy_ledger (guild_id, user_id, delta, reason)
+                SELECT %(guild_id)s, %(user_id)s, %(reward)s, %(action)s FROM paid WHERE %(reward)s <> 0
+            )
+            SELECT
+                (SELECT last_time FROM claimed),
+                (SELECT balance FROM paid),
+                (SELECT last_time FROM cooldowns WHERE user_id = %(user_id)s AND guild_id = %(guild_id)s AND action = %(action)s)
+            """,
+            {'user_id': user_id, 'guild_id': guild_id, 'action': action, 'now': now, 'cooldown': cooldown, 'reward': reward}
+        )
+
+    async def compact_ledger(self, cutoff: datetime):
+        # Cada snapshot guarda el saldo justo después del último movimiento compactado y el neto acumulado.
+        # Toda la sentencia ve una misma instantánea: los saldos y el libro que lee son consistentes entre sí.
+        await db_execute(
+            """
+            WITH moved AS (
+                DELETE FROM economy_ledger WHERE created_at < %(cutoff)s RETURNING guild_id, user_id, id, delta
+            ), grouped AS (
+                SELECT guild_id, user_id, SUM(delta) AS delta, COUNT(*) AS entries, MAX(id) AS last_id
+                FROM moved GROUP BY guild_id, user_id
+            )
+            INSERT INTO economy_snapshots (guild_id, user_id, balance, compacted_delta, compacted_entries, last_ledger_id, taken_at)
+            SELECT g.guild_id, g.user_id,
+                   COALESCE(e.balance, 0) - COALESCE((
+                       SELECT SUM(l.delta) FROM economy_ledger l
+                       WHERE l.guild_id = g.guild_id AND l.user_id = g.user_id AND l.created_at >= %(cutoff)s
+                   ), 0),
+                   g.delta, g.entries, g.last_id, now()
+            FROM grouped g
+            LEFT JOIN economy e ON e.guild_id = g.guild_id AND e.user_id = g.user_id
+            ON CONFLICT (guild_id, user_id) DO UPDATE
+            SET balance = EXCLUDED.balance,
+                compacted_delta = economy_snapshots.compacted_delta + EXCLUDED.compacted_delta,
+                compacted_entries = economy_snapshots.compacted_entries + EXCLUDED.compacted_entries,
+                last_ledger_id = EXCLUDED.last_ledger_id,
+                taken_at = EXCLUDED.taken_at
+            """,
+            {'cutoff': cutoff}
+        )
+
+    async def get_ledger_page(self, guild_id: int, user_id: int, before_id: Optional[int], limit: int) -> list[tuple[int, int, str, datetime]]:
+        if before_id is None:
+            return await db_fetchall(
+                "SELECT id, delta, reason, created_at FROM economy_ledger WHERE guild_id = %s AND user_id = %s ORDER BY id DESC LIMIT %s",
+                (guild_id, user_id, limit)
+            )
+        return await db_fetchall(
+            "SELECT id, delta, reason, created_at FROM economy_ledger WHERE guild_id = %s AND user_id = %s AND id < %s ORDER BY id DESC LIMIT %s",
+            (guild_id, user_id, before_id, limit)
+        )
+
+    async def get_ledger_snapshot(self, guild_id: int, user_id: int) -> Optional[tuple[int, int, int, datetime]]:
+        return await db_fetchone(
+            "SELECT balance, compacted_delta, compacted_entries, taken_at FROM economy_snapshots WHERE guild_id = %s AND user_id = %s",
+            (guild_id, user_id)
+        )
+
+    async def get_leaderboard_page(self, guild_id: int, mode: str, after: Optional[tuple[int, int]], limit: int) -> list[tuple[int, int]]:
+        table, column = LEADERBOARD_SOURCES[mode]
+        if after is None:
+            return await db_fetchall(
+                f"SELECT user_id, {column} FROM {table} WHERE guild_id = %s ORDER BY {column} DESC, user_id DESC LIMIT %s",
+                (guild_id, limit)
+            )
+        return await db_fetchall(
+            f"SELECT user_id, {column} FROM {table} WHERE guild_id = %s AND ({column}, user_id) < (%s, %s) ORDER BY {column} DESC, user_id DESC LIMIT %s",
+            (guild_id, *after, limit)
+        )
+
+    async def get_level(self, user_id: int, guild_id: int) -> Optional[tuple[int, float]]:
+        return await db_fetchone("SELECT total_xp, last_message_time FROM leveling WHERE user_id = %s AND guild_id = %s", (user_id, guild_id))
+
+    @staticmethod
+    def _grant_xp_batch(cursor, rows: list[dict]):
+        # Upsert de varias filas que suma el delta al XP total y recalcula el nivel en la misma sentencia,
+        # así que varios procesos pueden otorgar XP al mismo usuario sin perder actualizaciones.
+        execute_values(
+            cursor,
+            """
+            INSERT INTO leveling AS l (user_id, guild_id, total_xp, level, last_message_time) VALUES %s
+            ON CONFLICT (user_id, guild_id) DO UPDATE
+            SET total_xp = l.total_xp + EXCLUDED.total_xp,
+                level = nexus_level_for_xp(l.total_xp + EXCLUDED.total_xp),
+                last_message_time = GREATEST(l.last_message_time, EXCLUDED.last_message_time)
+            """,
+            rows,
+            template="(%(user_id)s, %(guild_id)s, %(xp)s, nexus_level_for_xp(%(xp)s), %(last_message_time)s)"
+        )
+
+    async def grant_xp_batch(self, rows: list[dict]):
+        await db_transaction(self._grant_xp_batch, rows)
+
+    async def bulk_update_xp(self, guild_id: int, user_ids: list[int], amount: int, replace: bool = False) -> int:
+        new_total = "GREATEST(%(amount)s, 0)" if replace else "GREATEST(l.total_xp + %(amount)s, 0)"
+        return await db_execute(
+            f"""
+            INSERT INTO leveling AS l (user_id, guild_id, total_xp, level)
+            SELECT u, %(guild_id)s, GREATEST(%(amount)s, 0), nexus_level_for_xp(GREATEST(%(amount)s, 0))
+            FROM unnest(%(user_ids)s::BIGINT[]) AS u
+            ON CONFLICT (user_id, guild_id) DO UPDATE
+            SET total_xp = {new_total}, level = nexus_level_for_xp({new_total})
+            """,
+            {'guild_id': guild_id, 'user_ids': user_ids, 'amount': amount}
+        )
+
+    async def add_warning(self, guild_id: int, user_id: int, moderator_id: int, reason: str, timestamp: datetime):
+        await db_execute(
+            "INSERT INTO warnings (user_id, guild_id, moderator_id, reason, timestamp) VALUES (%s, %s, %s, %s, %s)",
+            (user_id, guild_id, moderator_id, reason, timestamp)
+        )
+
+    async def count_warnings(self, guild_id: int, user_id: int) -> int:
+        # Se resuelve con un index-only scan sobre `warnings_user_idx`.
+        return (await db_fetchone("SELECT count(*) FROM warnings WHERE guild_id = %s AND user_id = %s", (guild_id, user_id)))[0]
+
+    async def get_warnings_page(self, guild_id: int, user_id: int, before_id: Optional[int], limit: int) -> list[tuple[int, int, str, datetime]]:
+        if before_id is None:
+            return await db_fetchall(
+                "SELECT id, moderator_id, reason, timestamp FROM warnings WHERE guild_id = %s AND user_id = %s ORDER BY id DESC LIMIT %s",
+                (guild_id, user_id, limit)
+            )
+        return await db_fetchall(
+            "SELECT id, moderator_id, reason, timestamp FROM warnings WHERE guild_id = %s AND user_id = %s AND id < %s ORDER BY id DESC LIMIT %s",
+            (guild_id, user_id, before_id, limit)
+        )
+
+    async def delete_warnings(self, guild_id: int, user_id: int, before: Optional[datetime] = None, from_id: Optional[int] = None, to_id: Optional[int] = None) -> int:
+        conditions = ["guild_id = %s", "user_id = %s"]
+        params: list = [guild_id, user_id]
+        for condition, value in (("timestamp < %s", before), ("id >= %s", from_id), ("id <= %s", to_id)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        return await db_execute(f"DELETE FROM warnings WHERE {' AND '.join(conditions)}", tuple(params))
+
+    async def load_scheduled_actions(self, shard_ids: Optional[list[int]] = None) -> list[tuple[int, int, str, float]]:
+        if shard_ids is None:
+            return await db_fetchall("SELECT guild_id, user_id, action, run_at FROM scheduled_actions")
+        return await db_fetchall(
+            "SELECT guild_id, user_id, action, run_at FROM scheduled_actions WHERE mod(guild_id >> 22, %s) = ANY(%s)",
+            (SHARD_COUNT, shard_ids)
+        )
+
+    async def schedule_action(self, guild_id: int, user_id: int, action: str, run_at: float):
+        await db_execute(
+            """
+            INSERT INTO scheduled_actions (guild_id, user_id, action, run_at) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (guild_id, user_id, action) DO UPDATE SET run_at = EXCLUDED.run_at
+            """,
+            (guild_id, user_id, action, run_at)
+        )
+
+    async def cancel_action(self, guild_id: int, user_id: int, action: str):
+        await db_execute("DELETE FROM scheduled_actions WHERE guild_id = %s AND user_id = %s AND action = %s", (guild_id, user_id, action))
+
+    async def finish_action(self, guild_id: int, user_id: int, action: str, run_at: float):
+        await db_execute(
+            "DELETE FROM scheduled_actions WHERE guild_id = %s AND user_id = %s AND action = %s AND run_at = %s",
+            (guild_id, user_id, action, run_at)
+        )
+
+    async def load_pending_interactions(self, shard_ids: Optional[list[int]] = None) -> list[tuple]:
+        query = "SELECT message_id, kind, guild_id, channel_id, author_id, target_id, responder_id, expires_at FROM pending_interactions"
+        if shard_ids is None:
+            return await db_fetchall(query)
+        return await db_fetchall(query + " WHERE mod(guild_id >> 22, %s) = ANY(%s)", (SHARD_COUNT, shard_ids))
+
+    async def add_pending_interaction(self, message_id: int, kind: str, guild_id: int, channel_id: int, author_id: int, target_id: int, responder_id: int, expires_at: float):
+        await db_execute(
+            "INSERT INTO pending_interactions (message_id, kind, guild_id, channel_id, author_id, target_id, responder_id, expires_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+            (message_id, kind, guild_id, channel_id, author_id, target_id, responder_id, expires_at)
+        )
+
+    async def delete_pending_interaction(self, message_id: int):
+        await db_execute("DELETE FROM pending_interactions WHERE message_id = %s", (message_id,))
+
+    async def get_shop_roles(self, guild_id: int) -> list[tuple[int, int]]:
+        return await db_fetchall("SELECT role_id, price FROM role_shop WHERE guild_id = %s", (guild_id,))
+
+    async def set_shop_role(self, guild_id: int, role_id: int, price: int):
+        await db_execute(
+            "INSERT INTO role_shop (guild_id, role_id, price) VALUES (%s, %s, %s) ON CONFLICT (guild_id, role_id) DO UPDATE SET price = EXCLUDED.price",
+            (guild_id, role_id, price)
+        )
+
+    async def remove_shop_roles(self, guild_id: int, role_ids: list[int]) -> int:
+        return await db_execute("DELETE FROM role_shop WHERE guild_id = %s AND role_id = ANY(%s)", (guild_id, role_ids))
+
+    async def get_marriages(self, guild_id: int) -> list[tuple[int, int, datetime]]:
+        return await db_fetchall("SELECT user1_id, user2_id, marriage_date FROM marriages WHERE guild_id = %s", (guild_id,))
+
+    async def add_marriage(self, guild_id: int, user1_id: int, user2_id: int, marriage_date: datetime):
+        await db_execute("INSERT INTO marriages (user1_id, user2_id, guild_id, marriage_date) VALUES (%s, %s, %s, %s)",
+                         (user1_id, user2_id, guild_id, marriage_date))
+
+    async def delete_marriage(self, guild_id: int, user1_id: int, user2_id: int):
+        await db_execute("DELETE FROM marriages WHERE user1_id = %s AND user2_id = %s AND guild_id = %s", (user1_id, user2_id, guild_id))
+
+
+# Esquema completo de SQLite. No arrastra el historial de migraciones de PostgreSQL: un archivo nuevo
+# se crea directamente en la versión actual y `PRAGMA user_version` indica cuál tiene.
+SQLITE_SCHEMA_VERSION = 1
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS config (
+        guild_id INTEGER PRIMARY KEY,
+        log_channel_id INTEGER,
+        report_channel_id INTEGER,
+        report_role_id INTEGER,
+        autorole_id INTEGER,
+        mute_mode TEXT,
+        mute_role_id INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS scheduled_actions (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        run_at REAL NOT NULL,
+        PRIMARY KEY (guild_id, user_id, action)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS warnings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        guild_id INTEGER,
+        moderator_id INTEGER,
+        reason TEXT,
+        timestamp TEXT
+    );
+    CREATE INDEX IF NOT EXISTS warnings_user_idx ON warnings (guild_id, user_id, id DESC);
+    CREATE TABLE IF NOT EXISTS economy (
+        user_id INTEGER,
+        guild_id INTEGER,
+        balance INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, guild_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS economy_rank_idx ON economy (guild_id, balance DESC, user_id DESC);
+    CREATE TABLE IF NOT EXISTS economy_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS economy_ledger_user_idx ON economy_ledger (guild_id, user_id, id DESC);
+    CREATE INDEX IF NOT EXISTS economy_ledger_created_idx ON economy_ledger (created_at);
+    CREATE TABLE IF NOT EXISTS economy_snapshots (
+        guild_id INTEGER,
+        user_id INTEGER,
+        balance INTEGER NOT NULL,
+        compacted_delta INTEGER NOT NULL DEFAULT 0,
+        compacted_entries INTEGER NOT NULL DEFAULT 0,
+        last_ledger_id INTEGER NOT NULL,
+        taken_at TEXT NOT NULL,
+        PRIMARY KEY (guild_id, user_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS cooldowns (
+        user_id INTEGER,
+        guild_id INTEGER,
+        action TEXT,
+        last_time REAL,
+        PRIMARY KEY (user_id, guild_id, action)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS leveling (
+        user_id INTEGER,
+        guild_id INTEGER,
+        total_xp INTEGER NOT NULL DEFAULT 0,
+        level INTEGER NOT NULL DEFAULT 0,
+        last_message_time REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, guild_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS leveling_rank_idx ON leveling (guild_id, total_xp DESC, user_id DESC);
+    CREATE TABLE IF NOT EXISTS role_shop (
+        guild_id INTEGER,
+        role_id INTEGER,
+        price INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, role_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS marriages (
+        user1_id INTEGER,
+        user2_id INTEGER,
+        guild_id INTEGER,
+        marriage_date TEXT,
+        PRIMARY KEY (user1_id, user2_id, guild_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS marriages_guild_user2_idx ON marriages (guild_id, user2_id);
+    CREATE TABLE IF NOT EXISTS pending_interactions (
+        message_id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        guild_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        author_id INTEGER NOT NULL,
+        target_id INTEGER NOT NULL,
+        responder_id INTEGER NOT NULL,
+        expires_at REAL NOT NULL
+    );
+"""
+
+def _check_sqlite_version():
+    # RETURNING (3.35) es lo más reciente que usan las consultas; las upserts necesitan 3.24.
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        raise sqlite3.NotSupportedError(f"SQLite {sqlite3.sqlite_version} no es compatible: se necesita la versión 3.35 o superior.")
+
+def _to_sqlite_time(value: Optional[datetime]) -> Optional[str]:
+    """Las fechas se guardan como texto ISO 8601 en UTC con precisión fija, que ordena igual que el tiempo."""
+    return value.astimezone(timezone.utc).isoformat(timespec='microseconds') if value else None
+
+def _from_sqlite_time(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+class SQLiteStorage(Storage):
+    """
+    Almacenamiento en un archivo SQLite en modo WAL, para instalaciones pequeñas y pruebas sin servicios externos.
+
+    Usa una sola conexión en un hilo dedicado, así que las consultas no bloquean el event loop y nunca compiten
+    entre sí dentro del proceso. El módulo sqlite3 guarda cada sentencia preparada por su texto
+    (`cached_statements`), por lo que las consultas, que son constantes, solo se compilan la primera vez.
+    Cada sentencia suelta es atómica (autocommit); las operaciones de varias sentencias abren `BEGIN IMMEDIATE`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        _check_sqlite_version()
+        conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=SQLITE_STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # Con WAL, NORMAL no sincroniza en cada commit: una caída del sistema puede perder los últimos, nunca corromper.
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")  # Otros procesos (modo clúster) escribiendo.
+        conn.create_function('nexus_level_for_xp', 1, level_for_xp, deterministic=True)
+        return conn
+
+    async def _call(self, func, *args):
+        # Se copia el contexto como en asyncio.to_thread, para que las variables de contexto lleguen al hilo.
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(context.run, func, *args))
+
+    def _run_transaction(self, func, atomic: bool, *args):
+        cursor = self.conn.cursor()
+        if not atomic:
+            return func(cursor, *args)
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(cursor, *args)
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+        return result
+
+    async def _run(self, func, *args, atomic: bool = False, helper: Optional[str] = None):
+        """Ejecuta `func(cursor, *args)` en el hilo de SQLite con las mismas métricas que `db_transaction`."""
+        labels = (('helper', helper or func.__qualname__),)
+        start = time.perf_counter()
+        try:
+            return await self._call(self._run_transaction, func, atomic, *args)
+        except Exception:
+            metrics.inc('nexus_db_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('nexus_db_query_duration_seconds', labels, time.perf_counter() - start)
+
+    @staticmethod
+    def _first(cursor) -> Optional[tuple]:
+        # Se leen todas las filas para que SQLite termine la sentencia: con RETURNING, la escritura no se
+        # confirma en autocommit hasta entonces.
+        rows = cursor.fetchall()
+        return rows[0] if rows else None
+
+    async def _execute(self, query: str, params: Union[tuple, dict] = ()) -> int:
+        return await self._run(lambda cursor: cursor.execute(query, params).rowcount, helper=_caller_name())
+
+    async def _fetchone(self, query: str, params: Union[tuple, dict] = ()) -> Optional[tuple]:
+        return await self._run(lambda cursor: self._first(cursor.execute(query, params)), helper=_caller_name())
+
+    async def _fetchall(self, query: str, params: Union[tuple, dict] = ()) -> list[tuple]:
+        return await self._run(lambda cursor: cursor.execute(query, params).fetchall(), helper=_caller_name())
+
+    async def open(self):
+        if self.conn is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='nexus-sqlite')
+            self.conn = await self._call(self._connect)
+
+    async def close(self):
+        if self.conn is not None:
+            await self._call(self.conn.close)
+            self.conn = None
+            self.executor.shutdown()
+
+    def migrate(self) -> int:
+        _check_sqlite_version()
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")  # Queda guardado en el archivo.
+            conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+            version, = conn.execute("PRAGMA user_version").fetchone()
+            if version >= SQLITE_SCHEMA_VERSION:
+                return 0
+            conn.executescript(f"BEGIN IMMEDIATE; {SQLITE_SCHEMA} PRAGMA user_version = {SQLITE_SCHEMA_VERSION}; COMMIT;")
+            print(f"Esquema SQLite (versión {SQLITE_SCHEMA_VERSION}) creado en {self.path}")
+            return 1
+        finally:
+            conn.close()
+
+    async def ping(self) -> bool:
+        if self.conn is None:
+            return False
+        await self._fetchone("SELECT 1")
+        return True
+
+    async def load_configs(self) -> list[tuple]:
+        return await self._fetchall(f"SELECT guild_id, {', '.join(CONFIG_FIELDS)} FROM config")
+
+    async def get_config(self, guild_id: int) -> Optional[tuple]:
+        return await self._fetchone(f"SELECT {', '.join(CONFIG_FIELDS)} FROM config WHERE guild_id = ?", (guild_id,))
+
+    async def update_config(self, guild_id: int, fields: dict) -> tuple:
+        columns = list(fields)
+        return await self._fetchone(
+            f"""
+            INSERT INTO config (guild_id, {', '.join(columns)}) VALUES (?, {', '.join(['?'] * len(columns))})
+            ON CONFLICT (guild_id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}
+            RETURNING {', '.join(CONFIG_FIELDS)}
+            """,
+            (guild_id, *fields.values())
+        )
+
+    async def get_balance(self, user_id: int, guild_id: int) -> int:
+        def query(cursor):
+            result = self._first(cursor.execute("SELECT balance FROM economy WHERE user_id = ? AND guild_id = ?", (user_id, guild_id)))
+            if result:
+                return result[0]
+            cursor.execute("INSERT INTO economy (user_id, guild_id, balance) VALUES (?, ?, 0) ON CONFLICT (user_id, guild_id) DO NOTHING", (user_id, guild_id))
+            return 0
+        return await self._run(query)
+
+    @staticmethod
+    def _log_ledger(cursor, guild_id: int, user_id: int, delta: int, reason: str):
+        # Se llama dentro de la misma transacción que el cambio de saldo.
+        cursor.execute(
+            "INSERT INTO economy_ledger (guild_id, user_id, delta, reason, created_at) VALUES (?, ?, ?, ?, ?)",
+            (guild_id, user_id, delta, reason, _to_sqlite_time(datetime.now(timezone.utc)))
+        )
+
+    async def add_balance(self, user_id: int, guild_id: int, amount: int, reason: str, required: int = 0) -> Optional[int]:
+        def update(cursor):
+            if required > 0:
+                result = self._first(cursor.execute(
+                    "UPDATE economy SET balance = balance + ? WHERE user_id = ? AND guild_id = ? AND balance >= ? RETURNING balance",
+                    (amount, user_id, guild_id, required)
+                ))
+            else:
+                result = self._first(cursor.execute(
+                    """
+                    INSERT INTO economy (user_id, guild_id, balance) VALUES (?, ?, ?)
+                    ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = balance + excluded.balance
+                    RETURNING balance
+                    """,
+                    (user_id, guild_id, amount)
+                ))
+            if result is None:
+                return None
+            self._log_ledger(cursor, guild_id, user_id, amount, reason)
+            return result[0]
+        return await self._run(update, atomic=True)
+
+    async def transfer_balance(self, guild_id: int, from_user_id: int, to_user_id: int, amount: int, reason: str) -> Optional[tuple[int, int]]:
+        def transfer(cursor):
+            debit = self._first(cursor.execute(
+                "UPDATE economy SET balance = balance - ? WHERE user_id = ? AND guild_id = ? AND balance >= ? RETURNING balance",
+                (amount, from_user_id, guild_id, amount)
+            ))
+            if debit is None:
+                return None
+            credit = self._first(cursor.execute(
+                """
+                INSERT INTO economy (user_id, guild_id, balance) VALUES (?, ?, ?)
+                ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = balance + excluded.balance
+                RETURNING balance
+                """,
+                (to_user_id, guild_id, amount)
+            ))
+            self._log_ledger(cursor, guild_id, from_user_id, -amount, reason)
+            self._log_ledger(cursor, guild_id, to_user_id, amount, reason)
+            return debit[0], credit[0]
+        return await self._run(transfer, atomic=True)
+
+    async def set_balance(self, user_id: int, guild_id: int, amount: int, reason: str) -> tuple[int, int]:
+        def update(cursor):
+            old = self._first(cursor.execute("SELECT balance FROM economy WHERE user_id = ? AND guild_id = ?", (user_id, guild_id)))
+            old_balance = old[0] if old else 0
+            cursor.execute(
+                "INSERT INTO economy (user_id, guild_id, balance) VALUES (?, ?, ?) ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = excluded.balance",
+                (user_id, guild_id, amount)
+            )
+            if amount != old_balance:
+                self._log_ledger(cursor, guild_id, user_id, amount - old_balance, reason)
+            return amount, old_balance
+        return await self._run(update, atomic=True)
+
+    async def claim_cooldown(self, user_id: int, guild_id: int, action: str, now: float, cooldown: float, reward: int) -> tuple[Optional[float], Optional[int], Optional[float]]:
+        def claim(cursor):
+            claimed = self._first(cursor.execute(
+                """
+                INSERT INTO cooldowns (user_id, guild_id, action, last_time) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id, guild_id, action) DO UPDATE SET last_time = excluded.last_time
+                WHERE last_time <= ?
+                RETURNING last_time
+                """,
+                (user_id, guild_id, action, now, now - cooldown)
+            ))
+            if claimed is None:
+                previous = self._first(cursor.execute(
+                    "SELECT last_time FROM cooldowns WHERE user_id = ? AND guild_id = ? AND action = ?", (user_id, guild_id, action)
+                ))
+                return None, None, previous[0] if previous else None
+            paid = self._first(cursor.execute(
+                """
+                INSERT INTO economy (user_id, guild_id, balance) VALUES (?, ?, ?)
+                ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = balance + excluded.balance
+                RETURNING balance
+                """,
+                (user_id, guild_id, reward)
+            ))
+            if reward:
+                self._log_ledger(cursor, guild_id, user_id, reward, action)
+            return claimed[0], paid[0], claimed[0]
+        return await self._run(claim, atomic=True)
+
+    async def compact_ledger(self, cutoff: datetime):
+        def compact(cursor):
+            # Mismo cálculo que en PostgreSQL; aquí el snapshot se escribe antes de borrar, en la misma transacción.
+            # El WHERE true evita la ambigüedad de SQLite entre el ON del JOIN y el ON CONFLICT.
+            cursor.execute(
+                """
+                INSERT INTO economy_snapshots (guild_id, user_id, balance, compacted_delta, compacted_entries, last_ledger_id, taken_at)
+                SELECT g.guild_id, g.user_id,
+                       COALESCE(e.balance, 0) - COALESCE((
+                           SELECT SUM(l.delta) FROM economy_ledger l
+                           WHERE l.guild_id = g.guild_id AND l.user_id = g.user_id AND l.created_at >= :cutoff
+                       ), 0),
+                       g.delta, g.entries, g.last_id, :now
+                FROM (
+                    SELECT guild_id, user_id, SUM(delta) AS delta, COUNT(*) AS entries, MAX(id) AS last_id
+                    FROM economy_ledger WHERE created_at < :cutoff GROUP BY guild_id, user_id
+                ) AS g
+                LEFT JOIN economy e ON e.guild_id = g.guild_id AND e.user_id = g.user_id
+                WHERE true
+                ON CONFLICT (guild_id, user_id) DO UPDATE
+                SET balance = excluded.balance,
+                    compacted_delta = compacted_delta + excluded.compacted_delta,
+                    compacted_entries = compacted_entries + excluded.compacted_entries,
+                    last_ledger_id = excluded.last_ledger_id,
+                    taken_at = excluded.taken_at
+                """,
+                {'now': _to_sqlite_time(datetime.now(timezone.utc)), 'cutoff': _to_sqlite_time(cutoff)}
+            )
+            cursor.execute("DELETE FROM economy_ledger WHERE created_at < ?", (_to_sqlite_time(cutoff),))
+        await self._run(compact, atomic=True)
+
+    async def get_ledger_page(self, guild_id: int, user_id: int, before_id: Optional[int], limit: int) -> list[tuple[int, int, str, datetime]]:
+        if before_id is None:
+            rows = await self._fetchall(
+                "SELECT id, delta, reason, created_at FROM economy_ledger WHERE guild_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?",
+                (guild_id, user_id, limit)
+            )
+        else:
+            rows = await self._fetchall(
+                "SELECT id, delta, reason, created_at FROM economy_ledger WHERE guild_id = ? AND user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (guild_id, user_id, before_id, limit)
+            )
+        return [(entry_id, delta, reason, _from_sqlite_time(created_at)) for entry_id, delta, reason, created_at in rows]
+
+    async def get_ledger_snapshot(self, guild_id: int, user_id: int) -> Optional[tuple[int, int, int, datetime]]:
+        row = await self._fetchone(
+            "SELECT balance, compacted_delta, compacted_entries, taken_at FROM economy_snapshots WHERE guild_id = ? AND user_id = ?",
+            (guild_id, user_id)
+        )
+        return (*row[:3], _from_sqlite_time(row[3])) if row else None
+
+    async def get_leaderboard_page(self, guild_id: int, mode: str, after: Optional[tuple[int, int]], limit: int) -> list[tuple[int, int]]:
+        table, column = LEADERBOARD_SOURCES[mode]
+        if after is None:
+            return await self._fetchall(
+                f"SELECT user_id, {column} FROM {table} WHERE guild_id = ? ORDER BY {column} DESC, user_id DESC LIMIT ?",
+                (guild_id, limit)
+            )
+        return await self._fetchall(
+            f"SELECT user_id, {column} FROM {table} WHERE guild_id = ? AND ({column}, user_id) < (?, ?) ORDER BY {column} DESC, user_id DESC LIMIT ?",
+            (guild_id, *after, limit)
+        )
+
+    async def get_level(self, user_id: int, guild_id: int) -> Optional[tuple[int, float]]:
+        return await self._fetchone("SELECT total_xp, last_message_time FROM leveling WHERE user_id = ? AND guild_id = ?", (user_id, guild_id))
+
+    async def grant_xp_batch(self, rows: list[dict]):
+        def grant(cursor):
+            # En el SET de SQLite, las columnas se refieren a la fila anterior: el nivel se calcula con el XP sumado.
+            cursor.executemany(
+                """
+                INSERT INTO leveling (user_id, guild_id, total_xp, level, last_message_time)
+                VALUES (:user_id, :guild_id, :xp, nexus_level_for_xp(:xp), :last_message_time)
+                ON CONFLICT (user_id, guild_id) DO UPDATE
+                SET total_xp = total_xp + excluded.total_xp,
+                    level = nexus_level_for_xp(total_xp + excluded.total_xp),
+                    last_message_time = MAX(last_message_time, excluded.last_message_time)
+                """,
+                rows
+            )
+        await self._run(grant, atomic=True)
+
+    async def bulk_update_xp(self, guild_id: int, user_ids: list[int], amount: int, replace: bool = False) -> int:
+        new_total = "MAX(:amount, 0)" if replace else "MAX(total_xp + :amount, 0)"
+        def update(cursor):
+            return cursor.executemany(
+                f"""
+                INSERT INTO leveling (user_id, guild_id, total_xp, level)
+                VALUES (:user_id, :guild_id, MAX(:amount, 0), nexus_level_for_xp(MAX(:amount, 0)))
+                ON CONFLICT (user_id, guild_id) DO UPDATE
+                SET total_xp = {new_total}, level = nexus_level_for_xp({new_total})
+                """,
+                [{'user_id': user_id, 'guild_id': guild_id, 'amount': amount} for user_id in user_ids]
+            ).rowcount
+        return await self._run(update, atomic=True)
+
+    async def add_warning(self, guild_id: int, user_id: int, moderator_id: int, reason: str, timestamp: datetime):
+        await self._execute(
+            "INSERT INTO warnings (user_id, guild_id, moderator_id, reason, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (user_id, guild_id, moderator_id, reason, _to_sqlite_time(timestamp))
+        )
+
+    async def count_warnings(self, guild_id: int, user_id: int) -> int:
+        return (await self._fetchone("SELECT count(*) FROM warnings WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)))[0]
+
+    async def get_warnings_page(self, guild_id: int, user_id: int, before_id: Optional[int], limit: int) -> list[tuple[int, int, str, datetime]]:
+        if before_id is None:
+            rows = await self._fetchall(
+                "SELECT id, moderator_id, reason, timestamp FROM warnings WHERE guild_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?",
+                (guild_id, user_id, limit)
+            )
+        else:
+            rows = await self._fetchall(
+                "SELECT id, moderator_id, reason, timestamp FROM warnings WHERE guild_id = ? AND user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (guild_id, user_id, before_id, limit)
+            )
+        return [(warning_id, moderator_id, reason, _from_sqlite_time(timestamp)) for warning_id, moderator_id, reason, timestamp in rows]
+
+    async def delete_warnings(self, guild_id: int, user_id: int, before: Optional[datetime] = None, from_id: Optional[int] = None, to_id: Optional[int] = None) -> int:
+        conditions = ["guild_id = ?", "user_id = ?"]
+        params: list = [guild_id, user_id]
+        for condition, value in (("timestamp < ?", _to_sqlite_time(before)), ("id >= ?", from_id), ("id <= ?", to_id)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        return await self._execute(f"DELETE FROM warnings WHERE {' AND '.join(conditions)}", tuple(params))
+
+    async def load_scheduled_actions(self, shard_ids: Optional[list[int]] = None) -> list[tuple[int, int, str, float]]:
+        if shard_ids is None:
+            return await self._fetchall("SELECT guild_id, user_id, action, run_at FROM scheduled_actions")
+        return await self._fetchall(
+            f"SELECT guild_id, user_id, action, run_at FROM scheduled_actions WHERE (guild_id >> 22) % ? IN ({', '.join(['?'] * len(shard_ids))})",
+            (SHARD_COUNT, *shard_ids)
+        )
+
+    async def schedule_action(self, guild_id: int, user_id: int, action: str, run_at: float):
+        await self._execute(
+            """
+            INSERT INTO scheduled_actions (guild_id, user_id, action, run_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (guild_id, user_id, action) DO UPDATE SET run_at = excluded.run_at
+            """,
+            (guild_id, user_id, action, run_at)
+        )
+
+    async def cancel_action(self, guild_id: int, user_id: int, action: str):
+        await self._execute("DELETE FROM scheduled_actions WHERE guild_id = ? AND user_id = ? AND action = ?", (guild_id, user_id, action))
+
+    async def finish_action(self, guild_id: int, user_id: int, action: str, run_at: float):
+        await self._execute(
+            "DELETE FROM scheduled_actions WHERE guild_id = ? AND user_id = ? AND action = ? AND run_at = ?",
+            (guild_id, user_id, action, run_at)
+        )
+
+    async def load_pending_interactions(self, shard_ids: Optional[list[int]] = None) -> list[tuple]:
+        query = "SELECT message_id, kind, guild_id, channel_id, author_id, target_id, responder_id, expires_at FROM pending_interactions"
+        if shard_ids is None:
+            return await self._fetchall(query)
+        return await self._fetchall(
+            query + f" WHERE (guild_id >> 22) % ? IN ({', '.join(['?'] * len(shard_ids))})",
+            (SHARD_COUNT, *shard_ids)
+        )
+
+    async def add_pending_interaction(self, message_id: int, kind: str, guild_id: int, channel_id: int, author_id: int, target_id: int, responder_id: int, expires_at: float):
+        await self._execute(
+            "INSERT INTO pending_interactions (message_id, kind, guild_id, channel_id, author_id, target_id, responder_id, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (message_id, kind, guild_id, channel_id, author_id, target_id, responder_id, expires_at)
+        )
+
+    async def delete_pending_interaction(self, message_id: int):
+        await self._execute("DELETE FROM pending_interactions WHERE message_id = ?", (message_id,))
+
+    async def get_shop_roles(self, guild_id: int) -> list[tuple[int, int]]:
+        return await self._fetchall("SELECT role_id, price FROM role_shop WHERE guild_id = ?", (guild_id,))
+
+    async def set_shop_role(self, guild_id: int, role_id: int, price: int):
+        await self._execute(
+            "INSERT INTO role_shop (guild_id, role_id, price) VALUES (?, ?, ?) ON CONFLICT (guild_id, role_id) DO UPDATE SET price = excluded.price",
+            (guild_id, role_id, price)
+        )
+
+    async def remove_shop_roles(self, guild_id: int, role_ids: list[int]) -> int:
+        return await self._execute(
+            f"DELETE FROM role_shop WHERE guild_id = ? AND role_id IN ({', '.join(['?'] * len(role_ids))})",
+            (guild_id, *role_ids)
+        )
+
+    async def get_marriages(self, guild_id: int) -> list[tuple[int, int, datetime]]:
+        rows = await self._fetchall("SELECT user1_id, user2_id, marriage_date FROM marriages WHERE guild_id = ?", (guild_id,))
+        return [(user1_id, user2_id, _from_sqlite_time(marriage_date)) for user1_id, user2_id, marriage_date in rows]
+
+    async def add_marriage(self, guild_id: int, user1_id: int, user2_id: int, marriage_date: datetime):
+        await self._execute("INSERT INTO marriages (user1_id, user2_id, guild_id, marriage_date) VALUES (?, ?, ?, ?)",
+                            (user1_id, user2_id, guild_id, _to_sqlite_time(marriage_date)))
+
+    async def delete_marriage(self, guild_id: int, user1_id: int, user2_id: int):
+        await self._execute("DELETE FROM marriages WHERE user1_id = ? AND user2_id = ? AND guild_id = ?", (user1_id, user2_id, guild_id))
+
+
+storage: Storage = SQLiteStorage(SQLITE_PATH) if STORAGE_BACKEND == 'sqlite' else PostgresStorage()
+
+
+# ----------------------------------------------------
+# CACHÉS Y OPERACIONES DE DATOS
+# ----------------------------------------------------
+
+class GuildConfigCache:
+    """Caché en memoria de la tabla `config`. Los servidores sin configuración se guardan como `{}`."""
+
+    def __init__(self):
+        self.configs: dict[int, dict] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _row_to_dict(row: tuple) -> dict:
+        return dict(zip(CONFIG_FIELDS, row))
+
+    async def load_all(self):
+        """Carga la configuración de todos los servidores en una sola consulta."""
+        rows = await storage.load_configs()
+        self.configs = {row[0]: self._row_to_dict(row[1:]) for row in rows}
+
+    async def get(self, guild_id: int) -> dict:
+        config = self.configs.get(guild_id)
+        if config is not None:
+            self.hits += 1
+            return config
+        self.misses += 1
+        result = await storage.get_config(guild_id)
+        config = self._row_to_dict(result) if result else {}
+        self.configs[guild_id] = config
+        return config
+
+    def set(self, guild_id: int, row: tuple):
+        self.configs[guild_id] = self._row_to_dict(row)
+
+    def invalidate(self, guild_id: int):
+        self.configs.pop(guild_id, None)
+
+    def stats(self) -> dict:
+        return {'size': len(self.configs), 'hits': self.hits, 'misses': self.misses}
+
+
+guild_configs = GuildConfigCache()
+
+
+async def get_config(guild: discord.Guild):
+    """Obtiene la configuración del servidor (desde la caché)."""
+    return await guild_configs.get(guild.id)
+
+async def update_config(guild_id: int, **fields):
+    """Guarda campos de configuración del servidor y actualiza la caché con la fila resultante."""
+    assert all(column in CONFIG_FIELDS for column in fields)
+    guild_configs.set(guild_id, await storage.update_config(guild_id, fields))
+
+async def get_log_channel(guild: discord.Guild) -> Optional[discord.TextChannel]:
+    """Obtiene el canal de logs del servidor."""
+    config = await get_config(guild)
+    if config.get('log_channel_id'):
+        return guild.get_channel(config['log_channel_id'])
+    return None
+
+async def get_report_config(guild: discord.Guild) -> tuple[Optional[discord.TextChannel], Optional[discord.Role]]:
+    """Obtiene el canal y rol de reportes."""
+    config = await get_config(guild)
+    channel = guild.get_channel(config.get('report_channel_id'))
+    role = guild.get_role(config.get('report_role_id'))
+    return channel, role
+
+
+async def get_balance(user_id: int, guild_id: int) -> int:
+    """Obtiene el saldo de un usuario."""
+    return await storage.get_balance(user_id, guild_id)
+
+async def update_balance(user_id: int, guild_id: int, amount: int, reason: str, required: int = 0) -> Optional[int]:
+    """
+    Añade o resta una cantidad al saldo de un usuario en una sola sentencia y la anota en el libro contable.
+
+    Si `required` es positivo, solo se aplica cuando el saldo actual es al menos `required`
+    (así una apuesta o compra no puede gastar dos veces el mismo dinero). Retorna el nuevo saldo,
+    o None si el saldo no alcanzaba.
+    """
+    return await storage.add_balance(user_id, guild_id, amount, reason, required)
+
+async def transfer_balance(guild_id: int, from_user_id: int, to_user_id: int, amount: int, reason: str) -> Optional[tuple[int, int]]:
+    """
+    Mueve dinero entre dos usuarios de forma atómica, solo si el origen tiene saldo suficiente.
+
+    Retorna (nuevo saldo del origen, nuevo saldo del destino), o None si el origen no tenía suficiente.
+    """
+    return await storage.transfer_balance(guild_id, from_user_id, to_user_id, amount, reason)
+
+async def set_balance(user_id: int, guild_id: int, amount: int, reason: str = 'admin') -> int:
+    """Establece el saldo de un usuario a una cantidad específica y anota la diferencia en el libro contable."""
+    new_balance, _old_balance = await storage.set_balance(user_id, guild_id, amount, reason)
+    return new_balance
+
+
+class CooldownStore:
+    """
+    Cooldowns de economía con caché TTL en memoria.
+
+    "Todavía en cooldown" se responde desde memoria; reclamar el cooldown y pagar la recompensa
+    es una sola operación atómica, así que dos invocaciones simultáneas no pueden cobrar ambas.
+    """
+
+    def __init__(self, cooldowns: dict[str, float], max_size: int):
+        self.cooldowns = cooldowns
+        self.max_size = max_size
+        # (guild_id, user_id, action) -> fin del cooldown, del menos al más recientemente reclamado (LRU).
+        self.expires: OrderedDict[tuple[int, int, str], float] = OrderedDict()
+
+    def remaining(self, user_id: int, guild_id: int, action: str) -> float:
+        """Segundos de cooldown restantes según la caché (0 si no se sabe que esté en cooldown)."""
+        key = (guild_id, user_id, action)
+        expires_at = self.expires.get(key)
+        if expires_at is None:
+            return 0.0
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            del self.expires[key]
+            return 0.0
+        return remaining
+
+    def _remember(self, user_id: int, guild_id: int, action: str, expires_at: float):
+        key = (guild_id, user_id, action)
+        self.expires[key] = expires_at
+        self.expires.move_to_end(key)
+        # Olvidar una entrada solo cuesta una consulta: la DB sigue decidiendo si el cooldown se puede reclamar.
+        while len(self.expires) > self.max_size:
+            self.expires.popitem(last=False)
+
+    async def claim(self, user_id: int, guild_id: int, action: str, reward: int = 0) -> tuple[float, Optional[int]]:
+        """
+        Reclama el cooldown y suma `reward` al saldo de forma atómica.
+
+        Retorna (0, nuevo saldo) si se reclamó, o (segundos restantes, None) si seguía en cooldown.
+        """
+        remaining = self.remaining(user_id, guild_id, action)
+        if remaining > 0:
+            return remaining, None
+        cooldown = self.cooldowns[action]
+        now = time.time()
+        claimed_time, new_balance, previous_time = await storage.claim_cooldown(user_id, guild_id, action, now, cooldown, reward)
+        if claimed_time is None:
+            if previous_time is None:
+                previous_time = now  # Otra invocación simultánea creó la fila y reclamó el cooldown.
+            self._remember(user_id, guild_id, action, previous_time + cooldown)
+            return max(previous_time + cooldown - now, 0.0), None
+        self._remember(user_id, guild_id, action, now + cooldown)
+        return 0.0, new_balance
+
+
+cooldowns = CooldownStore(ECONOMY_COOLDOWNS, COOLDOWN_CACHE_MAX_SIZE)
+
+
+def format_cooldown(remaining_seconds: float) -> str:
+    """Formatea segundos restantes como 'Xh Ym'."""
+    remaining_hours = int(remaining_seconds // 3600)
+    remaining_minutes = int((remaining_seconds % 3600) // 60)
+    return f"{remaining_hours}h {remaining_minutes}m"
+
+
+async def get_level_data(user_id: int, guild_id: int) -> tuple[int, int, float]:
+    """Obtiene XP dentro del nivel actual, Nivel y el último tiempo de mensaje de un usuario."""
+    result = await storage.get_level(user_id, guild_id)
+    total_xp, last_message_time = result if result else (0, 0.0)
+    return (*split_xp(total_xp), last_message_time)
+
+def get_xp_needed(level: int) -> int:
+    """Calcula el XP necesario para el siguiente nivel."""
+    return 100 + level * 50
+
+def xp_for_level(level: int) -> int:
+    """XP total acumulado necesario para alcanzar un nivel (suma de get_xp_needed hasta level - 1)."""
+    return 25 * level * level + 75 * level
+
+def level_for_xp(total_xp: int) -> int:
+    """Nivel correspondiente a un XP total, en forma cerrada (inversa exacta de xp_for_level)."""
+    return (math.isqrt(5625 + 100 * max(total_xp, 0)) - 75) // 50
+
+def split_xp(total_xp: int) -> tuple[int, int]:
+    """Convierte un XP total en (XP dentro del nivel actual, nivel)."""
+    level = level_for_xp(total_xp)
+    return total_xp - xp_for_level(level), level
+
+async def bulk_update_xp(guild_id: int, user_ids: list[int], amount: int, replace: bool = False) -> int:
+    """Suma (o establece, si `replace`) el XP total de varios usuarios."""
+    return await storage.bulk_update_xp(guild_id, user_ids, amount, replace)
+
+
+class MarriageCache:
+    """
+    Mapa en memoria de matrimonios por servidor: `{guild_id: {user_id: (partner_id, marriage_date)}}`.
+
+    Cada matrimonio se guarda en ambos sentidos. Un servidor se carga completo la primera vez que se consulta
+    y después solo lo modifican `marry` y `divorce`.
+    """
+
+    def __init__(self):
+        self.partners: dict[int, dict[int, tuple[int, datetime]]] = {}
+        self.locks: dict[int, asyncio.Lock] = {}
+
+    async def _load(self, guild_id: int) -> dict[int, tuple[int, datetime]]:
+        partners = self.partners.get(guild_id)
+        if partners is not None:
+            return partners
+        async with self.locks.setdefault(guild_id, asyncio.Lock()):
+            partners = self.partners.get(guild_id)
+            if partners is None:
+                rows = await storage.get_marriages(guild_id)
+                partners = {}
+                for user1_id, user2_id, marriage_date in rows:
+                    partners[user1_id] = (user2_id, marriage_date)
+                    partners[user2_id] = (user1_id, marriage_date)
+                self.partners[guild_id] = partners
+        return partners
+
+    async def get(self, guild_id: int, user_id: int) -> Optional[tuple[int, datetime]]:
+        """Retorna (partner_id, marriage_date) o None si el usuario no está casado."""
+        return (await self._load(guild_id)).get(user_id)
+
+    async def marry(self, guild_id: int, user1_id: int, user2_id: int) -> bool:
+        """Registra un matrimonio. Retorna False si alguno de los dos ya está casado."""
+        partners = await self._load(guild_id)
+        if user1_id in partners or user2_id in partners:
+            return False
+        marriage_date = datetime.now(timezone.utc)
+        # Se reserva en memoria antes de escribir para que dos propuestas simultáneas no casen a la misma persona.
+        partners[user1_id] = (user2_id, marriage_date)
+        partners[user2_id] = (user1_id, marriage_date)
+        u1, u2 = sorted([user1_id, user2_id])
+        try:
+            await storage.add_marriage(guild_id, u1, u2, marriage_date)
+        except Exception:
+            partners.pop(user1_id, None)
+            partners.pop(user2_id, None)
+            raise
+        return True
+
+    async def divorce(self, guild_id: int, user_id: int) -> Optional[int]:
+        """Elimina el matrimonio del usuario. Retorna la ID de la ex pareja o None si no estaba casado."""
+        partners = await self._load(guild_id)
+        entry = partners.pop(user_id, None)
+        if entry is None:
+            return None
+        partner_id, _ = entry
+        partners.pop(partner_id, None)
+        u1, u2 = sorted([user_id, partner_id])
+        await storage.delete_marriage(guild_id, u1, u2)
+        return partner_id
+
+    def invalidate(self, guild_id: int):
+        self.partners.pop(guild_id, None)
+        self.locks.pop(guild_id, None)
+
+
+marriages = MarriageCache()
+
+
+def normalize_role_name(name: str) -> str:
+    """Normaliza un nombre de rol para compararlo: sin mayúsculas ni espacios repetidos."""
+    return ' '.join(name.casefold().split())
+
+
+class ShopIndex:
+    """
+    Índice en memoria de la tienda de roles por servidor.
+
+    `prices` guarda `{guild_id: {role_id: price}}` y se carga completo la primera vez que se consulta un servidor.
+    `names` guarda por servidor una lista ordenada de (nombre normalizado, role_id) para buscar por nombre exacto
+    o por prefijo con bisect; se reconstruye desde `prices` cuando se renombra un rol a la venta.
+    """
+
+    def __init__(self):
+        self.prices: dict[int, dict[int, int]] = {}
+        self.names: dict[int, list[tuple[str, int]]] = {}
+        self.locks: dict[int, asyncio.Lock] = {}
+
+    async def _load(self, guild: discord.Guild) -> dict[int, int]:
+        prices = self.prices.get(guild.id)
+        if prices is not None:
+            return prices
+        async with self.locks.setdefault(guild.id, asyncio.Lock()):
+            prices = self.prices.get(guild.id)
+            if prices is None:
+                rows = await storage.get_shop_roles(guild.id)
+                prices = {role_id: price for role_id, price in rows if guild.get_role(role_id)}
+                # Roles borrados mientras el bot no estaba conectado.
+                stale = [role_id for role_id, _ in rows if role_id not in prices]
+                if stale:
+                    await storage.remove_shop_roles(guild.id, stale)
+                self.prices[guild.id] = prices
+        return prices
+
+    async def _names(self, guild: discord.Guild) -> list[tuple[str, int]]:
+        prices = await self._load(guild)
+        names = self.names.get(guild.id)
+        if names is None:
+            names = sorted((normalize_role_name(role.name), role.id) for role in map(guild.get_role, prices) if role)
+            self.names[guild.id] = names
+        return names
 
-DATABASE_URL = os.getenv('DATABASE_URL')
+    async def entries(self, guild: discord.Guild) -> list[tuple[discord.Role, int]]:
+        """Retorna (rol, precio) de todos los roles a la venta, ordenados por precio y nombre."""
+        prices = await self._load(guild)
+        entries = [(role, prices[role.id]) for role in map(guild.get_role, prices) if role]
+        entries.sort(key=lambda entry: (entry[1], entry[0].name.casefold()))
+        return entries
+
+    async def find(self, guild: discord.Guild, name: str) -> Optional[tuple[discord.Role, int]]:
+        """Busca un rol a la venta por nombre (sin distinguir mayúsculas). Retorna (rol, precio) o None."""
+        key = normalize_role_name(name)
+        names = await self._names(guild)
+        i = bisect.bisect_left(names, (key, 0))
+        if i < len(names) and names[i][0] == key:
+            role = guild.get_role(names[i][1])
+            if role:
+                return role, self.prices[guild.id][role.id]
+        return None
+
+    async def complete(self, guild: discord.Guild, prefix: str, limit: int = 25) -> list[tuple[discord.Role, int]]:
+        """Retorna hasta `limit` roles a la venta cuyo nombre empieza por `prefix`, en orden alfabético."""
+        key = normalize_role_name(prefix)
+        names = await self._names(guild)
+        results = []
+        for name, role_id in names[bisect.bisect_left(names, (key, 0)):]:
+            if not name.startswith(key) or len(results) >= limit:
+                break
+            role = guild.get_role(role_id)
+            if role:
+                results.append((role, self.prices[guild.id][role_id]))
+        return results
+
+    async def add(self, guild: discord.Guild, role: discord.Role, price: int):
+        """Pone un rol a la venta o actualiza su precio."""
+        prices = await self._load(guild)
+        await storage.set_shop_role(guild.id, role.id, price)
+        if role.id not in prices:
+            self.names.pop(guild.id, None)
+        prices[role.id] = price
+
+    async def remove(self, guild_id: int, role_id: int) -> bool:
+        """Quita un rol de la tienda. Retorna False si no estaba a la venta."""
+        prices = self.prices.get(guild_id)
+        if prices is not None:
+            prices.pop(role_id, None)
+            self.names.pop(guild_id, None)
+        return await storage.remove_shop_roles(guild_id, [role_id]) > 0
+
+    def role_renamed(self, role: discord.Role):
+        if role.id in self.prices.get(role.guild.id, ()):
+            self.names.pop(role.guild.id, None)
+
+    def invalidate(self, guild_id: int):
+        self.prices.pop(guild_id, None)
+        self.names.pop(guild_id, None)
+        self.locks.pop(guild_id, None)
+
+
+shop_index = ShopIndex()
 
-bot = commands.Bot(command_prefix=PREFIX, intents=INTENTS)
-bot.help_command = CustomHelpCommand()
 
 # ----------------------------------------------------
-# 3. FUNCIONES DE UTILIDAD PARA EMBEDS
+# 5. AGREGADOR DE XP (ESCRITURA DIFERIDA)
 # ----------------------------------------------------
 
-def create_error_embed(title: str, description: str) -> discord.Embed:
-    """Crea un embed estándar para mensajes de error."""
-    return discord.Embed(
-        title=f"❌ {title}",
-        description=description,
-        color=discord.Color.red()
-    )
+class XPAggregator:
+    """
+    Acumula el XP de los mensajes en memoria y lo escribe en `leveling` en lote.
 
-def create_success_embed(title: str, description: str) -> discord.Embed:
-    """Crea un embed estándar para mensajes exitosos."""
-    return discord.Embed(
-        title=f"✅ {title}",
-        description=description,
-        color=discord.Color.green()
-    )
+    El cooldown se resuelve desde memoria, así que los mensajes en cooldown no tocan la DB.
+    Solo el primer mensaje de un usuario (o tras un periodo de inactividad) carga su fila.
+    """
+
+    def __init__(self, max_pending: int, idle_seconds: float):
+        self.max_pending = max_pending
+        self.idle_seconds = idle_seconds
+        self.state: dict[tuple[int, int], list] = {}  # (guild_id, user_id) -> [total_xp, last_message_time]
+        self.pending: dict[tuple[int, int], list] = {}  # (guild_id, user_id) -> [xp por guardar, last_message_time]
+        self.lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
 
-async def create_role_if_not_exists(guild: discord.Guild, role_name: str) -> discord.Role:
-    """Crea un rol con el nombre especificado si no existe, ajustando permisos para MUTE_ROLE_NAME."""
-    role = discord.utils.get(guild.roles, name=role_name)
-    if role:
-        return role
+    async def _load(self, user_id: int, guild_id: int) -> list:
+        result = await storage.get_level(user_id, guild_id)
+        return list(result) if result else [0, 0.0]
 
-    role = await guild.create_role(name=role_name, permissions=discord.Permissions.none())
+    def peek(self, user_id: int, guild_id: int) -> Optional[tuple[int, int, float]]:
+        """Retorna (XP del nivel, nivel, último mensaje) desde memoria, incluyendo XP aún no guardado."""
+        entry = self.state.get((guild_id, user_id))
+        return (*split_xp(entry[0]), entry[1]) if entry else None
+
+    async def forget(self, guild_id: int, user_ids: list[int]):
+        """
+        Descarta el estado en memoria de usuarios cuyo XP se modificó directamente en la DB.
+
+        Primero se guarda el XP pendiente: si se descartara sin guardarlo, la siguiente carga leería un total
+        sin ese XP y podría anunciar dos veces la misma subida de nivel.
+        """
+        await self.flush()
+        for user_id in user_ids:
+            key = (guild_id, user_id)
+            if key not in self.pending:  # Si el guardado falló, se conserva el estado hasta el próximo flush.
+                self.state.pop(key, None)
+
+    async def grant(self, user_id: int, guild_id: int, xp_to_add: int, current_time: float) -> Optional[int]:
+        """Otorga XP si el usuario no está en cooldown. Retorna el nuevo nivel si subió de nivel."""
+        key = (guild_id, user_id)
+        entry = self.state.get(key)
+        if entry is None:
+            loaded = await self._load(user_id, guild_id)
+            entry = self.state.setdefault(key, loaded)
+        total_xp, last_message_time = entry
+        if current_time - last_message_time < XP_COOLDOWN_SECONDS:
+            return None
+        level = level_for_xp(total_xp)
+        new_level = level_for_xp(total_xp + xp_to_add)
+        entry[:] = [total_xp + xp_to_add, current_time]
+        pending = self.pending.setdefault(key, [0, current_time])
+        pending[0] += xp_to_add
+        pending[1] = current_time
+        if len(self.pending) >= self.max_pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+        return new_level if new_level > level else None
 
-    if role_name == MUTE_ROLE_NAME:
-        for channel in guild.channels:
-            if isinstance(channel, (discord.TextChannel, discord.VoiceChannel)):
+    async def flush(self):
+        """Escribe todo el XP pendiente en una única sentencia por lotes."""
+        async with self.lock:
+            if self.pending:
+                batch, self.pending = self.pending, {}
+                rows = [
+                    {'user_id': user_id, 'guild_id': guild_id, 'xp': xp, 'last_message_time': last_time}
+                    for (guild_id, user_id), (xp, last_time) in batch.items()
+                ]
                 try:
-                    await channel.set_permissions(role, send_messages=False, speak=False)
-                except discord.Forbidden:
-                    print(f"Advertencia: No se pudieron establecer permisos para el canal {channel.name}.")
+                    await storage.grant_xp_batch(rows)
+                except Exception as e:
+                    # Se reincorpora el lote fallido sumándolo a lo acumulado mientras tanto.
+                    for key, (xp, last_time) in batch.items():
+                        pending = self.pending.setdefault(key, [0, last_time])
+                        pending[0] += xp
+                    metrics.inc('nexus_errors_total', (('where', 'xp_flush'),))
+                    print(f"Error al guardar el XP pendiente ({len(rows)} usuarios): {e}")
+                    return
+            # Se descartan los usuarios inactivos ya guardados para que la memoria no crezca sin límite.
+            cutoff = time.time() - self.idle_seconds
+            for key in [k for k, v in self.state.items() if v[1] < cutoff and k not in self.pending]:
+                del self.state[key]
+
+
+xp_aggregator = XPAggregator(XP_FLUSH_MAX_PENDING, XP_CACHE_IDLE_SECONDS)
+
+
+@tasks.loop(seconds=XP_FLUSH_INTERVAL_SECONDS)
+async def flush_xp():
+    """Vacía periódicamente el XP acumulado en memoria hacia la base de datos."""
+    await xp_aggregator.flush()
 
-    return role
 
 
 # ----------------------------------------------------
-# 4. FUNCIONES DE UTILIDAD DE BASE DE DATOS (DB)
+# 6. PLANIFICADOR DE ACCIONES PROGRAMADAS
 # ----------------------------------------------------
 
-@contextmanager
-def get_db_connection():
-    """Crea y maneja una conexión a la base de datos PostgreSQL."""
+class ActionScheduler:
+    """
+    Ejecuta acciones de moderación programadas (desmuteos, desbaneos...) en su hora exacta.
+
+    Las acciones pendientes viven en `scheduled_actions` y se cargan una vez en un min-heap.
+    El bucle duerme hasta el próximo vencimiento y se despierta antes si el calendario cambia.
+    """
+
+    def __init__(self):
+        self.handlers: dict[str, Callable[[int, int], Awaitable[None]]] = {}
+        self.heap: list[tuple[float, int, int, str]] = []  # (run_at, guild_id, user_id, action)
+        self.deadlines: dict[tuple[int, int, str], float] = {}  # Entradas vigentes; el resto del heap está obsoleto.
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def handler(self, action: str):
+        """Registra la corrutina `handler(guild_id, user_id)` que ejecuta una acción."""
+        def decorator(func):
+            self.handlers[action] = func
+            return func
+        return decorator
+
+    def _push(self, guild_id: int, user_id: int, action: str, run_at: float):
+        self.deadlines[(guild_id, user_id, action)] = run_at
+        heapq.heappush(self.heap, (run_at, guild_id, user_id, action))
+        if self.heap[0][0] == run_at:
+            self.wakeup.set()
+
+    async def start(self):
+        """Carga las acciones pendientes (solo de los shards de este proceso) y arranca el bucle."""
+        # Cada servidor pertenece a un solo shard, así que cada acción la ejecuta un único proceso.
+        rows = await storage.load_scheduled_actions(SHARD_IDS)
+        self.heap, self.deadlines = [], {}
+        for guild_id, user_id, action, run_at in rows:
+            self.deadlines[(guild_id, user_id, action)] = run_at
+            self.heap.append((run_at, guild_id, user_id, action))
+        heapq.heapify(self.heap)
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    async def schedule(self, guild_id: int, user_id: int, action: str, run_at: float):
+        """Programa (o reprograma) una acción y la persiste."""
+        await storage.schedule_action(guild_id, user_id, action, run_at)
+        self._push(guild_id, user_id, action, run_at)
+
+    async def cancel(self, guild_id: int, user_id: int, action: str):
+        """Cancela una acción pendiente. Su entrada en el heap se descarta al llegar a la cima."""
+        self.deadlines.pop((guild_id, user_id, action), None)
+        await storage.cancel_action(guild_id, user_id, action)
+
+    async def _run(self):
+        # Hasta tener la caché de servidores, los handlers no encontrarían al servidor ni al miembro.
+        await bot.wait_until_ready()
+        while True:
+            self.wakeup.clear()
+            while self.heap and self.deadlines.get(self.heap[0][1:]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            run_at, guild_id, user_id, action = heapq.heappop(self.heap)
+            del self.deadlines[(guild_id, user_id, action)]
+            try:
+                await self.handlers[action](guild_id, user_id)
+            except Exception as e:
+                metrics.inc('nexus_errors_total', (('where', f'scheduler_{action}'),))
+                print(f"Error al ejecutar la acción programada '{action}' (usuario {user_id}, servidor {guild_id}): {e}")
+            # Solo se borra si nadie la reprogramó mientras se ejecutaba. Si falla, la fila queda y la acción
+            # se vuelve a ejecutar al reiniciar, pero el bucle sigue atendiendo al resto.
+            try:
+                await storage.finish_action(guild_id, user_id, action, run_at)
+            except Exception as e:
+                metrics.inc('nexus_errors_total', (('where', 'scheduler_finish'),))
+                print(f"Error al borrar la acción programada '{action}' (usuario {user_id}, servidor {guild_id}): {e}")
+
+
+scheduler = ActionScheduler()
+
+
+@scheduler.handler('unmute')
+async def scheduled_unmute(guild_id: int, user_id: int):
+    """Quita el rol de silencio cuando expira un muteo temporal."""
+    guild = bot.get_guild(guild_id)
+    if not guild:
+        return
+    member = await member_cache.get(guild, user_id, refresh=True)  # Los roles deben estar al día.
+    mute_role = await get_mute_role(guild)
+    if member and mute_role and mute_role in member.roles:
+        try:
+            await member.remove_roles(mute_role, reason="Tiempo de muteo expirado.")
+            log_channel = await get_log_channel(guild)
+            if log_channel:
+                outbound.send_embed(log_channel, discord.Embed(title="🔊 Auto-Desmuteo", description=f"{member.mention} ha sido desmuteado automáticamente.", color=discord.Color.green()))
+        except discord.Forbidden:
+            print(f"Error: No se pudo desmutear al usuario {member.id} en {guild.name} (Permisos).")
+
+@scheduler.handler('unban')
+async def scheduled_unban(guild_id: int, user_id: int):
+    """Levanta un baneo temporal cuando expira."""
+    guild = bot.get_guild(guild_id)
+    if not guild:
+        return
     try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        yield conn
-    finally:
-        if conn:
-            conn.close()
+        await guild.unban(discord.Object(id=user_id), reason="Tiempo de baneo expirado.")
+        log_channel = await get_log_channel(guild)
+        if log_channel:
+            outbound.send_embed(log_channel, discord.Embed(title="🕊️ Auto-Desbaneo", description=f"<@{user_id}> (ID: {user_id}) ha sido desbaneado automáticamente.", color=discord.Color.green()))
+    except discord.NotFound:
+        pass
+    except discord.Forbidden:
+        print(f"Error: No se pudo desbanear al usuario {user_id} en {guild.name} (Permisos).")
 
-def initialize_db():
-    """Inicializa la base de datos PostgreSQL y crea las tablas necesarias."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS config (
-                    guild_id BIGINT PRIMARY KEY,
-                    log_channel_id BIGINT,
-                    report_channel_id BIGINT,
-                    report_role_id BIGINT,
-                    autorole_id BIGINT
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS temp_mutes (
-                    user_id BIGINT,
-                    guild_id BIGINT,
-                    unmute_time DOUBLE PRECISION,
-                    PRIMARY KEY (user_id, guild_id)
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS warnings (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    guild_id BIGINT,
-                    moderator_id BIGINT,
-                    reason TEXT,
-                    timestamp TEXT
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS economy (
-                    user_id BIGINT,
-                    guild_id BIGINT,
-                    balance INTEGER DEFAULT 0,
-                    PRIMARY KEY (user_id, guild_id)
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS cooldowns (
-                    user_id BIGINT,
-                    guild_id BIGINT,
-                    action TEXT,
-                    last_time DOUBLE PRECISION,
-                    PRIMARY KEY (user_id, guild_id, action)
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS leveling (
-                    user_id BIGINT,
-                    guild_id BIGINT,
-                    xp INTEGER DEFAULT 0,
-                    level INTEGER DEFAULT 0,
-                    last_message_time DOUBLE PRECISION DEFAULT 0,
-                    PRIMARY KEY (user_id, guild_id)
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS role_shop (
-                    guild_id BIGINT,
-                    role_id BIGINT,
-                    price INTEGER,
-                    PRIMARY KEY (guild_id, role_id)
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS marriages (
-                    user1_id BIGINT,
-                    user2_id BIGINT,
-                    guild_id BIGINT,
-                    marriage_date TEXT,
-                    PRIMARY KEY (user1_id, user2_id, guild_id)
-                )
-            """)
-            conn.commit()
 
 
-def get_config(guild: discord.Guild):
-    """Obtiene la configuración del servidor."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT log_channel_id, report_channel_id, report_role_id, autorole_id FROM config WHERE guild_id = %s", (guild.id,))
-            result = cursor.fetchone()
-            if result:
-                return {
-                    'log_channel_id': result[0],
-                    'report_channel_id': result[1],
-                    'report_role_id': result[2],
-                    'autorole_id': result[3]
-                }
-            return {}
-
-def get_log_channel(guild: discord.Guild) -> Optional[discord.TextChannel]:
-    """Obtiene el canal de logs del servidor."""
-    config = get_config(guild)
-    if config.get('log_channel_id'):
-        return guild.get_channel(config['log_channel_id'])
-    return None
+# ----------------------------------------------------
+# 7. LIBRO CONTABLE DE ECONOMÍA
+# ----------------------------------------------------
 
-def get_report_config(guild: discord.Guild) -> tuple[Optional[discord.TextChannel], Optional[discord.Role]]:
-    """Obtiene el canal y rol de reportes."""
-    config = get_config(guild)
-    channel = guild.get_channel(config.get('report_channel_id'))
-    role = guild.get_role(config.get('report_role_id'))
-    return channel, role
+LEDGER_REASONS = {
+    'daily': "Recompensa diaria",
+    'work': "Trabajo",
+    'flip': "Cara o cruz",
+    'slots': "Tragaperras",
+    'rob': "Robo",
+    'shop': "Tienda",
+    'admin': "Administración",
+}
+# Cada movimiento (`economy_ledger`) se escribe en la misma transacción que su cambio de saldo (ver Storage),
+# así que el libro y `economy.balance` nunca se contradicen, tampoco entre procesos del clúster.
 
 
-def get_balance(user_id: int, guild_id: int) -> int:
-    """Obtiene el saldo de un usuario."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO economy (user_id, guild_id, balance) VALUES (%s, %s, 0) ON CONFLICT (user_id, guild_id) DO NOTHING",
-                (user_id, guild_id)
-            )
-            conn.commit()
-            cursor.execute("SELECT balance FROM economy WHERE user_id = %s AND guild_id = %s", (user_id, guild_id))
-            result = cursor.fetchone()
-            return result[0] if result else 0
+@tasks.loop(hours=LEDGER_COMPACTION_INTERVAL_HOURS)
+async def compact_ledger():
+    """
+    Compacta periódicamente en `economy_snapshots` los movimientos de más de LEDGER_RETENTION_DAYS días.
 
-def update_balance(user_id: int, guild_id: int, amount: int):
-    """Añade o resta una cantidad al saldo de un usuario."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO economy (user_id, guild_id, balance) VALUES (%s, %s, 0) ON CONFLICT (user_id, guild_id) DO NOTHING",
-                (user_id, guild_id)
-            )
-            cursor.execute("UPDATE economy SET balance = balance + %s WHERE user_id = %s AND guild_id = %s", (amount, user_id, guild_id))
-            conn.commit()
+    Cada snapshot guarda el saldo justo después del último movimiento compactado y el neto acumulado,
+    y las filas compactadas se borran para que la tabla no crezca sin límite.
+    """
+    try:
+        await storage.compact_ledger(datetime.now(timezone.utc) - timedelta(days=LEDGER_RETENTION_DAYS))
+    except Exception as e:
+        metrics.inc('nexus_errors_total', (('where', 'ledger_compaction'),))
+        print(f"Error al compactar el libro contable: {e}")
 
-def set_balance(user_id: int, guild_id: int, amount: int) -> int:
-    """Establece el saldo de un usuario a una cantidad específica."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO economy (user_id, guild_id, balance) VALUES (%s, %s, 0) ON CONFLICT (user_id, guild_id) DO NOTHING",
-                (user_id, guild_id)
-            )
-            cursor.execute("UPDATE economy SET balance = %s WHERE user_id = %s AND guild_id = %s", (amount, user_id, guild_id))
-            conn.commit()
-            return get_balance(user_id, guild_id)
 
+# ----------------------------------------------------
+# 8. CACHÉ DE AUDITORÍA DE MENSAJES
+# ----------------------------------------------------
 
-def get_last_action_time(user_id: int, guild_id: int, action: str) -> float:
-    """Obtiene la última hora de una acción específica (timestamp)."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT last_time FROM cooldowns WHERE user_id = %s AND guild_id = %s AND action = %s", (user_id, guild_id, action))
-            result = cursor.fetchone()
-            return result[0] if result else 0.0
+class AuditRecord:
+    """Registro compacto de un mensaje para poder mostrarlo en el log si se borra."""
 
-def set_last_action_time(user_id: int, guild_id: int, action: str):
-    """Establece la última hora de una acción específica al tiempo actual."""
-    current_time = time.time()
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT INTO cooldowns (user_id, guild_id, action, last_time) VALUES (%s, %s, %s, %s)
-                ON CONFLICT (user_id, guild_id, action) DO UPDATE SET last_time = EXCLUDED.last_time
-                """,
-                (user_id, guild_id, action, current_time)
-            )
-            conn.commit()
+    __slots__ = ('guild_id', 'channel_id', 'author_id', 'content', 'attachments', 'size')
 
+    def __init__(self, guild_id: int, channel_id: int, author_id: int, content: str, attachments: tuple[str, ...]):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.content = content
+        self.attachments = attachments
+        # Estimación del coste en memoria: objeto y claves más el texto guardado.
+        self.size = AUDIT_RECORD_OVERHEAD_BYTES + len(content.encode()) + sum(len(name.encode()) for name in attachments)
 
-def get_level_data(user_id: int, guild_id: int) -> tuple[int, int, float]:
-    """Obtiene XP, Nivel y el último tiempo de mensaje de un usuario."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO leveling (user_id, guild_id) VALUES (%s, %s) ON CONFLICT (user_id, guild_id) DO NOTHING",
-                (user_id, guild_id)
-            )
-            conn.commit()
-            cursor.execute("SELECT xp, level, last_message_time FROM leveling WHERE user_id = %s AND guild_id = %s", (user_id, guild_id))
-            result = cursor.fetchone()
-            return result if result else (0, 0, 0.0)
 
-def get_xp_needed(level: int) -> int:
-    """Calcula el XP necesario para el siguiente nivel."""
-    return 100 + level * 50
+class AuditMessageCache:
+    """
+    LRU de mensajes recientes, solo de servidores con canal de logs, limitado por un presupuesto de bytes.
 
-def update_level_data(user_id: int, guild_id: int, xp_to_add: int, last_message_time: float) -> tuple[int, bool]:
-    """Actualiza los datos de XP y Nivel de un usuario. Retorna el nuevo nivel y si subió de nivel."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            xp, level, _ = get_level_data(user_id, guild_id)
-            new_xp = xp + xp_to_add
-            new_level = level
-            leveled_up = False
-            xp_needed = get_xp_needed(level)
-            while new_xp >= xp_needed:
-                new_xp -= xp_needed
-                new_level += 1
-                leveled_up = True
-                xp_needed = get_xp_needed(new_level) 
-            cursor.execute(
-                "UPDATE leveling SET xp = %s, level = %s, last_message_time = %s WHERE user_id = %s AND guild_id = %s",
-                (new_xp, new_level, last_message_time, user_id, guild_id)
-            )
-            conn.commit()
-            return new_level, leveled_up
+    A diferencia de la caché interna de discord.py (`max_messages`), guarda solo lo que el log necesita
+    y permite registrar borrados vía eventos raw aunque discord.py ya no tenga el mensaje.
+    """
 
-def get_shop_roles(guild_id: int) -> list[tuple[int, int]]:
-    """Obtiene todos los roles a la venta en el servidor."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT role_id, price FROM role_shop WHERE guild_id = %s", (guild_id,))
-            return cursor.fetchall()
+    def __init__(self, max_bytes: int, max_content_chars: int):
+        self.max_bytes = max_bytes
+        self.max_content_chars = max_content_chars
+        self.records: OrderedDict[int, AuditRecord] = OrderedDict()
+        self.bytes = 0
+
+    def truncate(self, content: str) -> str:
+        return content if len(content) <= self.max_content_chars else content[:self.max_content_chars - 1] + "…"
+
+    def remember(self, message: discord.Message):
+        record = AuditRecord(
+            message.guild.id, message.channel.id, message.author.id,
+            self.truncate(message.content), tuple(attachment.filename for attachment in message.attachments)
+        )
+        self.pop(message.id)
+        self.records[message.id] = record
+        self.bytes += record.size
+        while self.bytes > self.max_bytes and self.records:
+            _, evicted = self.records.popitem(last=False)
+            self.bytes -= evicted.size
+
+    def update_content(self, message_id: int, content: str):
+        record = self.records.get(message_id)
+        if record is not None:
+            self.bytes -= record.size
+            record = AuditRecord(record.guild_id, record.channel_id, record.author_id, self.truncate(content), record.attachments)
+            self.records[message_id] = record
+            self.bytes += record.size
+
+    def pop(self, message_id: int) -> Optional[AuditRecord]:
+        record = self.records.pop(message_id, None)
+        if record is not None:
+            self.bytes -= record.size
+        return record
+
+    def forget_guild(self, guild_id: int):
+        for message_id in [mid for mid, record in self.records.items() if record.guild_id == guild_id]:
+            self.pop(message_id)
+
+
+audit_cache = AuditMessageCache(AUDIT_CACHE_MAX_BYTES, AUDIT_CONTENT_MAX_CHARS)
+
+
+def describe_audit_record(record: AuditRecord) -> str:
+    content = record.content or "*(sin texto)*"
+    if record.attachments:
+        content += "\n📎 " + ", ".join(record.attachments)
+    return content
+
+
+@metrics.gauge('nexus_audit_cache', "Mensajes y bytes estimados en la caché de auditoría.")
+def audit_cache_gauge():
+    return [((('stat', 'entries'),), len(audit_cache.records)), ((('stat', 'bytes'),), audit_cache.bytes)]
+
+
+# ----------------------------------------------------
+# 9. REGISTRO DE INTERACCIONES CON BOTONES
+# ----------------------------------------------------
+
+class PendingInteraction:
+    """Mensaje con botones que espera la respuesta de un usuario (una propuesta, una confirmación...)."""
+
+    __slots__ = ('message_id', 'kind', 'guild_id', 'channel_id', 'author_id', 'target_id', 'responder_id', 'expires_at')
+
+    def __init__(self, message_id: int, kind: str, guild_id: int, channel_id: int, author_id: int, target_id: int, responder_id: int, expires_at: float):
+        self.message_id = message_id
+        self.kind = kind
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.target_id = target_id
+        self.responder_id = responder_id
+        self.expires_at = expires_at
+
+
+class InteractionRegistry:
+    """
+    Despacha los botones de las interacciones pendientes por custom_id (`nexus:<tipo>:<opción>`).
+
+    Cada tipo tiene una sola vista persistente (`timeout=None`) registrada al arrancar, así que discord.py
+    encuentra el botón con una búsqueda en diccionario y el estado se busca por ID de mensaje; ningún
+    `wait_for` revisa cada evento. El estado vive en `pending_interactions` y el vencimiento en el planificador,
+    por lo que los botones siguen funcionando tras un reinicio.
+    """
+
+    def __init__(self):
+        self.handlers: dict[str, Callable[[discord.Interaction, PendingInteraction, str], Awaitable[None]]] = {}
+        self.buttons: dict[str, tuple[tuple[str, str, Optional[str], discord.ButtonStyle], ...]] = {}
+        self.expired: dict[str, tuple[str, str]] = {}  # (título, descripción) del embed de vencimiento.
+        self.views: dict[str, discord.ui.View] = {}
+        self.pending: dict[int, PendingInteraction] = {}
+        self.by_author: dict[tuple[int, int, str], int] = {}  # (guild_id, author_id, tipo) -> message_id
+
+    def handler(self, kind: str, buttons: tuple[tuple[str, str, Optional[str], discord.ButtonStyle], ...], expired: tuple[str, str]):
+        """
+        Registra la corrutina `handler(interaction, pending, choice)` de un tipo.
+
+        `buttons` son (opción, etiqueta, emoji, estilo) y `expired` el título y la descripción del mensaje vencido.
+        """
+        def decorator(func):
+            self.handlers[kind] = func
+            self.buttons[kind] = buttons
+            self.expired[kind] = expired
+            scheduler.handler(f'expire_{kind}')(functools.partial(self.expire, kind=kind))
+            return func
+        return decorator
+
+    async def load(self):
+        """Registra las vistas persistentes y carga las interacciones pendientes (solo de los shards de este proceso)."""
+        # Las vistas necesitan el event loop en marcha, por eso se crean aquí y no al registrar el tipo.
+        for kind, buttons in self.buttons.items():
+            view = discord.ui.View(timeout=None)
+            for choice, label, emoji, style in buttons:
+                button = discord.ui.Button(label=label, emoji=emoji, style=style, custom_id=f"nexus:{kind}:{choice}")
+                button.callback = functools.partial(self.dispatch, kind=kind, choice=choice)
+                view.add_item(button)
+            bot.add_view(view)
+            self.views[kind] = view
+        rows = await storage.load_pending_interactions(SHARD_IDS)
+        self.pending, self.by_author = {}, {}
+        for row in rows:
+            if row[1] in self.handlers:
+                self._track(PendingInteraction(*row))
+
+    def _track(self, pending: PendingInteraction):
+        self.pending[pending.message_id] = pending
+        self.by_author[(pending.guild_id, pending.author_id, pending.kind)] = pending.message_id
+
+    def _untrack(self, pending: PendingInteraction):
+        self.pending.pop(pending.message_id, None)
+        self.by_author.pop((pending.guild_id, pending.author_id, pending.kind), None)
+
+    def has_pending(self, guild_id: int, author_id: int, kind: str) -> bool:
+        return (guild_id, author_id, kind) in self.by_author
+
+    async def open(self, message: discord.Message, kind: str, author_id: int, target_id: int, responder_id: int, timeout: float):
+        """Empieza a esperar la respuesta de `responder_id` a un mensaje enviado con `self.views[kind]`."""
+        pending = PendingInteraction(message.id, kind, message.guild.id, message.channel.id, author_id, target_id, responder_id, time.time() + timeout)
+        self._track(pending)
+        await storage.add_pending_interaction(pending.message_id, kind, pending.guild_id, pending.channel_id, author_id, target_id, responder_id, pending.expires_at)
+        await scheduler.schedule(pending.guild_id, author_id, f'expire_{kind}', pending.expires_at)
+
+    async def _close(self, pending: PendingInteraction):
+        self._untrack(pending)
+        await storage.delete_pending_interaction(pending.message_id)
+
+    async def dispatch(self, interaction: discord.Interaction, kind: str, choice: str):
+        pending = self.pending.get(interaction.message.id)
+        if pending is None or pending.kind != kind:
+            await interaction.response.send_message(embed=create_error_embed("Error", "Esta solicitud ya no está disponible."), ephemeral=True)
+            return
+        if interaction.user.id != pending.responder_id:
+            await interaction.response.send_message(embed=create_error_embed("Error", "Este botón no es para ti."), ephemeral=True)
+            return
+        # Se deja de seguir antes de cualquier await: un segundo clic ya no la encuentra.
+        self._untrack(pending)
+        try:
+            await self.handlers[kind](interaction, pending, choice)
+        finally:
+            await self._close(pending)
+            await scheduler.cancel(pending.guild_id, pending.author_id, f'expire_{kind}')
+
+    async def expire(self, guild_id: int, author_id: int, kind: str):
+        """Handler del planificador: marca el mensaje como vencido y quita sus botones."""
+        message_id = self.by_author.get((guild_id, author_id, kind))
+        if message_id is None:
+            return
+        pending = self.pending[message_id]
+        await self._close(pending)
+        message = bot.get_partial_messageable(pending.channel_id, guild_id=guild_id).get_partial_message(message_id)
+        try:
+            await message.edit(content=None, embed=create_error_embed(*self.expired[kind]), view=None)
+        except discord.HTTPException:
+            pass  # El mensaje o el canal ya no existen.
+
+
+interactions = InteractionRegistry()
+
+
+@metrics.gauge('nexus_pending_interactions', "Interacciones con botones que esperan respuesta.")
+def pending_interactions_gauge():
+    return [((), len(interactions.pending))]
 
-def get_partner(user_id: int, guild_id: int) -> Optional[int]:
-    """Obtiene la ID del compañero de matrimonio."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT user2_id, user1_id FROM marriages WHERE (user1_id = %s OR user2_id = %s) AND guild_id = %s", (user_id, user_id, guild_id))
-            result = cursor.fetchone()
-            if result:
-                return result[0] if result[0] != user_id else result[1]
-            return None
 
-def get_marriage_data(user_id: int, guild_id: int) -> Optional[tuple[int, int, str]]:
-    """Obtiene (user1_id, user2_id, marriage_date) de un matrimonio."""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT user1_id, user2_id, marriage_date FROM marriages WHERE (user1_id = %s OR user2_id = %s) AND guild_id = %s", (user_id, user_id, guild_id))
-            return cursor.fetchone()
 
 CLIENT_ID_INVITE = "1443693871061008457"
 PERMISSION_CODE_INVITE = 2422992118
@@ -388,50 +2978,25 @@ def generate_invite_link(client_id: str, permissions: int) -> str:
 @bot.event
 async def on_ready():
     """Se ejecuta cuando el bot está listo y conectado a Discord."""
-    print(f'Bot conectado como {bot.user.name} (ID: {bot.user.id})')
-    initialize_db()
+    print(f'Bot conectado como {bot.user.name} (ID: {bot.user.id})' + (f" [clúster {CLUSTER_ID}, shards {SHARD_IDS}]" if IS_CLUSTER_WORKER else ""))
+    # Se ejecuta en cada reconexión: el esquema, la caché de configuración y el planificador se preparan en setup_hook.
     # La sincronización ahora se maneja manualmente con el comando /sync.
     # try:
     #     await bot.tree.sync()
     #     print("Comandos Slash sincronizados exitosamente.")
     # except Exception as e:
     #     print(f"Error al sincronizar comandos Slash: {e}")
-    check_mutes.start()
-    if OWNER_ID != 1224791534436749354:
+    if IS_PRIMARY_CLUSTER and OWNER_ID != 1224791534436749354:
         owner = bot.get_user(OWNER_ID)
         if owner:
             await owner.send(f"🤖 **{bot.user.name}** ha iniciado correctamente. ")
 
 
-@tasks.loop(minutes=1)
-async def check_mutes():
-    """Revisa la base de datos para desmutear usuarios cuyo tiempo ha expirado."""
-    current_time = time.time()
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT user_id, guild_id FROM temp_mutes WHERE unmute_time <= %s", (current_time,))
-            expired_mutes = cursor.fetchall()
-            for user_id, guild_id in expired_mutes:
-                guild = bot.get_guild(guild_id)
-                if not guild: continue
-                member = guild.get_member(user_id)
-                mute_role = discord.utils.get(guild.roles, name=MUTE_ROLE_NAME)
-                if member and mute_role and mute_role in member.roles:
-                    try:
-                        await member.remove_roles(mute_role, reason="Tiempo de muteo expirado.")
-                        log_channel = get_log_channel(guild)
-                        if log_channel:
-                            await log_channel.send(embed=discord.Embed(title="🔊 Auto-Desmuteo", description=f"{member.mention} ha sido desmuteado automáticamente.", color=discord.Color.green()))
-                    except discord.Forbidden:
-                        print(f"Error: No se pudo desmutear al usuario {member.id} en {guild.name} (Permisos).")
-            cursor.execute("DELETE FROM temp_mutes WHERE unmute_time <= %s", (current_time,))
-            conn.commit()
-
-
 @bot.event
+@timed_event
 async def on_member_join(member: discord.Member):
     """Asigna el auto-rol a los nuevos miembros."""
-    config = get_config(member.guild)
+    config = await get_config(member.guild)
     autorole_id = config.get('autorole_id')
     if autorole_id:
         autorole = member.guild.get_role(autorole_id)
@@ -443,6 +3008,86 @@ async def on_member_join(member: discord.Member):
 
 
 @bot.event
+async def on_guild_remove(guild: discord.Guild):
+    """Libera la configuración en caché de un servidor que ya no usa el bot."""
+    guild_configs.invalidate(guild.id)
+    marriages.invalidate(guild.id)
+    shop_index.invalidate(guild.id)
+    member_cache.invalidate_guild(guild.id)
+    audit_cache.forget_guild(guild.id)
+
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    """Reindexa los nombres de la tienda cuando se renombra un rol a la venta."""
+    if before.name != after.name:
+        shop_index.role_renamed(after)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    """Quita de la tienda un rol borrado."""
+    if role.id in shop_index.prices.get(role.guild.id, ()):
+        await shop_index.remove(role.guild.id, role.id)
+
+
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    """Olvida al miembro en la caché de respaldo para no mostrarlo como si siguiera en el servidor."""
+    member_cache.forget(payload.guild_id, payload.user.id)
+
+
+@bot.before_invoke
+async def start_command_timer(ctx: commands.Context):
+    ctx.metrics_started = time.perf_counter()
+
+@bot.after_invoke
+async def observe_command(ctx: commands.Context):
+    """Registra la duración de los comandos prefix e híbridos (también cuando se usan como slash)."""
+    started = getattr(ctx, 'metrics_started', None)
+    if started is None:
+        return
+    kind = 'hybrid' if isinstance(ctx.command, commands.HybridCommand) else 'prefix'
+    labels = (('command', ctx.command.qualified_name), ('kind', kind))
+    metrics.observe('nexus_command_duration_seconds', labels, time.perf_counter() - started)
+    if ctx.command_failed:
+        metrics.inc('nexus_command_errors_total', labels)
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    observe_app_command(interaction, command)
+
+
+@metrics.gauge('nexus_gateway_latency_seconds', "Latencia del heartbeat con el gateway de Discord.")
+def gateway_latency_gauge():
+    return [((), bot.latency)]
+
+@metrics.gauge('nexus_guilds', "Servidores en los que está el bot.")
+def guilds_gauge():
+    return [((), len(bot.guilds))]
+
+@metrics.gauge('nexus_members', "Suma de miembros de todos los servidores.")
+def members_gauge():
+    return [((), sum(guild.member_count or 0 for guild in bot.guilds))]
+
+@metrics.gauge('nexus_config_cache', "Estado de la caché de configuración por servidor.")
+def config_cache_gauge():
+    return [((('stat', stat),), value) for stat, value in guild_configs.stats().items()]
+
+@metrics.gauge('nexus_pending_writes', "Escrituras diferidas que aún no se guardan en la DB.")
+def pending_writes_gauge():
+    return [
+        ((('queue', 'xp'),), len(xp_aggregator.pending)),
+        ((('queue', 'outbound'),), outbound.pending()),
+    ]
+
+@metrics.gauge('nexus_scheduled_actions', "Acciones programadas pendientes.")
+def scheduled_actions_gauge():
+    return [((), len(scheduler.deadlines))]
+
+
+@bot.event
+@timed_event
 async def on_message(message: discord.Message):
     """Maneja el sistema de XP y procesa comandos."""
     if message.author.bot or not message.guild:
@@ -450,32 +3095,84 @@ async def on_message(message: discord.Message):
         return
     user_id = message.author.id
     guild_id = message.guild.id
+    if (await get_config(message.guild)).get('log_channel_id'):
+        audit_cache.remember(message)
     current_time = time.time()
-    _, _, last_message_time = get_level_data(user_id, guild_id)
-    if current_time - last_message_time >= XP_COOLDOWN_SECONDS:
-        new_level, leveled_up = update_level_data(user_id, guild_id, XP_PER_MESSAGE, current_time)
-        if leveled_up:
-            await message.channel.send(f"🎉 ¡Felicidades, {message.author.mention}! Has alcanzado el Nivel **{new_level}**.")
+    new_level = await xp_aggregator.grant(user_id, guild_id, XP_PER_MESSAGE, current_time)
+    if new_level is not None:
+        # Varias subidas de nivel en la misma ventana salen en un solo mensaje (y solo la última por usuario).
+        outbound.announce(message.channel, ('level_up', user_id), f"🎉 ¡Felicidades, {message.author.mention}! Has alcanzado el Nivel **{new_level}**.")
     await bot.process_commands(message)
 
 
 @bot.event
-async def on_message_delete(message: discord.Message):
-    """Registra los mensajes eliminados en el canal de logs."""
-    if message.author.bot or not message.guild:
-        return
+@timed_event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    """Mantiene al día el contenido guardado para la auditoría."""
+    if 'content' in payload.data:
+        audit_cache.update_content(payload.message_id, payload.data['content'])
 
-    log_channel = get_log_channel(message.guild)
+
+@bot.event
+@timed_event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    """Registra los mensajes eliminados en el canal de logs, estén o no en la caché de discord.py."""
+    record = audit_cache.pop(payload.message_id)
+    if not payload.guild_id:
+        return
+    cached = payload.cached_message
+    if record is None and cached is not None and not cached.author.bot:
+        attachments = tuple(attachment.filename for attachment in cached.attachments)
+        record = AuditRecord(payload.guild_id, payload.channel_id, cached.author.id, audit_cache.truncate(cached.content), attachments)
+    if record is None:
+        return  # Mensaje de un bot, o demasiado antiguo para estar en ninguna caché.
+    guild = bot.get_guild(payload.guild_id)
+    log_channel = await get_log_channel(guild) if guild else None
     if log_channel:
         embed = discord.Embed(
             title="🗑️ Mensaje Eliminado",
-            description=f"**Autor:** {message.author.mention}\n"
-                        f"**Canal:** {message.channel.mention}\n"
-                        f"**Contenido:**\n{message.content}",
+            description=f"**Autor:** <@{record.author_id}>\n"
+                        f"**Canal:** <#{record.channel_id}>\n"
+                        f"**Contenido:**\n{describe_audit_record(record)}",
             color=discord.Color.orange(),
             timestamp=datetime.now()
         )
-        await log_channel.send(embed=embed)
+        outbound.send_embed(log_channel, embed)
+
+
+@bot.event
+@timed_event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    """Registra un borrado en lote (p. ej. una purga) como una sola entrada de log."""
+    records = [record for record in map(audit_cache.pop, payload.message_ids) if record is not None]
+    if not payload.guild_id:
+        return
+    guild = bot.get_guild(payload.guild_id)
+    log_channel = await get_log_channel(guild) if guild else None
+    if not log_channel:
+        return
+    authors: dict[int, int] = {}
+    for record in records:
+        authors[record.author_id] = authors.get(record.author_id, 0) + 1
+    top_authors = ", ".join(f"<@{author_id}> ({count})" for author_id, count in sorted(authors.items(), key=lambda item: -item[1])[:5])
+    lines = []
+    budget = AUDIT_BULK_LOG_MAX_CHARS
+    for record in records:
+        line = f"<@{record.author_id}>: {describe_audit_record(record)}".replace("\n", " ")[:200]
+        if len(line) + 1 > budget:
+            lines.append(f"… y {len(records) - len(lines)} más.")
+            break
+        lines.append(line)
+        budget -= len(line) + 1
+    embed = discord.Embed(
+        title="🗑️ Borrado en Lote",
+        description=f"**Canal:** <#{payload.channel_id}>\n"
+                    f"**Mensajes eliminados:** {len(payload.message_ids)} (con contenido guardado: {len(records)})\n"
+                    + (f"**Autores:** {top_authors}\n\n" + "\n".join(lines) if records else ""),
+        color=discord.Color.orange(),
+        timestamp=datetime.now()
+    )
+    outbound.send_embed(log_channel, embed)
 
 
 @bot.command(name="sync")
@@ -517,22 +3214,29 @@ async def sync(ctx: commands.Context, scope: Optional[str] = 'local'):
 
 
 @bot.tree.command(name='mod-ban', description='🔨 Banea a un usuario del servidor.')
-@discord.app_commands.describe(member='El usuario a banear.', reason='Razón del baneo.')
+@discord.app_commands.describe(member='El usuario a banear.', reason='Razón del baneo.', duration='Duración opcional para un baneo temporal (ej: 1h, 30m, 7d).')
 @discord.app_commands.checks.has_permissions(ban_members=True)
-async def slash_ban(interaction: discord.Interaction, member: discord.Member, reason: str = 'Sin razón especificada.'):
+async def slash_ban(interaction: discord.Interaction, member: discord.Member, reason: str = 'Sin razón especificada.', duration: Optional[str] = None):
     if member.id == interaction.user.id:
         await interaction.response.send_message(embed=create_error_embed("Error", "No puedes banearte a ti mismo."), ephemeral=True)
         return
     if member.top_role >= interaction.user.top_role and interaction.user.id != interaction.guild.owner_id:
         await interaction.response.send_message(embed=create_error_embed("Error de Jerarquía", "No puedes banear a un usuario con un rol igual o superior."), ephemeral=True)
         return
+    time_delta = parse_duration(duration) if duration else None
+    if duration and time_delta is None:
+        await interaction.response.send_message(embed=create_error_embed("Error", "Formato de duración inválido. Usa: 1d, 2h, 30m."), ephemeral=True)
+        return
     try:
         await member.ban(reason=f"Moderador: {interaction.user.name}, Razón: {reason}")
-        log_channel = get_log_channel(interaction.guild)
+        duration_str = f"\n**Duración:** {duration}" if time_delta else ""
+        if time_delta:
+            await scheduler.schedule(interaction.guild.id, member.id, 'unban', time.time() + time_delta.total_seconds())
+        log_channel = await get_log_channel(interaction.guild)
         if log_channel:
-            embed = discord.Embed(title="🔨 Usuario Baneado", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}\n**Razón:** {reason}", color=discord.Color.dark_red(), timestamp=datetime.now())
-            await log_channel.send(embed=embed)
-        await interaction.response.send_message(embed=create_success_embed("Baneado", f"{member.mention} ha sido baneado. Razón: **{reason}**"))
+            embed = discord.Embed(title="🔨 Usuario Baneado", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}{duration_str}\n**Razón:** {reason}", color=discord.Color.dark_red(), timestamp=datetime.now())
+            outbound.send_embed(log_channel, embed)
+        await interaction.response.send_message(embed=create_success_embed("Baneado", f"{member.mention} ha sido baneado. Razón: **{reason}**{duration_str}"))
     except discord.Forbidden:
         await interaction.response.send_message(embed=create_error_embed("Permiso Denegado", "No tengo permisos para banear a este usuario."), ephemeral=True)
 
@@ -547,10 +3251,11 @@ async def slash_unban(interaction: discord.Interaction, user_id: str, reason: st
         return
     try:
         await interaction.guild.unban(user, reason=f"Moderador: {interaction.user.name}, Razón: {reason}")
-        log_channel = get_log_channel(interaction.guild)
+        await scheduler.cancel(interaction.guild.id, user.id, 'unban')
+        log_channel = await get_log_channel(interaction.guild)
         if log_channel:
             embed = discord.Embed(title="🕊️ Usuario Desbaneado", description=f"**Usuario:** {user.mention} (ID: {user.id})\n**Moderador:** {interaction.user.mention}\n**Razón:** {reason}", color=discord.Color.blue(), timestamp=datetime.now())
-            await log_channel.send(embed=embed)
+            outbound.send_embed(log_channel, embed)
         await interaction.response.send_message(embed=create_success_embed("Desbaneado", f"{user.mention} ha sido desbaneado."))
     except discord.NotFound:
         await interaction.response.send_message(embed=create_error_embed("Error", "Este usuario no está baneado."), ephemeral=True)
@@ -569,10 +3274,10 @@ async def slash_kick(interaction: discord.Interaction, member: discord.Member, r
         return
     try:
         await member.kick(reason=f"Moderador: {interaction.user.name}, Razón: {reason}")
-        log_channel = get_log_channel(interaction.guild)
+        log_channel = await get_log_channel(interaction.guild)
         if log_channel:
             embed = discord.Embed(title="👟 Usuario Expulsado", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}\n**Razón:** {reason}", color=discord.Color.orange(), timestamp=datetime.now())
-            await log_channel.send(embed=embed)
+            outbound.send_embed(log_channel, embed)
         await interaction.response.send_message(embed=create_success_embed("Expulsado", f"{member.mention} ha sido expulsado. Razón: **{reason}**"))
     except discord.Forbidden:
         await interaction.response.send_message(embed=create_error_embed("Permiso Denegado", "No tengo permisos para expulsar a este usuario."), ephemeral=True)
@@ -581,62 +3286,94 @@ async def slash_kick(interaction: discord.Interaction, member: discord.Member, r
 @discord.app_commands.describe(member='El usuario a silenciar.', duration='Duración (ej: 1h, 30m, 1d).', reason='Razón del muteo.')
 @discord.app_commands.checks.has_permissions(manage_roles=True)
 async def slash_mute(interaction: discord.Interaction, member: discord.Member, duration: str, reason: str = 'Sin razón especificada.'):
-    try:
-        if 'd' in duration:
-            time_delta = timedelta(days=int(duration.replace('d', '')))
-        elif 'h' in duration:
-            time_delta = timedelta(hours=int(duration.replace('h', '')))
-        elif 'm' in duration:
-            time_delta = timedelta(minutes=int(duration.replace('m', '')))
-        else:
-            await interaction.response.send_message(embed=create_error_embed("Error", "Formato de duración inválido. Usa: 1d, 2h, 30m."), ephemeral=True)
+    if member.id == interaction.user.id:
+        await interaction.response.send_message(embed=create_error_embed("Error", "No puedes silenciarte a ti mismo."), ephemeral=True)
+        return
+    if member.top_role >= interaction.user.top_role and interaction.user.id != interaction.guild.owner_id:
+        await interaction.response.send_message(embed=create_error_embed("Error de Jerarquía", "No puedes silenciar a un usuario con un rol igual o superior."), ephemeral=True)
+        return
+    time_delta = parse_duration(duration)
+    if time_delta is None:
+        await interaction.response.send_message(embed=create_error_embed("Error", "Formato de duración inválido. Usa: 1d, 2h, 30m."), ephemeral=True)
+        return
+    config = await get_config(interaction.guild)
+    mute_mode = config.get('mute_mode') or DEFAULT_MUTE_MODE
+    if mute_mode == 'timeout':
+        # El aislamiento nativo de Discord exige Moderar miembros, no solo Gestionar roles.
+        if not interaction.permissions.moderate_members:
+            await interaction.response.send_message(embed=create_error_embed("Permiso Denegado", "Necesitas el permiso **Moderar miembros** para aislar usuarios."), ephemeral=True)
             return
-        mute_role = await create_role_if_not_exists(interaction.guild, MUTE_ROLE_NAME)
-        if mute_role in member.roles:
-            await interaction.response.send_message(embed=create_error_embed("Error", "Este usuario ya está silenciado."), ephemeral=True)
+        if time_delta > MAX_TIMEOUT_DURATION:
+            await interaction.response.send_message(embed=create_error_embed("Error", "Discord no permite aislar a alguien más de 28 días."), ephemeral=True)
             return
-        unmute_time = time.time() + time_delta.total_seconds()
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """
-                    INSERT INTO temp_mutes (user_id, guild_id, unmute_time) VALUES (%s, %s, %s)
-                    ON CONFLICT (user_id, guild_id) DO UPDATE SET unmute_time = EXCLUDED.unmute_time
-                    """,
-                    (member.id, interaction.guild.id, unmute_time)
-                )
-                conn.commit()
-        await member.add_roles(mute_role, reason=f"Muteo temporal. Moderador: {interaction.user.name}. Razón: {reason}")
-        log_channel = get_log_channel(interaction.guild)
-        if log_channel:
-            embed = discord.Embed(title="🔇 Usuario Silenciado", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}\n**Duración:** {duration}\n**Razón:** {reason}", color=discord.Color.dark_grey(), timestamp=datetime.now())
-            await log_channel.send(embed=embed)
-        await interaction.response.send_message(embed=create_success_embed("Silenciado", f"{member.mention} ha sido silenciado por **{duration}**. Razón: **{reason}**"))
+        already_muted = member.is_timed_out()
+    else:
+        mute_role = await get_mute_role(interaction.guild)
+        already_muted = mute_role is not None and mute_role in member.roles
+    if already_muted:
+        await interaction.response.send_message(embed=create_error_embed("Error", "Este usuario ya está silenciado."), ephemeral=True)
+        return
+
+    async def fail(embed: discord.Embed):
+        # El primer followup reemplazaría la respuesta pública diferida; se borra para que el error sea privado.
+        await interaction.delete_original_response()
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    # Crear el rol de silencio puede tardar más de los 3 segundos que da una interacción.
+    await interaction.response.defer()
+    audit_reason = f"Muteo temporal. Moderador: {interaction.user.name}. Razón: {reason}"
+    try:
+        if mute_mode == 'timeout':
+            await member.timeout(time_delta, reason=audit_reason)
+        else:
+            mute_role = await get_mute_role(interaction.guild, create=True)
+            await member.add_roles(mute_role, reason=audit_reason)
+            await scheduler.schedule(interaction.guild.id, member.id, 'unmute', time.time() + time_delta.total_seconds())
+    except discord.Forbidden:
+        await fail(create_error_embed("Permiso Denegado", "No tengo permisos para silenciar a este usuario."))
+        return
     except Exception as e:
+        metrics.inc('nexus_errors_total', (('where', 'mod-mute'),))
         print(f"Error al mutear: {e}")
-        await interaction.response.send_message(embed=create_error_embed("Error Fatal", f"Ocurrió un error: {e}"), ephemeral=True)
+        await fail(create_error_embed("Error Fatal", f"Ocurrió un error: {e}"))
+        return
+    log_channel = await get_log_channel(interaction.guild)
+    if log_channel:
+        embed = discord.Embed(title="🔇 Usuario Silenciado", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}\n**Duración:** {duration}\n**Razón:** {reason}", color=discord.Color.dark_grey(), timestamp=datetime.now())
+        outbound.send_embed(log_channel, embed)
+    await interaction.followup.send(embed=create_success_embed("Silenciado", f"{member.mention} ha sido silenciado por **{duration}**. Razón: **{reason}**"))
 
 @bot.tree.command(name='mod-unmute', description='🔊 Quita el silencio a un usuario.')
 @discord.app_commands.describe(member='El usuario a desmutear.')
 @discord.app_commands.checks.has_permissions(manage_roles=True)
 async def slash_unmute(interaction: discord.Interaction, member: discord.Member):
-    mute_role = discord.utils.get(interaction.guild.roles, name=MUTE_ROLE_NAME)
-    if mute_role and mute_role in member.roles:
-        try:
-            await member.remove_roles(mute_role, reason=f"Desmuteo manual. Moderador: {interaction.user.name}")
-            with get_db_connection() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("DELETE FROM temp_mutes WHERE user_id = %s AND guild_id = %s", (member.id, interaction.guild.id))
-                    conn.commit()
-            log_channel = get_log_channel(interaction.guild)
-            if log_channel:
-                embed = discord.Embed(title="🔊 Usuario Desmuteado", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}", color=discord.Color.orange(), timestamp=datetime.now())
-                await log_channel.send(embed=embed)
-            await interaction.response.send_message(embed=create_success_embed("Desmuteado", f"{member.mention} ha sido desmuteado."))
-        except discord.Forbidden:
-            await interaction.response.send_message(embed=create_error_embed("Permiso Denegado", "No tengo permisos para quitar este rol."), ephemeral=True)
-    else:
+    # Se revisan ambos modos: el servidor pudo cambiar de modo con usuarios todavía silenciados.
+    mute_role = await get_mute_role(interaction.guild)
+    has_role = mute_role is not None and mute_role in member.roles
+    if not has_role and not member.is_timed_out():
         await interaction.response.send_message(embed=create_error_embed("Error", "Este usuario no está silenciado."), ephemeral=True)
+        return
+    if member.top_role >= interaction.user.top_role and interaction.user.id != interaction.guild.owner_id:
+        await interaction.response.send_message(embed=create_error_embed("Error de Jerarquía", "No puedes desmutear a un usuario con un rol igual o superior."), ephemeral=True)
+        return
+    if member.is_timed_out() and not interaction.permissions.moderate_members:
+        await interaction.response.send_message(embed=create_error_embed("Permiso Denegado", "Necesitas el permiso **Moderar miembros** para quitar un aislamiento."), ephemeral=True)
+        return
+    audit_reason = f"Desmuteo manual. Moderador: {interaction.user.name}"
+    try:
+        if member.is_timed_out():
+            await member.timeout(None, reason=audit_reason)
+        if has_role:
+            await member.remove_roles(mute_role, reason=audit_reason)
+            await scheduler.cancel(interaction.guild.id, member.id, 'unmute')
+    except discord.Forbidden:
+        await interaction.response.send_message(embed=create_error_embed("Permiso Denegado", "No tengo permisos para quitar el silencio a este usuario."), ephemeral=True)
+        return
+    log_channel = await get_log_channel(interaction.guild)
+    if log_channel:
+        embed = discord.Embed(title="🔊 Usuario Desmuteado", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}", color=discord.Color.orange(), timestamp=datetime.now())
+        outbound.send_embed(log_channel, embed)
+    await interaction.response.send_message(embed=create_success_embed("Desmuteado", f"{member.mention} ha sido desmuteado."))
 
 @bot.tree.command(name='mod-warn', description='⚠️ Aplica una advertencia a un usuario.')
 @discord.app_commands.describe(member='El usuario a advertir.', reason='Razón de la advertencia.')
@@ -645,82 +3382,229 @@ async def slash_warn(interaction: discord.Interaction, member: discord.Member, r
     if member.bot:
         await interaction.response.send_message(embed=create_error_embed("Error", "No puedes advertir a un bot."), ephemeral=True)
         return
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO warnings (user_id, guild_id, moderator_id, reason, timestamp) VALUES (%s, %s, %s, %s, %s)",
-                (member.id, interaction.guild.id, interaction.user.id, reason, datetime.now().isoformat())
-            )
-            conn.commit()
-    log_channel = get_log_channel(interaction.guild)
+    await storage.add_warning(interaction.guild.id, member.id, interaction.user.id, reason, datetime.now(timezone.utc))
+    log_channel = await get_log_channel(interaction.guild)
     if log_channel:
         embed = discord.Embed(title="⚠️ Nueva Advertencia", description=f"**Usuario:** {member.mention}\n**Moderador:** {interaction.user.mention}\n**Razón:** {reason}", color=discord.Color.yellow(), timestamp=datetime.now())
-        await log_channel.send(embed=embed)
+        outbound.send_embed(log_channel, embed)
     await interaction.response.send_message(embed=create_success_embed("Advertencia Aplicada", f"{member.mention} ha recibido una advertencia. Razón: **{reason}**"))
 
+def create_warnings_embed(member: discord.Member, rows: list[tuple[int, int, str, datetime, str]], page: int, total: int) -> discord.Embed:
+    """Crea el embed de una página de advertencias a partir de filas (id, moderator_id, reason, timestamp, nombre del moderador)."""
+    embed = discord.Embed(title=f"📋 Advertencias de {member.display_name}", color=discord.Color.blue())
+    for warning_id, _, reason, timestamp, mod_name in rows:
+        date_str = timestamp.strftime("%d/%m/%Y %H:%M") if timestamp else "Fecha desconocida"
+        embed.add_field(
+            name=f"Advertencia ID {warning_id} ({date_str})",
+            value=f"**Moderador:** {mod_name}\n**Razón:** {reason}",
+            inline=False
+        )
+    pages = math.ceil(total / WARNINGS_PAGE_SIZE)
+    embed.set_footer(text=f"Total: {total} advertencias · Página {page + 1} de {pages}")
+    return embed
+
 @bot.tree.command(name='mod-warnings', description='📋 Muestra las advertencias de un usuario.')
 @discord.app_commands.describe(member='El usuario a consultar.')
 @discord.app_commands.checks.has_permissions(kick_members=True)
 async def slash_warnings(interaction: discord.Interaction, member: discord.Member):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT moderator_id, reason, timestamp FROM warnings WHERE user_id = %s AND guild_id = %s",
-                (member.id, interaction.guild.id)
-            )
-            results = cursor.fetchall()
-    if not results:
+    guild = interaction.guild
+    total = await storage.count_warnings(guild.id, member.id)
+    if not total:
         await interaction.response.send_message(embed=create_success_embed("Advertencias", f"{member.display_name} no tiene advertencias."), ephemeral=True)
         return
-    embed = discord.Embed(title=f"📋 Advertencias de {member.display_name}", color=discord.Color.blue())
-    for i, (mod_id, reason, timestamp) in enumerate(results):
-        mod = interaction.guild.get_member(mod_id)
-        mod_name = mod.display_name if mod else f"ID: {mod_id}"
-        date_str = datetime.fromisoformat(timestamp).strftime("%d/%m/%Y %H:%M")
-        embed.add_field(
-            name=f"Advertencia #{i+1} ({date_str})",
-            value=f"**Moderador:** {mod_name}\n**Razón:** {reason}",
-            inline=False
-        )
-    await interaction.response.send_message(embed=embed)
 
-@bot.tree.command(name='mod-clearwarnings', description='🧹 Elimina todas las advertencias de un usuario.')
-@discord.app_commands.describe(member='El usuario a limpiar.')
+    async def fetch(cursor, limit):
+        rows = await storage.get_warnings_page(guild.id, member.id, cursor, limit)
+        mod_names = await member_cache.display_names(guild, list({row[1] for row in rows}))
+        return [(*row, mod_names[row[1]]) for row in rows]
+
+    paginator = KeysetPaginator(
+        interaction.user.id,
+        fetch=fetch,
+        render=lambda rows, page: create_warnings_embed(member, rows, page, total),
+        cursor_of=lambda row: row[0],
+        page_size=WARNINGS_PAGE_SIZE
+    )
+    embed = await paginator.load(0)
+    if embed is None:  # Se borraron entre el conteo y la consulta.
+        await interaction.response.send_message(embed=create_success_embed("Advertencias", f"{member.display_name} no tiene advertencias."), ephemeral=True)
+        return
+    if paginator.has_next:
+        await interaction.response.send_message(embed=embed, view=paginator)
+        paginator.message = await interaction.original_response()
+    else:
+        await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name='mod-clearwarnings', description='🧹 Elimina advertencias de un usuario (todas, por antigüedad o por rango de IDs).')
+@discord.app_commands.describe(
+    member='El usuario a limpiar.',
+    older_than='Solo advertencias más antiguas que esto (ej: 30d, 12h).',
+    from_id='Solo advertencias con ID desde este valor (incluido).',
+    to_id='Solo advertencias con ID hasta este valor (incluido).'
+)
 @discord.app_commands.checks.has_permissions(administrator=True)
-async def slash_clearwarnings(interaction: discord.Interaction, member: discord.Member):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM warnings WHERE user_id = %s AND guild_id = %s",
-                (member.id, interaction.guild.id)
-            )
-            conn.commit()
-    await interaction.response.send_message(embed=create_success_embed("Advertencias Eliminadas", f"Se han eliminado todas las advertencias de {member.mention}."))
+async def slash_clearwarnings(interaction: discord.Interaction, member: discord.Member, older_than: Optional[str] = None,
+                              from_id: Optional[int] = None, to_id: Optional[int] = None):
+    before = None
+    filters = []
+    if older_than is not None:
+        age = parse_duration(older_than)
+        if age is None:
+            await interaction.response.send_message(embed=create_error_embed("Error", "Formato de antigüedad inválido. Usa: 30d, 12h, 45m."), ephemeral=True)
+            return
+        before = datetime.now(timezone.utc) - age
+        filters.append(f"con más de {older_than} de antigüedad")
+    if from_id is not None or to_id is not None:
+        filters.append(f"con ID entre {from_id if from_id is not None else 'el inicio'} y {to_id if to_id is not None else 'el final'}")
+    deleted = await storage.delete_warnings(interaction.guild.id, member.id, before, from_id, to_id)
+    scope = " " + " y ".join(filters) if filters else ""
+    await interaction.response.send_message(embed=create_success_embed("Advertencias Eliminadas", f"Se han eliminado **{deleted}** advertencias{scope} de {member.mention}."))
+
+BULK_DELETE_MAX_AGE = timedelta(days=14)  # Discord rechaza el borrado en lote de mensajes más antiguos.
+
+async def purge_messages(channel: discord.TextChannel, amount: int, check: Callable[[discord.Message], bool],
+                         before: Optional[discord.Object], after: Optional[discord.Object], include_old: bool,
+                         progress: Callable[[int, int], Awaitable[None]]) -> tuple[int, int, bool]:
+    """
+    Recorre el historial del canal (del más nuevo al más viejo) y borra hasta `amount` mensajes que cumplan `check`.
+
+    Solo se mantiene en memoria el lote actual de como mucho 100 mensajes, que se borra con un único bulk delete.
+    Los mensajes con más de 14 días se borran uno por uno si `include_old`; si no, el recorrido termina al
+    llegar a ellos, porque todo lo que sigue es aún más antiguo. Retorna (borrados, revisados, si se omitieron antiguos).
+    """
+    deleted = scanned = 0
+    skipped_old = False
+    batch: list[discord.Message] = []
+    cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE + timedelta(minutes=1)
+
+    async def flush():
+        nonlocal deleted, batch
+        if batch:
+            await channel.delete_messages(batch, reason="Purga de mensajes.")
+            deleted += len(batch)
+            batch = []
+            await progress(deleted, scanned)
 
-@bot.tree.command(name='mod-purge', description='🗑️ Elimina una cantidad específica de mensajes en el canal actual.')
-@discord.app_commands.describe(amount='Cantidad de mensajes a eliminar (máximo 100).')
+    # Con `after`, discord.py recorre del más viejo al más nuevo salvo que se indique lo contrario.
+    async for message in channel.history(limit=PURGE_SCAN_LIMIT, before=before, after=after, oldest_first=False):
+        if deleted + len(batch) >= amount:
+            break
+        scanned += 1
+        if not check(message):
+            continue
+        if message.created_at < cutoff:
+            if not include_old:
+                skipped_old = True
+                break
+            await flush()
+            try:
+                await message.delete()
+                deleted += 1
+            except discord.NotFound:
+                pass
+            await progress(deleted, scanned)
+            continue
+        batch.append(message)
+        if len(batch) == 100:
+            await flush()
+    await flush()
+    return deleted, scanned, skipped_old
+
+def _parse_message_id(value: Optional[str]) -> Optional[discord.Object]:
+    if value is None:
+        return None
+    value = value.strip().rsplit('/', 1)[-1]  # Acepta la ID o el enlace del mensaje.
+    return discord.Object(id=int(value)) if value.isdigit() else ...
+
+@bot.tree.command(name='mod-purge', description='🗑️ Elimina mensajes del canal actual, con filtros opcionales.')
+@discord.app_commands.describe(
+    amount=f'Cantidad máxima de mensajes a eliminar (hasta {PURGE_MAX_AMOUNT}).',
+    member='Solo mensajes de este usuario.',
+    bots_only='Solo mensajes de bots.',
+    contains='Solo mensajes que contengan este texto.',
+    attachments_only='Solo mensajes con archivos adjuntos.',
+    before='Solo mensajes anteriores a este (ID o enlace).',
+    after='Solo mensajes posteriores a este (ID o enlace).',
+    include_old='Borrar también mensajes de más de 14 días, uno por uno (lento).'
+)
 @discord.app_commands.checks.has_permissions(manage_messages=True)
-async def slash_purge(interaction: discord.Interaction, amount: int):
-    if amount <= 0 or amount > 100:
-        await interaction.response.send_message(embed=create_error_embed("Error", "Debes especificar una cantidad entre 1 y 100."), ephemeral=True)
+async def slash_purge(interaction: discord.Interaction, amount: int, member: Optional[discord.Member] = None,
+                      bots_only: bool = False, contains: Optional[str] = None, attachments_only: bool = False,
+                      before: Optional[str] = None, after: Optional[str] = None, include_old: bool = False):
+    if amount <= 0 or amount > PURGE_MAX_AMOUNT:
+        await interaction.response.send_message(embed=create_error_embed("Error", f"Debes especificar una cantidad entre 1 y {PURGE_MAX_AMOUNT}."), ephemeral=True)
         return
+    before_obj, after_obj = _parse_message_id(before), _parse_message_id(after)
+    if before_obj is ... or after_obj is ...:
+        await interaction.response.send_message(embed=create_error_embed("Error", "`before` y `after` deben ser la ID o el enlace de un mensaje."), ephemeral=True)
+        return
+    needle = contains.lower() if contains else None
+
+    def check(message: discord.Message) -> bool:
+        if message.pinned:
+            return False
+        if member and message.author.id != member.id:
+            return False
+        if bots_only and not message.author.bot:
+            return False
+        if needle and needle not in message.content.lower():
+            return False
+        if attachments_only and not message.attachments:
+            return False
+        return True
+
     await interaction.response.defer(ephemeral=True)
-    deleted = await interaction.channel.purge(limit=amount)
-    embed = create_success_embed("Mensajes Eliminados", f"Se han eliminado **{len(deleted)}** mensajes en {interaction.channel.mention}.")
-    await interaction.followup.send(embed=embed, ephemeral=False, delete_after=5)
+    last_update = 0.0
+    token_expired = False
+
+    async def report(embed: discord.Embed):
+        # Con include_old la purga puede durar más que los 15 minutos del token de la interacción.
+        nonlocal token_expired
+        if not token_expired:
+            try:
+                await interaction.edit_original_response(embed=embed)
+                return
+            except discord.HTTPException:
+                token_expired = True
+        try:
+            await interaction.channel.send(content=interaction.user.mention, embed=embed)
+        except discord.HTTPException as e:
+            print(f"No se pudo informar el resultado de la purga en el canal {interaction.channel.id}: {e}")
+
+    async def progress(deleted: int, scanned: int):
+        nonlocal last_update, token_expired
+        if token_expired or time.monotonic() - last_update < PURGE_PROGRESS_INTERVAL_SECONDS:
+            return
+        last_update = time.monotonic()
+        try:
+            await interaction.edit_original_response(embed=discord.Embed(
+                title="🗑️ Purgando...",
+                description=f"Eliminados **{deleted}** de {amount} mensajes (revisados: {scanned}).",
+                color=discord.Color.orange()
+            ))
+        except discord.HTTPException:
+            token_expired = True  # Se sigue purgando; el resultado se envía al canal.
+
+    try:
+        deleted, scanned, skipped_old = await purge_messages(interaction.channel, amount, check, before_obj, after_obj, include_old, progress)
+    except discord.Forbidden:
+        await report(create_error_embed("Permiso Denegado", "No tengo permisos para borrar mensajes en este canal."))
+        return
+    summary = f"Se han eliminado **{deleted}** mensajes en {interaction.channel.mention} (revisados: {scanned})."
+    if skipped_old:
+        summary += "\nSe omitieron los mensajes de más de 14 días; usa `include_old` para borrarlos uno por uno."
+    await report(create_success_embed("Mensajes Eliminados", summary))
+    log_channel = await get_log_channel(interaction.guild)
+    if log_channel:
+        embed = discord.Embed(title="🗑️ Purga de Mensajes", description=f"**Canal:** {interaction.channel.mention}\n**Moderador:** {interaction.user.mention}\n**Eliminados:** {deleted}", color=discord.Color.orange(), timestamp=datetime.now())
+        outbound.send_embed(log_channel, embed)
 
 
 @bot.tree.command(name='admin-setlogs', description='⚙️ Configura el canal para los logs de moderación.')
 @discord.app_commands.describe(channel='El canal de texto para enviar los logs.')
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def slash_setlogs(interaction: discord.Interaction, channel: discord.TextChannel):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO config (guild_id, log_channel_id) VALUES (%s, %s) ON CONFLICT (guild_id) DO UPDATE SET log_channel_id = EXCLUDED.log_channel_id",
-                (interaction.guild.id, channel.id)
-            )
-            conn.commit()
+    await update_config(interaction.guild.id, log_channel_id=channel.id)
     await interaction.response.send_message(embed=create_success_embed("Logs Configurados", f"El canal de logs ha sido configurado a {channel.mention}."), ephemeral=True)
 
 @bot.tree.command(name='admin-setreport', description='🚨 Configura el canal y rol para el sistema de reportes.')
@@ -728,13 +3612,7 @@ async def slash_setlogs(interaction: discord.Interaction, channel: discord.TextC
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def slash_setreport(interaction: discord.Interaction, channel: discord.TextChannel, role: discord.Role = None):
     role_id = role.id if role else None
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO config (guild_id, report_channel_id, report_role_id) VALUES (%s, %s, %s) ON CONFLICT (guild_id) DO UPDATE SET report_channel_id = EXCLUDED.report_channel_id, report_role_id = EXCLUDED.report_role_id",
-                (interaction.guild.id, channel.id, role_id)
-            )
-            conn.commit()
+    await update_config(interaction.guild.id, report_channel_id=channel.id, report_role_id=role_id)
     role_mention = role.mention if role else "ninguno"
     await interaction.response.send_message(embed=create_success_embed("Reportes Configurados", f"El canal de reportes es {channel.mention} y el rol a mencionar es {role_mention}."), ephemeral=True)
 
@@ -742,19 +3620,27 @@ async def slash_setreport(interaction: discord.Interaction, channel: discord.Tex
 @discord.app_commands.describe(role='El rol a asignar automáticamente.')
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def slash_setautorole(interaction: discord.Interaction, role: discord.Role):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO config (guild_id, autorole_id) VALUES (%s, %s) ON CONFLICT (guild_id) DO UPDATE SET autorole_id = EXCLUDED.autorole_id",
-                (interaction.guild.id, role.id)
-            )
-            conn.commit()
+    await update_config(interaction.guild.id, autorole_id=role.id)
     await interaction.response.send_message(embed=create_success_embed("Auto-Rol Configurado", f"El rol de bienvenida es ahora **{role.name}**."), ephemeral=True)
 
+@bot.tree.command(name='admin-setmutemode', description='🔇 Elige cómo silencia /mod-mute: aislamiento nativo o rol.')
+@discord.app_commands.describe(mode="'timeout' usa el aislamiento de Discord; 'role' usa el rol de silencio.")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def slash_setmutemode(interaction: discord.Interaction, mode: Literal['timeout', 'role']):
+    await update_config(interaction.guild.id, mute_mode=mode)
+    if mode == 'role':
+        await interaction.response.defer(ephemeral=True)
+        mute_role = await get_mute_role(interaction.guild, create=True)
+        failed = await apply_mute_overwrites(interaction.guild, mute_role)
+        note = f" No se pudieron configurar {failed} canales (revisa mis permisos)." if failed else ""
+        await interaction.followup.send(embed=create_success_embed("Modo de Silencio", f"/mod-mute usará el rol **{mute_role.name}**.{note}"), ephemeral=True)
+        return
+    await interaction.response.send_message(embed=create_success_embed("Modo de Silencio", "/mod-mute usará el aislamiento nativo de Discord."), ephemeral=True)
+
 @bot.tree.command(name='report', description='🗣️ Reporta a un usuario o mensaje a los moderadores.')
 @discord.app_commands.describe(member='El usuario a reportar.', reason='Razón del reporte.')
 async def slash_report(interaction: discord.Interaction, member: discord.Member, reason: str):
-    report_channel, report_role = get_report_config(interaction.guild)
+    report_channel, report_role = await get_report_config(interaction.guild)
     if not report_channel:
         await interaction.response.send_message(embed=create_error_embed("Error", "El canal de reportes no ha sido configurado. Pídele a un admin que use `/admin-setreport`."), ephemeral=True)
         return
@@ -781,84 +3667,87 @@ async def marry(ctx, member: discord.Member):
     if user1_id == user2_id or member.bot:
         await ctx.send(embed=create_error_embed("Error", "No puedes casarte contigo mismo o con un bot."), delete_after=10)
         return
-    if get_partner(user1_id, guild_id) or get_partner(user2_id, guild_id):
+    if interactions.has_pending(guild_id, user1_id, 'marry'):
+        await ctx.send(embed=create_error_embed("Error", "Ya tienes una propuesta de matrimonio pendiente."), delete_after=10)
+        return
+    if await marriages.get(guild_id, user1_id) or await marriages.get(guild_id, user2_id):
         await ctx.send(embed=create_error_embed("Error", "Uno de los usuarios ya está casado."), delete_after=10)
         return
     embed = discord.Embed(
         title="💍 Propuesta de Matrimonio",
-        description=f"{member.mention}, **{ctx.author.display_name}** te ha propuesto matrimonio.\n\nReacciona con **✅** para aceptar o **❌** para rechazar.",
+        description=f"{member.mention}, **{ctx.author.display_name}** te ha propuesto matrimonio.\n\nPulsa **Aceptar** o **Rechazar**.",
         color=discord.Color.light_grey()
     )
-    message = await ctx.send(content=member.mention, embed=embed)
-    await message.add_reaction("✅")
-    await message.add_reaction("❌")
-    def check(reaction, user):
-        return user.id == user2_id and str(reaction.emoji) in ["✅", "❌"] and reaction.message.id == message.id
-    try:
-        reaction, _ = await bot.wait_for('reaction_add', timeout=60.0, check=check)
-    except asyncio.TimeoutError:
-        await message.edit(embed=create_error_embed("Propuesta Expirada", "La propuesta de matrimonio ha expirado."), content=None)
-        await message.clear_reactions()
-        return
-    if str(reaction.emoji) == "✅":
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                u1, u2 = sorted([user1_id, user2_id])
-                cursor.execute("INSERT INTO marriages (user1_id, user2_id, guild_id, marriage_date) VALUES (%s, %s, %s, %s)", 
-                               (u1, u2, guild_id, datetime.now().isoformat()))
-                conn.commit()
-        await message.edit(embed=create_success_embed("¡BODAS!", f"**{ctx.author.display_name}** y **{member.display_name}** ¡se han casado! 🎉"), content=f"{ctx.author.mention} {member.mention}")
-        await message.clear_reactions()
-    else:
-        await message.edit(embed=create_error_embed("Propuesta Rechazada", f"**{member.display_name}** ha rechazado la propuesta de matrimonio."), content=None)
-        await message.clear_reactions()
+    message = await ctx.send(content=member.mention, embed=embed, view=interactions.views['marry'])
+    await interactions.open(message, 'marry', author_id=user1_id, target_id=user2_id, responder_id=user2_id, timeout=MARRY_PROPOSAL_TIMEOUT_SECONDS)
+
+@interactions.handler(
+    'marry',
+    buttons=(('accept', "Aceptar", "✅", discord.ButtonStyle.success), ('reject', "Rechazar", "❌", discord.ButtonStyle.danger)),
+    expired=("Propuesta Expirada", "La propuesta de matrimonio ha expirado.")
+)
+async def resolve_marry(interaction: discord.Interaction, pending: PendingInteraction, choice: str):
+    if choice == 'reject':
+        await interaction.response.edit_message(embed=create_error_embed("Propuesta Rechazada", f"**{interaction.user.display_name}** ha rechazado la propuesta de matrimonio."), content=None, view=None)
+        return
+    if not await marriages.marry(pending.guild_id, pending.author_id, pending.target_id):
+        await interaction.response.edit_message(embed=create_error_embed("Error", "Uno de los usuarios se casó mientras la propuesta estaba pendiente."), content=None, view=None)
+        return
+    author_name = await member_cache.display_name(interaction.guild, pending.author_id, "Usuario con ID {}")
+    await interaction.response.edit_message(
+        embed=create_success_embed("¡BODAS!", f"**{author_name}** y **{interaction.user.display_name}** ¡se han casado! 🎉"),
+        content=f"<@{pending.author_id}> {interaction.user.mention}",
+        view=None
+    )
 
 @bot.hybrid_command(name='divorce', description="Inicia el proceso de divorcio.")
 async def divorce(ctx):
     user_id = ctx.author.id
     guild_id = ctx.guild.id
-    partner_id = get_partner(user_id, guild_id)
-    if not partner_id:
+    if interactions.has_pending(guild_id, user_id, 'divorce'):
+        await ctx.send(embed=create_error_embed("Error", "Ya tienes una solicitud de divorcio pendiente."), delete_after=10)
+        return
+    marriage = await marriages.get(guild_id, user_id)
+    if not marriage:
         await ctx.send(embed=create_error_embed("Error", "No estás casado con nadie."), delete_after=10)
         return
-    partner = ctx.guild.get_member(partner_id)
-    partner_name = partner.display_name if partner else f"Usuario con ID {partner_id}"
+    partner_id, _ = marriage
+    partner_name = await member_cache.display_name(ctx.guild, partner_id, "Usuario con ID {}")
     embed = discord.Embed(
         title="💔 Solicitud de Divorcio",
-        description=f"¿Estás seguro de que quieres divorciarte de **{partner_name}**?\n\nReacciona con **💔** para confirmar el divorcio.",
+        description=f"¿Estás seguro de que quieres divorciarte de **{partner_name}**?\n\nPulsa **Divorciarse** para confirmar.",
         color=discord.Color.red()
     )
-    message = await ctx.send(embed=embed)
-    await message.add_reaction("💔")
-    def check(reaction, user):
-        return user.id == user_id and str(reaction.emoji) == "💔" and reaction.message.id == message.id
-    try:
-        await bot.wait_for('reaction_add', timeout=20.0, check=check)
-    except asyncio.TimeoutError:
-        await message.edit(embed=create_error_embed("Confirmación Expirada", "La solicitud de divorcio ha expirado."), content=None)
-        await message.clear_reactions()
+    message = await ctx.send(embed=embed, view=interactions.views['divorce'])
+    await interactions.open(message, 'divorce', author_id=user_id, target_id=partner_id, responder_id=user_id, timeout=DIVORCE_CONFIRM_TIMEOUT_SECONDS)
+
+@interactions.handler(
+    'divorce',
+    buttons=(('confirm', "Divorciarse", "💔", discord.ButtonStyle.danger), ('cancel', "Cancelar", None, discord.ButtonStyle.secondary)),
+    expired=("Confirmación Expirada", "La solicitud de divorcio ha expirado.")
+)
+async def resolve_divorce(interaction: discord.Interaction, pending: PendingInteraction, choice: str):
+    if choice == 'cancel':
+        await interaction.response.edit_message(embed=create_success_embed("Divorcio Cancelado", "Sigues casado(a). ❤️"), content=None, view=None)
         return
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            u1, u2 = sorted([user_id, partner_id])
-            cursor.execute("DELETE FROM marriages WHERE user1_id = %s AND user2_id = %s AND guild_id = %s", (u1, u2, guild_id))
-            conn.commit()
-    await message.edit(embed=create_success_embed("Divorcio Consumado", f"**{ctx.author.display_name}** se ha divorciado de **{partner_name}**. ¡Libertad!"), content=None)
-    await message.clear_reactions()
+    partner_id = await marriages.divorce(pending.guild_id, pending.author_id)
+    if partner_id is None:
+        await interaction.response.edit_message(embed=create_error_embed("Error", "Ya no estás casado con nadie."), content=None, view=None)
+        return
+    partner_name = await member_cache.display_name(interaction.guild, partner_id, "Usuario con ID {}")
+    await interaction.response.edit_message(embed=create_success_embed("Divorcio Consumado", f"**{interaction.user.display_name}** se ha divorciado de **{partner_name}**. ¡Libertad!"), content=None, view=None)
 
 @bot.hybrid_command(name='spouse', aliases=['wife', 'husband'], description="Muestra con quién estás casado.")
 async def spouse(ctx):
     user_id = ctx.author.id
     guild_id = ctx.guild.id
-    data = get_marriage_data(user_id, guild_id)
+    data = await marriages.get(guild_id, user_id)
     if not data:
         await ctx.send(embed=create_error_embed("Matrimonio", "No estás casado con nadie."), delete_after=10)
         return
-    _, _, date_str = data
-    partner_id = data[1] if data[0] == user_id else data[0]
-    partner = ctx.guild.get_member(partner_id)
-    partner_name = partner.display_name if partner else f"ID: {partner_id}"
-    marriage_date = datetime.fromisoformat(date_str).strftime("%d de %B de %Y")
+    partner_id, date = data
+    partner_name = await member_cache.display_name(ctx.guild, partner_id)
+    marriage_date = date.strftime("%d de %B de %Y") if date else "Desconocida"
     embed = discord.Embed(
         title=f"❤️ Matrimonio de {ctx.author.display_name}",
         description=f"Estás casado(a) con **{partner_name}**.",
@@ -886,7 +3775,7 @@ async def invite(ctx: commands.Context):
 @bot.hybrid_command(name='balance', aliases=['bal'], description="Muestra tu saldo o el de otro usuario.")
 async def balance(ctx, member: discord.Member = None):
     member = member or ctx.author
-    balance = get_balance(member.id, ctx.guild.id)
+    balance = await get_balance(member.id, ctx.guild.id)
     embed = discord.Embed(
         title="🏦 Saldo Bancario",
         description=f"El saldo de **{member.display_name}** es de **{balance} 💰**.",
@@ -895,42 +3784,66 @@ async def balance(ctx, member: discord.Member = None):
     await ctx.send(embed=embed)
 
 
+def create_transactions_embed(member: discord.Member, rows: list[tuple[int, int, str, datetime]], page: int, snapshot: Optional[tuple[int, int, int, datetime]]) -> discord.Embed:
+    """Crea el embed de una página del historial de movimientos."""
+    lines = []
+    for _, delta, reason, created_at in rows:
+        sign = "+" if delta >= 0 else "−"
+        lines.append(f"<t:{int(created_at.timestamp())}:R> **{sign}{abs(delta)} 💰** · {LEDGER_REASONS.get(reason, reason)}")
+    embed = discord.Embed(
+        title=f"📒 Movimientos de {member.display_name}",
+        description="\n".join(lines),
+        color=discord.Color.gold()
+    )
+    if snapshot:
+        balance, compacted_delta, compacted_entries, taken_at = snapshot
+        embed.add_field(
+            name="Historial compactado",
+            value=f"{compacted_entries} movimientos anteriores (neto **{compacted_delta:+} 💰**), saldo de **{balance} 💰** al compactar.",
+            inline=False
+        )
+    embed.set_footer(text=f"Página {page + 1}")
+    return embed
+
+@bot.hybrid_command(name='transactions', aliases=['tx'], description="Muestra el historial de movimientos de dinero.")
+async def transactions(ctx, member: discord.Member = None):
+    member = member or ctx.author
+    snapshot = await storage.get_ledger_snapshot(ctx.guild.id, member.id)
+    paginator = KeysetPaginator(
+        ctx.author.id,
+        fetch=lambda cursor, limit: storage.get_ledger_page(ctx.guild.id, member.id, cursor, limit),
+        render=lambda rows, page: create_transactions_embed(member, rows, page, snapshot),
+        cursor_of=lambda row: row[0],
+        page_size=TRANSACTIONS_PAGE_SIZE
+    )
+    embed = await paginator.load(0)
+    if embed is None:
+        await ctx.send(embed=create_error_embed("Error", f"**{member.display_name}** no tiene movimientos registrados."), delete_after=10)
+        return
+    if paginator.has_next:
+        paginator.message = await ctx.send(embed=embed, view=paginator)
+    else:
+        await ctx.send(embed=embed)
+
+
 @bot.hybrid_command(name='daily', description="Reclama tu recompensa diaria.")
 async def daily(ctx):
-    user_id = ctx.author.id
-    guild_id = ctx.guild.id
-    last_daily = get_last_action_time(user_id, guild_id, 'daily')
-    cooldown = ECONOMY_COOLDOWN_DAILY_HOURS * 3600
-    current_time = time.time()
-    if current_time - last_daily < cooldown:
-        remaining_seconds = cooldown - (current_time - last_daily)
-        remaining_hours = int(remaining_seconds // 3600)
-        remaining_minutes = int((remaining_seconds % 3600) // 60)
-        await ctx.send(embed=create_error_embed("En Cooldown", f"Debes esperar **{remaining_hours}h {remaining_minutes}m** para reclamar tu próxima recompensa diaria."), delete_after=10)
-        return
-    update_balance(user_id, guild_id, DAILY_REWARD)
-    set_last_action_time(user_id, guild_id, 'daily')
+    remaining, _ = await cooldowns.claim(ctx.author.id, ctx.guild.id, 'daily', DAILY_REWARD)
+    if remaining:
+        await ctx.send(embed=create_error_embed("En Cooldown", f"Debes esperar **{format_cooldown(remaining)}** para reclamar tu próxima recompensa diaria."), delete_after=10)
+        return
     await ctx.send(embed=create_success_embed("Recompensa Diaria", f"Has reclamado tu recompensa diaria de **{DAILY_REWARD} 💰**."))
 
 
 @bot.hybrid_command(name='work', description="Trabaja para ganar dinero.")
 async def work(ctx):
-    user_id = ctx.author.id
-    guild_id = ctx.guild.id
-    last_work = get_last_action_time(user_id, guild_id, 'work')
-    cooldown = ECONOMY_COOLDOWN_WORK_HOURS * 3600
-    current_time = time.time()
-    if current_time - last_work < cooldown:
-        remaining_seconds = cooldown - (current_time - last_work)
-        remaining_hours = int(remaining_seconds // 3600)
-        remaining_minutes = int((remaining_seconds % 3600) // 60)
-        await ctx.send(embed=create_error_embed("En Cooldown", f"Debes esperar **{remaining_hours}h {remaining_minutes}m** para volver a trabajar."), delete_after=10)
-        return
     earnings = random.randint(100, 300)
+    remaining, _ = await cooldowns.claim(ctx.author.id, ctx.guild.id, 'work', earnings)
+    if remaining:
+        await ctx.send(embed=create_error_embed("En Cooldown", f"Debes esperar **{format_cooldown(remaining)}** para volver a trabajar."), delete_after=10)
+        return
     jobs = ["programar código", "servir café", "pasear perros", "reparar computadoras", "diseñar logos"]
     job = random.choice(jobs)
-    update_balance(user_id, guild_id, earnings)
-    set_last_action_time(user_id, guild_id, 'work')
     await ctx.send(embed=create_success_embed("Trabajo Realizado", f"Fuiste a **{job}** y ganaste **{earnings} 💰**."))
 
 
@@ -943,18 +3856,14 @@ async def flip(ctx, side: str, amount: int):
     if amount <= 0:
         await ctx.send(embed=create_error_embed("Error", "La cantidad debe ser positiva."), delete_after=10)
         return
-    user_balance = get_balance(ctx.author.id, ctx.guild.id)
-    if user_balance < amount:
+    result = random.choice(['cara', 'cruz'])
+    new_balance = await update_balance(ctx.author.id, ctx.guild.id, amount if result == side else -amount, 'flip', required=amount)
+    if new_balance is None:
         await ctx.send(embed=create_error_embed("Error", "No tienes suficiente dinero."), delete_after=10)
         return
-    result = random.choice(['cara', 'cruz'])
     if result == side:
-        update_balance(ctx.author.id, ctx.guild.id, amount)
-        new_balance = user_balance + amount
         await ctx.send(embed=create_success_embed("¡Ganaste!", f"Salió **{result}**. ¡Ganaste **{amount} 💰**! Saldo: {new_balance} 💰"))
     else:
-        update_balance(ctx.author.id, ctx.guild.id, -amount)
-        new_balance = user_balance - amount
         await ctx.send(embed=create_error_embed("Perdiste", f"Salió **{result}**. Perdiste **{amount} 💰**. Saldo: {new_balance} 💰"))
 
 
@@ -963,25 +3872,22 @@ async def slots(ctx, amount: int):
     if amount <= 0:
         await ctx.send(embed=create_error_embed("Error", "La cantidad debe ser positiva."), delete_after=10)
         return
-    user_balance = get_balance(ctx.author.id, ctx.guild.id)
-    if user_balance < amount:
-        await ctx.send(embed=create_error_embed("Error", "No tienes suficiente dinero."), delete_after=10)
-        return
     emojis = ["🍒", "🍇", "🍋", "7️⃣"]
     results = [random.choice(emojis) for _ in range(3)]
     slot_display = f"| **{' | '.join(results)}** |"
     if results[0] == results[1] == results[2]:
         winnings = amount * 7
-        update_balance(ctx.author.id, ctx.guild.id, winnings)
         embed = create_success_embed("¡JACKPOT! 🎰🎰🎰", f"{slot_display}\n¡Ganaste **{winnings} 💰**! (x7)")
     elif results[0] == results[1] or results[1] == results[2]:
         winnings = amount * 2
-        update_balance(ctx.author.id, ctx.guild.id, winnings)
         embed = create_success_embed("¡Doble! 🎰🎰", f"{slot_display}\n¡Ganaste **{winnings} 💰**! (x2)")
     else:
-        update_balance(ctx.author.id, ctx.guild.id, -amount)
+        winnings = -amount
         embed = create_error_embed("Perdiste 💸", f"{slot_display}\nPerdiste **{amount} 💰**.")
-    new_balance = get_balance(ctx.author.id, ctx.guild.id)
+    new_balance = await update_balance(ctx.author.id, ctx.guild.id, winnings, 'slots', required=amount)
+    if new_balance is None:
+        await ctx.send(embed=create_error_embed("Error", "No tienes suficiente dinero."), delete_after=10)
+        return
     embed.set_footer(text=f"Saldo actual: {new_balance} 💰")
     await ctx.send(embed=embed)
 
@@ -994,46 +3900,42 @@ async def rob(ctx, member: discord.Member):
     if user_id == target_id or member.bot:
         await ctx.send(embed=create_error_embed("Error", "No puedes robarte a ti mismo o a un bot."), delete_after=10)
         return
-    last_rob = get_last_action_time(user_id, guild_id, 'rob')
-    cooldown = 2 * 3600
-    current_time = time.time()
-    if current_time - last_rob < cooldown:
-        remaining_seconds = cooldown - (current_time - last_rob)
-        remaining_hours = int(remaining_seconds // 3600)
-        remaining_minutes = int((remaining_seconds % 3600) // 60)
-        await ctx.send(embed=create_error_embed("En Cooldown", f"Debes esperar **{remaining_hours}h {remaining_minutes}m** para volver a robar."), delete_after=10)
+    remaining = cooldowns.remaining(user_id, guild_id, 'rob')
+    if remaining:
+        await ctx.send(embed=create_error_embed("En Cooldown", f"Debes esperar **{format_cooldown(remaining)}** para volver a robar."), delete_after=10)
         return
-    target_balance = get_balance(target_id, guild_id)
+    target_balance = await get_balance(target_id, guild_id)
     if target_balance < 1000:
         await ctx.send(embed=create_error_embed("Pobreza", f"{member.display_name} es demasiado pobre para ser robado (necesita al menos 1000 💰)."), delete_after=10)
         return
-    set_last_action_time(user_id, guild_id, 'rob')
+    remaining, _ = await cooldowns.claim(user_id, guild_id, 'rob')
+    if remaining:
+        await ctx.send(embed=create_error_embed("En Cooldown", f"Debes esperar **{format_cooldown(remaining)}** para volver a robar."), delete_after=10)
+        return
     if random.random() < 0.4:
         rob_amount = int(target_balance * random.uniform(0.1, 0.3))
-        update_balance(user_id, guild_id, rob_amount)
-        update_balance(target_id, guild_id, -rob_amount)
+        if await transfer_balance(guild_id, target_id, user_id, rob_amount, 'rob') is None:
+            await ctx.send(embed=create_error_embed("Pobreza", f"{member.display_name} ya no tiene suficiente dinero para ser robado."), delete_after=10)
+            return
         await ctx.send(embed=create_success_embed("¡Robo Exitoso! 😈", f"Le robaste **{rob_amount} 💰** a {member.display_name}. ¡Huye!"))
     else:
         fine = random.randint(100, 500)
-        update_balance(user_id, guild_id, -fine)
+        await update_balance(user_id, guild_id, -fine, 'rob')
         await ctx.send(embed=create_error_embed("¡Atrapado! 🚨", f"Fuiste atrapado intentando robar a {member.display_name}. Tuviste que pagar una multa de **{fine} 💰**."))
 
 
 
 
-def get_leaderboard_data(guild_id):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT user_id, xp, level FROM leveling WHERE guild_id = %s ORDER BY level DESC, xp DESC LIMIT 10",
-                (guild_id,)
-            )
-            return cursor.fetchall()
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_SOURCES = {
+    'levels': ('leveling', 'total_xp'),
+    'balance': ('economy', 'balance'),
+}
 
 @bot.hybrid_command(name='rank', description="Muestra tu nivel y XP o el de otro usuario.")
 async def rank(ctx, member: discord.Member = None):
     member = member or ctx.author
-    xp, level, _ = get_level_data(member.id, ctx.guild.id)
+    xp, level, _ = xp_aggregator.peek(member.id, ctx.guild.id) or await get_level_data(member.id, ctx.guild.id)
     xp_needed_next = get_xp_needed(level)
     embed = discord.Embed(
         title=f"📊 Rango de {member.display_name}",
@@ -1044,28 +3946,49 @@ async def rank(ctx, member: discord.Member = None):
     await ctx.send(embed=embed)
 
 
-@bot.hybrid_command(name='leaderboard', aliases=['top'], description="Muestra la tabla de clasificación de niveles.")
-async def leaderboard(ctx):
-    top_users = get_leaderboard_data(ctx.guild.id)
-    if not top_users:
-        await ctx.send(embed=create_error_embed("Error", "No hay datos de nivelación para mostrar."), delete_after=10)
-        return
+def create_leaderboard_embed(mode: str, rows: list[tuple[int, int, str]], page: int) -> discord.Embed:
+    """Crea el embed de una página de la tabla de clasificación a partir de filas (user_id, puntuación, nombre)."""
     description = []
-    for i, (user_id, xp, level) in enumerate(top_users):
-        member = ctx.guild.get_member(user_id)
-        name = member.display_name if member else f"ID: {user_id}"
+    for i, (user_id, score, name) in enumerate(rows, start=page * LEADERBOARD_PAGE_SIZE):
         rank_emoji = ""
         if i == 0: rank_emoji = "🥇"
         elif i == 1: rank_emoji = "🥈"
         elif i == 2: rank_emoji = "🥉"
         else: rank_emoji = f"#{i+1}"
-        description.append(f"{rank_emoji} **{name}** - Nivel **{level}** (XP: {xp})")
+        if mode == 'balance':
+            description.append(f"{rank_emoji} **{name}** - **{score} 💰**")
+        else:
+            description.append(f"{rank_emoji} **{name}** - Nivel **{level_for_xp(score)}** (XP: {score})")
     embed = discord.Embed(
-        title="🏆 Tabla de Clasificación (Niveles)",
+        title="🏆 Tabla de Clasificación (Dinero)" if mode == 'balance' else "🏆 Tabla de Clasificación (Niveles)",
         description='\n'.join(description),
         color=discord.Color.gold()
     )
-    await ctx.send(embed=embed)
+    embed.set_footer(text=f"Página {page + 1}")
+    return embed
+
+@bot.hybrid_command(name='leaderboard', aliases=['top'], description="Muestra la tabla de clasificación de niveles o de dinero.")
+async def leaderboard(ctx, mode: Literal['levels', 'balance'] = 'levels'):
+    async def fetch(cursor, limit):
+        rows = await storage.get_leaderboard_page(ctx.guild.id, mode, cursor, limit)
+        names = await member_cache.display_names(ctx.guild, [user_id for user_id, _ in rows])
+        return [(user_id, score, names[user_id]) for user_id, score in rows]
+
+    paginator = KeysetPaginator(
+        ctx.author.id,
+        fetch=fetch,
+        render=lambda rows, page: create_leaderboard_embed(mode, rows, page),
+        cursor_of=lambda row: (row[1], row[0]),
+        page_size=LEADERBOARD_PAGE_SIZE
+    )
+    embed = await paginator.load(0)
+    if embed is None:
+        await ctx.send(embed=create_error_embed("Error", "No hay datos para mostrar."), delete_after=10)
+        return
+    if paginator.has_next:
+        paginator.message = await ctx.send(embed=embed, view=paginator)
+    else:
+        await ctx.send(embed=embed)
 
 
 @bot.tree.command(name='admin-setmoney', description='💰 Establece el saldo de un usuario.')
@@ -1075,10 +3998,54 @@ async def slash_setmoney(interaction: discord.Interaction, member: discord.Membe
     if amount < 0:
         await interaction.response.send_message(embed=create_error_embed("Error", "La cantidad debe ser 0 o positiva."), ephemeral=True)
         return
-    new_balance = set_balance(member.id, interaction.guild.id, amount)
+    new_balance = await set_balance(member.id, interaction.guild.id, amount)
     await interaction.response.send_message(embed=create_success_embed("Saldo Actualizado", f"El saldo de **{member.display_name}** ha sido establecido a **{new_balance} 💰**."), ephemeral=True)
 
 
+def resolve_xp_targets(target: Union[discord.Member, discord.Role]) -> list[int]:
+    """Obtiene las IDs afectadas por un comando de XP: el usuario, o los miembros (no bots) del rol."""
+    if isinstance(target, discord.Role):
+        return [member.id for member in target.members if not member.bot]
+    return [target.id]
+
+async def apply_xp_change(interaction: discord.Interaction, target: Union[discord.Member, discord.Role], amount: int, replace: bool, summary: str):
+    """Aplica un cambio de XP en lote y responde a la interacción."""
+    user_ids = resolve_xp_targets(target)
+    if not user_ids:
+        await interaction.response.send_message(embed=create_error_embed("Error", f"El rol {target.mention} no tiene miembros."), ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    # El XP pendiente se guarda antes para que no se sume encima de un valor establecido.
+    await xp_aggregator.flush()
+    updated = await bulk_update_xp(interaction.guild.id, user_ids, amount, replace=replace)
+    await xp_aggregator.forget(interaction.guild.id, user_ids)
+    await interaction.followup.send(embed=create_success_embed("XP Actualizado", f"{summary} para **{updated}** usuario(s) ({target.mention})."), ephemeral=True)
+
+@bot.tree.command(name='admin-addxp', description='✨ Suma o resta XP a un usuario o a todos los miembros de un rol.')
+@discord.app_commands.describe(target='El usuario o rol a modificar.', amount='XP a sumar (negativo para restar).')
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def slash_addxp(interaction: discord.Interaction, target: Union[discord.Member, discord.Role], amount: int):
+    await apply_xp_change(interaction, target, amount, replace=False, summary=f"Se han sumado **{amount} XP**")
+
+@bot.tree.command(name='admin-setxp', description='✨ Establece el XP total de un usuario o de todos los miembros de un rol.')
+@discord.app_commands.describe(target='El usuario o rol a modificar.', amount='El nuevo XP total.')
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def slash_setxp(interaction: discord.Interaction, target: Union[discord.Member, discord.Role], amount: int):
+    if amount < 0:
+        await interaction.response.send_message(embed=create_error_embed("Error", "La cantidad debe ser 0 o positiva."), ephemeral=True)
+        return
+    await apply_xp_change(interaction, target, amount, replace=True, summary=f"El XP total se ha establecido a **{amount}**")
+
+@bot.tree.command(name='admin-setlevel', description='✨ Establece el nivel de un usuario o de todos los miembros de un rol.')
+@discord.app_commands.describe(target='El usuario o rol a modificar.', level='El nuevo nivel.')
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def slash_setlevel(interaction: discord.Interaction, target: Union[discord.Member, discord.Role], level: int):
+    if level < 0:
+        await interaction.response.send_message(embed=create_error_embed("Error", "El nivel debe ser 0 o positivo."), ephemeral=True)
+        return
+    await apply_xp_change(interaction, target, xp_for_level(level), replace=True, summary=f"El nivel se ha establecido a **{level}**")
+
+
 @bot.tree.command(name='admin-addshoprole', description='🛒 Pone un rol a la venta en la tienda de economía.')
 @discord.app_commands.describe(role='El rol que quieres vender.', price='El precio del rol.')
 @discord.app_commands.checks.has_permissions(administrator=True)
@@ -1086,87 +4053,372 @@ async def slash_addshoprole(interaction: discord.Interaction, role: discord.Role
     if price <= 0:
         await interaction.response.send_message(embed=create_error_embed("Error", "El precio debe ser positivo."), ephemeral=True)
         return
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO role_shop (guild_id, role_id, price) VALUES (%s, %s, %s) ON CONFLICT (guild_id, role_id) DO UPDATE SET price = EXCLUDED.price",
-                (interaction.guild.id, role.id, price)
-            )
-            conn.commit()
+    await shop_index.add(interaction.guild, role, price)
     await interaction.response.send_message(embed=create_success_embed("Rol Añadido a la Tienda", f"El rol **{role.name}** está ahora a la venta por **{price} 💰**."), ephemeral=True)
 
 
-@bot.hybrid_command(name='shop', description="Muestra la tienda de roles.")
-async def shop(ctx):
-    shop_roles = get_shop_roles(ctx.guild.id)
-    if not shop_roles:
-        await ctx.send(embed=create_error_embed("Tienda Vacía", "No hay roles a la venta en este momento."), delete_after=10)
+@bot.tree.command(name='admin-removeshoprole', description='🗑️ Quita un rol de la tienda de economía.')
+@discord.app_commands.describe(role='El rol que ya no quieres vender.')
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def slash_removeshoprole(interaction: discord.Interaction, role: discord.Role):
+    if not await shop_index.remove(interaction.guild.id, role.id):
+        await interaction.response.send_message(embed=create_error_embed("Error", f"El rol **{role.name}** no está a la venta."), ephemeral=True)
         return
-    description = []
-    for role_id, price in shop_roles:
-        role = ctx.guild.get_role(role_id)
-        if role:
-            description.append(f"**{role.name}** ➡️ **{price} 💰**")
+    await interaction.response.send_message(embed=create_success_embed("Rol Quitado de la Tienda", f"El rol **{role.name}** ya no está a la venta."), ephemeral=True)
+
+
+def create_shop_embed(rows: list[tuple[int, discord.Role, int]], page: int, total: int) -> discord.Embed:
+    """Crea el embed de una página de la tienda a partir de filas (posición, rol, precio)."""
+    description = [f"**{role.name}** ➡️ **{price} 💰**" for _, role, price in rows]
     embed = discord.Embed(
         title="🛍️ Tienda de Roles",
         description='\n'.join(description) + "\n\nUsa `!buyrole <NombreDelRol>` para comprar.",
         color=discord.Color.blue()
     )
-    await ctx.send(embed=embed)
+    embed.set_footer(text=f"Página {page + 1} de {math.ceil(total / SHOP_PAGE_SIZE)}")
+    return embed
+
+@bot.hybrid_command(name='shop', description="Muestra la tienda de roles.")
+async def shop(ctx):
+    entries = await shop_index.entries(ctx.guild)
+    if not entries:
+        await ctx.send(embed=create_error_embed("Tienda Vacía", "No hay roles a la venta en este momento."), delete_after=10)
+        return
+
+    async def fetch(cursor, limit):
+        start = cursor or 0
+        return [(i, role, price) for i, (role, price) in enumerate(entries[start:start + limit], start)]
+
+    paginator = KeysetPaginator(
+        ctx.author.id,
+        fetch=fetch,
+        render=lambda rows, page: create_shop_embed(rows, page, len(entries)),
+        cursor_of=lambda row: row[0] + 1,
+        page_size=SHOP_PAGE_SIZE
+    )
+    embed = await paginator.load(0)
+    if paginator.has_next:
+        paginator.message = await ctx.send(embed=embed, view=paginator)
+    else:
+        await ctx.send(embed=embed)
 
 
 @bot.hybrid_command(name='buyrole', description="Compra un rol de la tienda.")
+@discord.app_commands.describe(role_name='El nombre del rol que quieres comprar.')
 async def buyrole(ctx, *, role_name: str):
-    role_name = role_name.strip()
-    shop_roles = get_shop_roles(ctx.guild.id)
-    role_to_buy = None
-    price = 0
-    for role_id, p in shop_roles:
-        role = ctx.guild.get_role(role_id)
-        if role and role.name.lower() == role_name.lower():
-            role_to_buy = role
-            price = p
-            break
-    if not role_to_buy:
-        await ctx.send(embed=create_error_embed("Error", f"El rol **{role_name}** no está a la venta."), delete_after=10)
+    found = await shop_index.find(ctx.guild, role_name)
+    if not found:
+        await ctx.send(embed=create_error_embed("Error", f"El rol **{role_name.strip()}** no está a la venta."), delete_after=10)
         return
+    role_to_buy, price = found
     if role_to_buy in ctx.author.roles:
         await ctx.send(embed=create_error_embed("Error", f"Ya tienes el rol **{role_to_buy.name}**."), delete_after=10)
         return
-    user_balance = get_balance(ctx.author.id, ctx.guild.id)
-    if user_balance < price:
+    new_balance = await update_balance(ctx.author.id, ctx.guild.id, -price, 'shop', required=price)
+    if new_balance is None:
         await ctx.send(embed=create_error_embed("Error", f"No tienes suficiente dinero. Necesitas **{price} 💰**."), delete_after=10)
         return
     try:
-        update_balance(ctx.author.id, ctx.guild.id, -price)
         await ctx.author.add_roles(role_to_buy, reason="Compra de rol en la tienda.")
-        new_balance = get_balance(ctx.author.id, ctx.guild.id)
         await ctx.send(embed=create_success_embed("Compra Exitosa", f"Has comprado el rol **{role_to_buy.name}** por **{price} 💰**. Saldo restante: {new_balance} 💰"))
     except discord.Forbidden:
+        await update_balance(ctx.author.id, ctx.guild.id, price, 'shop')  # Reembolso: no se pudo entregar el rol.
         await ctx.send(embed=create_error_embed("Error de Permisos", "No puedo darte ese rol (puede que el rol esté por encima del mío)."), delete_after=10)
 
+@buyrole.autocomplete('role_name')
+async def buyrole_autocomplete(interaction: discord.Interaction, current: str) -> list[discord.app_commands.Choice[str]]:
+    """Sugiere los roles de la tienda cuyo nombre empieza por lo que el usuario lleva escrito."""
+    matches = await shop_index.complete(interaction.guild, current)
+    return [discord.app_commands.Choice(name=f"{role.name} — {price} 💰"[:100], value=role.name) for role, price in matches]
+
+
+# ----------------------------------------------------
+# SERVIDOR HTTP DE SALUD (EN EL EVENT LOOP)
+# ----------------------------------------------------
+
+class LoopLagMonitor:
+    """Mide cada `interval` segundos cuánto se retrasa el event loop en despertar una tarea."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lag = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(loop.time() - start - self.interval, 0.0)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+
+loop_lag = LoopLagMonitor(HEALTH_LAG_CHECK_INTERVAL_SECONDS)
+
+
+@metrics.gauge('nexus_event_loop_lag_seconds', "Último retraso medido del event loop.")
+def loop_lag_gauge():
+    return [((), loop_lag.lag)]
+
+
+async def check_db_health() -> bool:
+    """Comprueba que el almacenamiento pueda ejecutar una consulta dentro del tiempo límite."""
+    try:
+        return await asyncio.wait_for(storage.ping(), HEALTH_DB_TIMEOUT_SECONDS)
+    except Exception:
+        return False
+
+
+async def healthz(request: web.Request) -> web.Response:
+    """El proceso está vivo y el event loop responde."""
+    return web.Response(text="El bot está vivo.")
+
+async def readyz(request: web.Request) -> web.Response:
+    """El bot puede atender tráfico: gateway conectado, DB accesible y event loop sin retrasos."""
+    checks = {
+        'gateway': bot.is_ready() and not bot.is_closed() and math.isfinite(bot.latency),
+        'database': await check_db_health(),
+        'event_loop': loop_lag.lag < HEALTH_MAX_LOOP_LAG_SECONDS,
+    }
+    status = 200 if all(checks.values()) else 503
+    return web.json_response({'ready': status == 200, 'checks': checks, 'loop_lag_seconds': loop_lag.lag}, status=status)
+
+def _finite_or_none(value: float) -> Optional[float]:
+    return value if math.isfinite(value) else None
+
+async def status(request: web.Request) -> web.Response:
+    """Estado de este proceso: shards, latencias y servidores."""
+    latencies = bot.latencies if CLUSTER_MODE else [(0, bot.latency)]
+    return web.json_response({
+        'cluster_id': CLUSTER_ID,
+        'shard_ids': SHARD_IDS,
+        'shard_count': SHARD_COUNT,
+        'ready': bot.is_ready(),
+        'latencies': {str(shard_id): _finite_or_none(latency) for shard_id, latency in latencies},
+        'guilds': len(bot.guilds),
+        'members': sum(guild.member_count or 0 for guild in bot.guilds),
+        'loop_lag_seconds': loop_lag.lag,
+    })
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_http_server() -> web.AppRunner:
+    """Levanta el servidor de salud en el mismo event loop que el bot (sin hilos extra)."""
+    app = web.Application()
+    app.router.add_get('/', healthz)
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_get('/status', status)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HTTP_HOST, HTTP_PORT).start()
+    return runner
+
+
+# ----------------------------------------------------
+# MODO CLÚSTER (VARIOS PROCESOS)
+# ----------------------------------------------------
+
+def split_shards(shard_count: int, clusters: int) -> list[list[int]]:
+    """Reparte los shards en rangos contiguos, uno por proceso."""
+    return [list(range(i * shard_count // clusters, (i + 1) * shard_count // clusters)) for i in range(clusters)]
+
+def cluster_port(cluster_id: int) -> int:
+    """Puerto local del servidor de salud de cada worker (el principal usa PORT)."""
+    return HTTP_PORT + 1 + cluster_id
+
+async def fetch_gateway_info(token: str) -> tuple[int, int]:
+    """Obtiene (shards recomendados, max_concurrency) de Discord."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers={'Authorization': f"Bot {token}"}) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return data['shards'], data['session_start_limit']['max_concurrency']
+
+
+class ClusterSupervisor:
+    """
+    Proceso principal del modo clúster: lanza un worker por rango de shards, los reinicia si mueren
+    y expone en PORT el estado agregado de todos (`/status`, `/readyz`).
+    """
+
+    def __init__(self, shard_count: int, max_concurrency: int):
+        self.shard_count = shard_count
+        self.max_concurrency = max_concurrency
+        self.plan = split_shards(shard_count, CLUSTER_COUNT)
+        self.processes: dict[int, multiprocessing.Process] = {}
+        self.restarts = {cluster_id: 0 for cluster_id in range(CLUSTER_COUNT)}
+        self.context = multiprocessing.get_context('spawn')
+        self.stopping = asyncio.Event()
+
+    def _spawn(self, cluster_id: int):
+        # Con 'spawn' el hijo importa el módulo desde cero, así que la configuración viaja por el entorno.
+        os.environ.update({
+            'CLUSTER_ID': str(cluster_id),
+            'SHARD_IDS': ','.join(map(str, self.plan[cluster_id])),
+            'SHARD_COUNT': str(self.shard_count),
+            'PORT': str(cluster_port(cluster_id)),
+            'HTTP_HOST': '127.0.0.1',
+        })
+        process = self.context.Process(target=run_bot, name=f"nexus-cluster-{cluster_id}")
+        process.start()
+        self.processes[cluster_id] = process
+        print(f"Clúster {cluster_id} iniciado (PID {process.pid}, shards {self.plan[cluster_id]}).")
+
+    def _identify_delay(self, cluster_id: int) -> float:
+        # Discord permite `max_concurrency` IDENTIFY cada 5 segundos; se escalonan los workers para no superarlo.
+        return CLUSTER_IDENTIFY_WINDOW_SECONDS * math.ceil(len(self.plan[cluster_id]) / self.max_concurrency)
+
+    async def _supervise(self):
+        for cluster_id in range(CLUSTER_COUNT):
+            self._spawn(cluster_id)
+            await asyncio.sleep(self._identify_delay(cluster_id))
+        while not self.stopping.is_set():
+            for cluster_id, process in list(self.processes.items()):
+                if not process.is_alive() and not self.stopping.is_set():
+                    self.restarts[cluster_id] += 1
+                    print(f"Clúster {cluster_id} terminó con código {process.exitcode}; reiniciando.")
+                    self._spawn(cluster_id)
+                    await asyncio.sleep(self._identify_delay(cluster_id))
+            try:
+                await asyncio.wait_for(self.stopping.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fetch_worker(self, session: aiohttp.ClientSession, cluster_id: int, path: str) -> tuple[int, Optional[dict]]:
+        try:
+            async with session.get(f"http://127.0.0.1:{cluster_port(cluster_id)}{path}") as resp:
+                return resp.status, await resp.json()
+        except Exception:
+            return 0, None
 
-app = Flask(__name__)
+    async def _gather(self, path: str) -> list[tuple[int, Optional[dict]]]:
+        timeout = aiohttp.ClientTimeout(total=CLUSTER_STATUS_TIMEOUT_SECONDS)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            return await asyncio.gather(*(self._fetch_worker(session, cluster_id, path) for cluster_id in range(CLUSTER_COUNT)))
 
-@app.route('/')
-def home():
-    return "El bot está vivo."
+    async def status(self, request: web.Request) -> web.Response:
+        clusters = []
+        for cluster_id, (_, data) in enumerate(await self._gather('/status')):
+            process = self.processes.get(cluster_id)
+            clusters.append({
+                'cluster_id': cluster_id,
+                'shard_ids': self.plan[cluster_id],
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'restarts': self.restarts[cluster_id],
+                'status': data,
+            })
+        reachable = [c['status'] for c in clusters if c['status']]
+        return web.json_response({
+            'shard_count': self.shard_count,
+            'clusters': clusters,
+            'guilds': sum(s['guilds'] for s in reachable),
+            'members': sum(s['members'] for s in reachable),
+            'ready': len(reachable) == CLUSTER_COUNT and all(s['ready'] for s in reachable),
+        })
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        results = await self._gather('/readyz')
+        checks = {str(cluster_id): code == 200 for cluster_id, (code, _) in enumerate(results)}
+        status = 200 if all(checks.values()) else 503
+        return web.json_response({'ready': status == 200, 'clusters': checks}, status=status)
+
+    def stop(self):
+        self.stopping.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        app = web.Application()
+        app.router.add_get('/', healthz)
+        app.router.add_get('/healthz', healthz)
+        app.router.add_get('/readyz', self.readyz)
+        app.router.add_get('/status', self.status)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, HTTP_HOST, HTTP_PORT).start()
+        try:
+            await self._supervise()
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+            for process in self.processes.values():
+                await asyncio.to_thread(process.join, 30)
+            await runner.cleanup()
+
+
+async def prepare_cluster(token: str) -> ClusterSupervisor:
+    """Calcula el reparto de shards antes de lanzar los workers."""
+    shard_count, max_concurrency = await fetch_gateway_info(token)
+    return ClusterSupervisor(SHARD_COUNT or max(shard_count, CLUSTER_COUNT), max_concurrency)
+
+def run_cluster(token: str):
+    async def main():
+        supervisor = await prepare_cluster(token)
+        print(f"Modo clúster: {supervisor.shard_count} shards en {CLUSTER_COUNT} procesos.")
+        await supervisor.run()
+    asyncio.run(main())
+
+
+async def start_bot(token: str):
+    """
+    Conecta el bot y lo cierra ordenadamente con SIGTERM o SIGINT.
+
+    `bot.run` solo atrapa KeyboardInterrupt, pero Render al desplegar y el supervisor del clúster al detenerse
+    (`process.terminate()`) envían SIGTERM; así `close()` siempre vacía el XP y los logs en cola.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    async with bot:
+        runner = asyncio.create_task(bot.start(token))
+        stop_waiter = asyncio.create_task(stopping.wait())
+        await asyncio.wait({runner, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        stop_waiter.cancel()
+        if stopping.is_set():
+            print("Señal de apagado recibida; guardando datos pendientes...")
+        # Se espera aquí a close() para que asyncio.run no cancele los vaciados a medias.
+        await bot.close()
+        await runner
 
-def run_flask():
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
 
 def run_bot():
     TOKEN = os.getenv('DISCORD_TOKEN')
     if not TOKEN:
         print("¡ERROR CRÍTICO! La variable DISCORD_TOKEN no está configurada. El bot no puede iniciarse.")
         return
-    if not DATABASE_URL:
+    if STORAGE_BACKEND not in ('postgres', 'sqlite'):
+        print(f"¡ERROR CRÍTICO! STORAGE_BACKEND='{STORAGE_BACKEND}' no es válido. Usa 'postgres' o 'sqlite'.")
+        return
+    if STORAGE_BACKEND == 'postgres' and not DATABASE_URL:
         print("¡ERROR CRÍTICO! La variable DATABASE_URL no está configurada. El bot no puede conectarse a la base de datos.")
         return
+    if not IS_CLUSTER_WORKER:
+        # En modo clúster el proceso principal migra una sola vez antes de lanzar los workers.
+        try:
+            storage.migrate()
+        except (psycopg2.Error, sqlite3.Error) as e:
+            print(f"¡ERROR CRÍTICO! No se pudo migrar la base de datos: {e}")
+            return
+    if CLUSTER_COUNT > 1 and not IS_CLUSTER_WORKER:
+        run_cluster(TOKEN)
+        return
     print("Conectando el bot a Discord...")
+    discord.utils.setup_logging()  # Lo que hacía bot.run.
     try:
-        bot.run(TOKEN)
+        asyncio.run(start_bot(TOKEN))
     except discord.HTTPException as e:
         print(f"ERROR: Token inválido o problema de conexión. Revisa tu Token. Error: {e.status} {e.text}")
     except Exception as e:
@@ -1174,7 +4426,4 @@ def run_bot():
 
 
 if __name__ == '__main__':
-    from threading import Thread
-    flask_thread = Thread(target=run_flask)
-    flask_thread.start()
     run_bot()
@@ -0,0 +1,396 @@
+"""
+Benchmark de carga de Nexusv1.py sin conexión a Discord.
+
+Reproduce eventos sintéticos (mensajes y comandos de economía/niveles) directamente sobre los
+handlers del bot contra un PostgreSQL local o un archivo SQLite, y reporta la latencia de cada handler
+(p50/p95/p99), las idas y vueltas a la DB por evento y el tiempo que el event loop estuvo bloqueado.
+
+Uso:
+    python bench.py --database-url postgresql://localhost/nexus --guilds 10 --users 1000 --events 20000 --concurrency 50
+    python bench.py --backend sqlite --guilds 10 --users 1000 --events 20000 --concurrency 50
+
+Con PostgreSQL, todas las tablas se crean en un esquema aparte (`--schema`, por defecto `nexus_bench`)
+que se borra al iniciar; con SQLite, en un archivo aparte (`--sqlite-path`) que también se recrea.
+Así nunca toca los datos del bot.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import math
+import os
+import random
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+from psycopg2.extensions import make_dsn
+
+import Nexusv1 as nexus
+
+# ----------------------------------------------------
+# 1. OBJETOS SINTÉTICOS DE DISCORD
+# ----------------------------------------------------
+
+class FakeUser:
+    def __init__(self, user_id: int, bot: bool = False):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = bot
+        self.display_avatar = SimpleNamespace(url=f"https://cdn.discordapp.com/embed/avatars/{user_id % 5}.png")
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, members: list[FakeUser]):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.members = {member.id: member for member in members}
+        self.member_ids = list(self.members)
+
+    def get_member(self, user_id: int) -> Optional[FakeUser]:
+        return self.members.get(user_id)
+
+
+class FakeMessage:
+    _next_id = 1
+
+    def __init__(self, author: FakeUser, guild: FakeGuild, channel: "FakeChannel", content: str = ""):
+        self.id = FakeMessage._next_id
+        FakeMessage._next_id += 1
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.content = content
+        self._state = nexus.bot._connection
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def clear_reactions(self):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: FakeGuild):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"channel{channel_id}"
+        self.mention = f"<#{channel_id}>"
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs) -> FakeMessage:
+        self.sent += 1
+        return FakeMessage(nexus.bot.user, self.guild, self, content or "")
+
+
+class FakeContext:
+    def __init__(self, author: FakeUser, guild: FakeGuild, channel: FakeChannel):
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.bot = nexus.bot
+        self.message = FakeMessage(author, guild, channel)
+        self.interaction = None
+
+    async def send(self, content=None, **kwargs) -> FakeMessage:
+        return await self.channel.send(content, **kwargs)
+
+    async def defer(self, **kwargs):
+        pass
+
+
+# ----------------------------------------------------
+# 2. INSTRUMENTACIÓN
+# ----------------------------------------------------
+
+# Contador de sentencias del evento en curso. asyncio.to_thread (y el hilo de SQLite) copia el contexto,
+# así que el hilo que ejecuta la transacción lo ve aunque haya otros eventos en paralelo.
+current_event_counter: contextvars.ContextVar[Optional[list[int]]] = contextvars.ContextVar('current_event_counter', default=None)
+background_counter = [0]
+
+
+class CountingCursor:
+    """Envuelve un cursor de psycopg2 o sqlite3 y cuenta cada sentencia enviada al motor."""
+
+    def __init__(self, cursor, counter: list[int]):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def install_db_counter():
+    """Sustituye `_run_transaction` para contar sentencias y commits por evento."""
+    if isinstance(nexus.storage, nexus.SQLiteStorage):
+        run_sqlite = nexus.storage._run_transaction
+
+        def counted_sqlite(func, atomic, *args):
+            counter = current_event_counter.get() or background_counter
+            if atomic:
+                counter[0] += 1  # COMMIT
+            return run_sqlite(lambda cursor, *a: func(CountingCursor(cursor, counter), *a), atomic, *args)
+
+        nexus.storage._run_transaction = counted_sqlite
+        return
+
+    run_transaction = nexus._run_transaction
+
+    def counted(func, *args):
+        counter = current_event_counter.get() or background_counter
+        counter[0] += 1  # COMMIT
+        return run_transaction(lambda cursor, *a: func(CountingCursor(cursor, counter), *a), *args)
+
+    nexus._run_transaction = counted
+
+
+class LoopLagMonitor:
+    """Mide cuánto tarda el event loop en despertar una tarea que duerme `interval` segundos."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.blocked = 0.0
+        self.max_lag = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            if lag > 0:
+                self.blocked += lag
+                self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.task.cancel()
+
+
+# ----------------------------------------------------
+# 3. CARGA DE TRABAJO
+# ----------------------------------------------------
+
+DEFAULT_MIX = "message=80,daily=2,work=3,flip=4,slots=4,rob=2,rank=3,leaderboard=2"
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in EVENT_HANDLERS:
+            raise argparse.ArgumentTypeError(f"Evento desconocido: {name}")
+        weights[name] = int(weight)
+    return weights
+
+
+async def event_message(ctx: FakeContext, rng: random.Random):
+    message = FakeMessage(ctx.author, ctx.guild, ctx.channel, content="hola a todos")
+    await nexus.on_message(message)
+
+async def event_daily(ctx: FakeContext, rng: random.Random):
+    await nexus.daily.callback(ctx)
+
+async def event_work(ctx: FakeContext, rng: random.Random):
+    await nexus.work.callback(ctx)
+
+async def event_flip(ctx: FakeContext, rng: random.Random):
+    await nexus.flip.callback(ctx, rng.choice(['cara', 'cruz']), rng.randint(1, 200))
+
+async def event_slots(ctx: FakeContext, rng: random.Random):
+    await nexus.slots.callback(ctx, rng.randint(1, 200))
+
+async def event_rob(ctx: FakeContext, rng: random.Random):
+    target = ctx.guild.get_member(rng.choice(ctx.guild.member_ids))
+    await nexus.rob.callback(ctx, target)
+
+async def event_rank(ctx: FakeContext, rng: random.Random):
+    await nexus.rank.callback(ctx)
+
+async def event_leaderboard(ctx: FakeContext, rng: random.Random):
+    await nexus.leaderboard.callback(ctx, rng.choice(['levels', 'balance']))
+
+
+EVENT_HANDLERS = {
+    'message': event_message,
+    'daily': event_daily,
+    'work': event_work,
+    'flip': event_flip,
+    'slots': event_slots,
+    'rob': event_rob,
+    'rank': event_rank,
+    'leaderboard': event_leaderboard,
+}
+
+
+async def seed_database(guilds: list[FakeGuild], balance: int):
+    """Da saldo inicial a todos los usuarios para que flip, slots y rob tengan trabajo real."""
+    rows = [(user_id, guild.id, balance) for guild in guilds for user_id in guild.members]
+    if isinstance(nexus.storage, nexus.SQLiteStorage):
+        await nexus.storage._run(
+            lambda cursor: cursor.executemany("INSERT INTO economy (user_id, guild_id, balance) VALUES (?, ?, ?)", rows), atomic=True
+        )
+    else:
+        await nexus.db_transaction(lambda cursor: nexus.execute_values(cursor, "INSERT INTO economy (user_id, guild_id, balance) VALUES %s", rows))
+
+
+def reset_schema(cursor, schema: str):
+    cursor.execute(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+    cursor.execute(f'CREATE SCHEMA "{schema}"')
+
+
+def reset_sqlite(path: str):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# ----------------------------------------------------
+# 4. EJECUCIÓN Y REPORTE
+# ----------------------------------------------------
+
+def percentile(samples: list[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run_benchmark(args) -> str:
+    rng = random.Random(args.seed)
+    nexus.bot._connection.user = FakeUser(1, bot=True)
+    if args.backend == 'sqlite':
+        reset_sqlite(args.sqlite_path)
+        nexus.storage = nexus.SQLiteStorage(args.sqlite_path)
+        await nexus.storage.open()
+    else:
+        nexus.DATABASE_URL = make_dsn(args.database_url, options=f"-c search_path={args.schema}")
+        nexus.DB_SSLMODE = args.sslmode
+        nexus.DB_POOL_MAX_SIZE = args.pool_size
+        nexus.storage = nexus.PostgresStorage()
+        await nexus.storage.open()
+        await nexus.db_transaction(reset_schema, args.schema)
+    install_db_counter()
+    await asyncio.to_thread(nexus.storage.migrate)
+
+    guilds = []
+    for g in range(args.guilds):
+        guild_id = 10_000 + g
+        members = [FakeUser(guild_id * 1_000_000 + u) for u in range(args.users)]
+        guilds.append(FakeGuild(guild_id, members))
+    await seed_database(guilds, args.initial_balance)
+    channels = {guild.id: FakeChannel(guild.id * 10, guild) for guild in guilds}
+
+    weights = parse_mix(args.mix)
+    names = list(weights)
+    events = rng.choices(names, weights=[weights[n] for n in names], k=args.events)
+
+    latencies: dict[str, list[float]] = {name: [] for name in names}
+    round_trips: dict[str, list[int]] = {name: [] for name in names}
+    errors: dict[str, int] = {name: 0 for name in names}
+    queue: asyncio.Queue = asyncio.Queue()
+    for name in events:
+        guild = rng.choice(guilds)
+        queue.put_nowait((name, guild, guild.get_member(rng.choice(guild.member_ids))))
+
+    async def worker(worker_rng: random.Random):
+        while True:
+            try:
+                name, guild, author = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            counter = [0]
+            token = current_event_counter.set(counter)
+            ctx = FakeContext(author, guild, channels[guild.id])
+            start = time.perf_counter()
+            try:
+                await EVENT_HANDLERS[name](ctx, worker_rng)
+            except Exception as e:
+                errors[name] += 1
+                if args.verbose:
+                    print(f"[{name}] {type(e).__name__}: {e}")
+            finally:
+                latencies[name].append(time.perf_counter() - start)
+                round_trips[name].append(counter[0])
+                current_event_counter.reset(token)
+
+    nexus.flush_xp.start()
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(random.Random(rng.random())) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    monitor.stop()
+    nexus.flush_xp.cancel()
+    await nexus.xp_aggregator.flush()
+    await nexus.storage.close()
+
+    lines = [
+        f"Motor: {args.backend}  Eventos: {args.events}  Servidores: {args.guilds}  Usuarios/servidor: {args.users}  Concurrencia: {args.concurrency}",
+        f"Duración: {elapsed:.2f} s  Throughput: {args.events / elapsed:.1f} eventos/s",
+        f"Event loop bloqueado: {monitor.blocked * 1000:.1f} ms en total, lag máximo {monitor.max_lag * 1000:.1f} ms",
+        f"Sentencias de DB en segundo plano (flush de XP): {background_counter[0]}",
+        "",
+        f"{'evento':<12}{'n':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'DB/evento':>11}{'errores':>9}",
+    ]
+    for name in names:
+        samples = latencies[name]
+        if not samples:
+            continue
+        lines.append(
+            f"{name:<12}{len(samples):>8}"
+            f"{percentile(samples, 50) * 1000:>10.2f}{percentile(samples, 95) * 1000:>10.2f}{percentile(samples, 99) * 1000:>10.2f}"
+            f"{sum(round_trips[name]) / len(samples):>11.2f}{errors[name]:>9}"
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga de Nexus sin conexión a Discord.")
+    parser.add_argument('--backend', choices=['postgres', 'sqlite'], default='postgres')
+    parser.add_argument('--database-url', help="PostgreSQL local, p. ej. postgresql://localhost/nexus (con --backend postgres).")
+    parser.add_argument('--sqlite-path', default='nexus_bench.db', help="Archivo desechable de SQLite (con --backend sqlite).")
+    parser.add_argument('--schema', default='nexus_bench', help="Esquema desechable donde se crean las tablas.")
+    parser.add_argument('--sslmode', default='prefer')
+    parser.add_argument('--pool-size', type=int, default=nexus.DB_POOL_MAX_SIZE)
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--users', type=int, default=1000, help="Usuarios por servidor.")
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Pesos por evento, p. ej. 'message=80,flip=20'.")
+    parser.add_argument('--initial-balance', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Además de imprimir el reporte, lo guarda en este archivo.")
+    parser.add_argument('--verbose', action='store_true', help="Imprime cada excepción de los handlers.")
+    args = parser.parse_args()
+    if args.backend == 'postgres' and not args.database_url:
+        parser.error("--database-url es obligatorio con --backend postgres")
+
+    report = asyncio.run(run_benchmark(args))
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+
+
+if __name__ == "__main__":
+    main()